@@ -1,4 +1,6 @@
 import os
+import time
+import logging
 from pymongo import MongoClient
 from .models import *
 from typing import Optional
@@ -35,10 +37,15 @@ class LexicalTextSearchDB():
             self.mongo_client = mongo_client
 
         self.supported_languages = supported_languages
+        # Generation is read before the services so that changes written meanwhile are noticed later
+        self.generation_poll_interval = float(os.environ.get('CATALOG_GENERATION_POLL_INTERVAL', 5))
+        self._generation_checked = time.monotonic()
+        self.database_generation = self._get_database_generation()
         self.services = []
         self._get_all_services_from_db()
 
     def _get_all_services_from_db(self, start_datetime: Optional[datetime] = None) -> int:
+        # Services are updated in a copy which replaces the list with one assignment, searches keep the list they have read
         if start_datetime:
             all_services = list(self.mongo_client.service_db.services.find(
                 {"lastUpdated": {"$gte": start_datetime}}))
@@ -53,6 +60,8 @@ class LexicalTextSearchDB():
                     'source_text')] = translation.get('target_text')
 
         all_services = [Service(**service) for service in all_services]
+        services = list(self.services) if start_datetime else []
+        service_index = {service["id"]: index for index, service in enumerate(services)}
         updated_services_count = 0
         for service in all_services:
             service_updated = False
@@ -74,19 +83,45 @@ class LexicalTextSearchDB():
                 lan_desc = [text for text in lan_desc if text]
                 text_el[language] = ' '.join(lan_desc)
             if any([text_el[lan] for lan in text_el.keys()]):
-                existing_service_index = self._get_service_index_by_id(
-                    service.id)
-                if existing_service_index:
-                    self.services[existing_service_index] = {
-                        "id": service.id, "text": text_el}
+                codes = self._get_service_codes(service)
+                existing_service_index = service_index.get(service.id)
+                if existing_service_index is not None:
+                    services[existing_service_index] = {
+                        "id": service.id, "text": text_el, "codes": codes}
                 else:
-                    self.services.append({"text": text_el, "id": service.id})
+                    service_index[service.id] = len(services)
+                    services.append({"text": text_el, "id": service.id, "codes": codes})
                 service_updated = True
             if service_updated:
                 updated_services_count += 1
 
+        self.services = services
         return updated_services_count
 
+    def _get_database_generation(self):
+        # Processor increments the generation whenever it has written new data
+        generation = self.mongo_client.service_db.catalog_generation.find_one({"_id": "catalog"})
+        return generation.get("generation") if generation is not None else None
+
+    def _refresh_database_generation(self) -> bool:
+        # Checks at most once in poll interval if the processor has written new data, returns True if it has.
+        # The generation is stored only after the new data has been published so that a failed update is retried
+        if time.monotonic() - self._generation_checked <= self.generation_poll_interval:
+            return False
+        self._generation_checked = time.monotonic()
+        try:
+            generation = self._get_database_generation()
+        except Exception as e:
+            logging.error(f"Could not read catalog generation: {e}")
+            return False
+        return generation != self.database_generation
+
+    def _get_service_codes(self, service: Service) -> dict:
+        # Same classification codes as the processor stores for service matcher, a service without municipalities is available in all of them
+        return {"service_class_codes": [service_class["code"] for service_class in service.serviceClasses["fi"]],
+                "municipality_codes": [area["code"] for area in service.areas["fi"] if area.get('type') == 'Municipality'],
+                "life_event_codes": [life_event["code"] for life_event in service.lifeEvents["fi"]]}
+
     def _get_translation_if_missing(self, text: str, finnish_text: str, language: str) -> str:
         if text is not None or language == 'fi':
             return(text)
@@ -96,9 +131,6 @@ class LexicalTextSearchDB():
         else:
             return(None)
 
-    def _get_service_index_by_id(self, service_id: str) -> int:
-        return next((index for (index, d) in enumerate(self.services) if d["id"] == service_id), None)
-
     def update_services(self) -> str:
         if len(self.services) > 0:
             start_datetime = datetime.utcnow() - timedelta(hours=24)
@@ -7,6 +7,8 @@ from nltk.tokenize import word_tokenize
 from nltk import ngrams
 import numpy as np
 import re
+import logging
+import threading
 
 SUPPORTED_LANGUAGES = {'fi': 'finnish', 'en': 'english', 'sv': 'swedish'}
 
@@ -24,27 +26,48 @@ class LexicalTextSearch():
     -------
     search_services(ServiceSearchQuery: ServiceSearchQuery)
         Returns list of found services
+
+    search_service_ids(ServiceIdSearchQuery: ServiceIdSearchQuery)
+        Returns ids and scores of found services among the candidate services
+
+    update_services()
+        Updates services changed in the database and rebuilds the BM25 models
     """
 
     def __init__(self, db: Optional[LexicalTextSearchDB] = None) -> None:
         # download nltk punkt
         nltk.download('punkt')
 
-        self.tokenized_service_texts = []
         if db is None:
             self.db = LexicalTextSearchDB(
                 supported_languages=list(SUPPORTED_LANGUAGES.keys()))
         else:
             self.db = db
+        self._update_lock = threading.Lock()
         self.create_bm25(CreateBM25())
 
-    def _tokenize_service_texts(self) -> None:
-        self.tokenized_service_texts = {language: []
-                                        for language in SUPPORTED_LANGUAGES}
-        for service in self.db.get_services():
-            for language in self.tokenized_service_texts.keys():
-                self.tokenized_service_texts[language].append(
-                    self._tokenize_text(service["text"][language], language))
+    def _refresh_services(self) -> None:
+        # /syncServices of the processor reaches only one replica, the others notice the new generation here
+        # An update already running stores the new generation when it has finished
+        if self.db._refresh_database_generation() and not self._update_lock.locked():
+            threading.Thread(target=self._update_services_in_background, daemon=True).start()
+
+    def _update_services_in_background(self) -> None:
+        try:
+            self.update_services()
+        except Exception as e:
+            logging.error(f"Could not update services: {e}")
+
+    def _tokenize_service_texts(self, services: list, ngram_min: dict, ngram_max: dict) -> tuple:
+        tokenized_service_texts = {language: []
+                                   for language in SUPPORTED_LANGUAGES}
+        service_row_index = {}
+        for row, service in enumerate(services):
+            service_row_index[service["id"]] = row
+            for language in tokenized_service_texts.keys():
+                tokenized_service_texts[language].append(
+                    self._tokenize_text(service["text"][language], language, ngram_min, ngram_max))
+        return tokenized_service_texts, service_row_index
 
     def _create_ngrams(self, text: str, ngram_min: int, ngram_max: int) -> list:
         text_ngrams_total = []
@@ -63,50 +86,115 @@ class LexicalTextSearch():
         cleant_text = cleant_text.lower()
         return(cleant_text)
 
-    def _tokenize_text(self, text: str, language: str) -> list:
+    def _tokenize_text(self, text: str, language: str, ngram_min: Optional[dict] = None, ngram_max: Optional[dict] = None) -> list:
+        # Ngram lengths of the published search index are used if not given
+        if ngram_min is None or ngram_max is None:
+            ngram_min, ngram_max = self.search_index["ngram_min"], self.search_index["ngram_max"]
         cleant_text = self._clean_text(text)
         tokenized_text = word_tokenize(
             cleant_text, language=SUPPORTED_LANGUAGES.get(language))
         tokenized_text = [
             text for text in tokenized_text if text.isalpha() and text not in stopwords[language]]
         tokenized_text_ngrams = [self._create_ngrams(
-            text, self.ngram_min.get(language, 0), self.ngram_max.get(language, 0)) for text in tokenized_text]
+            text, ngram_min.get(language, 0), ngram_max.get(language, 0)) for text in tokenized_text]
         tokenized_text_ngrams = [
             item for sublist in tokenized_text_ngrams for item in sublist]
         return list(set(tokenized_text + tokenized_text_ngrams))
 
-    def create_bm25(self, CreateBM25: CreateBM25) -> None:
-        self.ngram_min = CreateBM25.ngram_min
-        self.ngram_max = CreateBM25.ngram_max
-        self.bm25_k1 = CreateBM25.bm25_k1
-        self.bm25_b = CreateBM25.bm25_b
-        self._tokenize_service_texts()
-        self.bm25 = {}
+    def _build_search_index(self, services: list, CreateBM25: CreateBM25) -> dict:
+        # Everything a search reads is built here and published together, searches running meanwhile use the previous index
+        tokenized_service_texts, service_row_index = self._tokenize_service_texts(
+            services, CreateBM25.ngram_min, CreateBM25.ngram_max)
+        bm25 = {}
         for language in SUPPORTED_LANGUAGES:
-            self.bm25[language] = BM25Plus(self.tokenized_service_texts[language],
-                                           k1=CreateBM25.bm25_k1, b=CreateBM25.bm25_b)
+            bm25[language] = BM25Plus(tokenized_service_texts[language],
+                                      k1=CreateBM25.bm25_k1, b=CreateBM25.bm25_b)
+        return {"services": services,
+                "service_row_index": service_row_index,
+                "tokenized_service_texts": tokenized_service_texts,
+                "bm25": bm25,
+                "ngram_min": CreateBM25.ngram_min,
+                "ngram_max": CreateBM25.ngram_max,
+                "bm25_k1": CreateBM25.bm25_k1,
+                "bm25_b": CreateBM25.bm25_b}
+
+    def create_bm25(self, CreateBM25: CreateBM25) -> str:
+        with self._update_lock:
+            self.search_index = self._build_search_index(self.db.get_services(), CreateBM25)
         return "Successfully created BM25 models"
 
     def search_services(self, ServiceSearchQuery: ServiceSearchQuery) -> ServiceSearchResponse:
+        self._refresh_services()
+        # The index is read once so that the whole search uses the same one
+        search_index = self.search_index
         tokenized_text = self._tokenize_text(
-            ServiceSearchQuery.text, ServiceSearchQuery.language)
-        scores = self.bm25[ServiceSearchQuery.language].get_scores(
+            ServiceSearchQuery.text, ServiceSearchQuery.language, search_index["ngram_min"], search_index["ngram_max"])
+        scores = search_index["bm25"][ServiceSearchQuery.language].get_scores(
             tokenized_text)
         if ServiceSearchQuery.top_k <= 0:
             top_k = np.argsort(scores)[::-1]
         else:
             top_k = np.argsort(scores)[::-1][:ServiceSearchQuery.top_k]
-        results = [{"score": scores[i], "text": self.db.get_services_by_index(
-            i)["text"][ServiceSearchQuery.language], "id": self.db.get_services_by_index(i)["id"]} for i in top_k]
+        services = search_index["services"]
+        results = [{"score": scores[i], "text": services[i]["text"][ServiceSearchQuery.language], "id": services[i]["id"]} for i in top_k]
+        return ServiceSearchResponse(
+            services=results
+        )
+
+    def _get_candidate_rows(self, search_index: dict, ServiceIdSearchQuery: ServiceIdSearchQuery) -> np.ndarray:
+        services = search_index["services"]
+        service_row_index = search_index["service_row_index"]
+        if ServiceIdSearchQuery.service_ids is not None:
+            rows = [service_row_index[service_id] for service_id in ServiceIdSearchQuery.service_ids
+                    if service_id in service_row_index]
+        else:
+            rows = range(len(services))
+        filters = {"service_class_codes": ServiceIdSearchQuery.service_classes,
+                   "municipality_codes": ServiceIdSearchQuery.municipalities,
+                   "life_event_codes": ServiceIdSearchQuery.life_events}
+        filters = {dimension: set(codes) for dimension, codes in filters.items() if codes is not None}
+        candidate_rows = []
+        for row in rows:
+            codes = services[row]["codes"]
+            # Codes are OR'ed within a filter and filters are AND'ed together
+            if all(not codes_filter.isdisjoint(codes[dimension]) or (dimension == "municipality_codes" and len(codes[dimension]) == 0)
+                   for dimension, codes_filter in filters.items()):
+                candidate_rows.append(row)
+        return np.array(candidate_rows, dtype=int)
+
+    def search_service_ids(self, ServiceIdSearchQuery: ServiceIdSearchQuery) -> ServiceSearchResponse:
+        self._refresh_services()
+        search_index = self.search_index
+        candidate_rows = self._get_candidate_rows(search_index, ServiceIdSearchQuery)
+        if len(candidate_rows) == 0:
+            return ServiceSearchResponse(services=[])
+        tokenized_text = self._tokenize_text(
+            ServiceIdSearchQuery.text, ServiceIdSearchQuery.language, search_index["ngram_min"], search_index["ngram_max"])
+        # Only the candidate documents are scored
+        scores = np.array(search_index["bm25"][ServiceIdSearchQuery.language].get_batch_scores(
+            tokenized_text, candidate_rows))
+        if 0 < ServiceIdSearchQuery.top_k < len(scores):
+            top_k = np.argpartition(-scores, ServiceIdSearchQuery.top_k - 1)[:ServiceIdSearchQuery.top_k]
+            top_k = top_k[np.argsort(-scores[top_k], kind="stable")]
+        else:
+            top_k = np.argsort(-scores, kind="stable")
+        results = [{"id": search_index["services"][candidate_rows[i]]["id"], "score": scores[i]} for i in top_k]
         return ServiceSearchResponse(
             services=results
         )
 
     def update_services(self) -> str:
-        updated_services_msg = self.db.update_services()
-        # Update also BM25 index with new services
-        # Use existing BM25 parameters so that if user has called /createBM25 endpoint to update their values
-        # they won't get overrided with the defaults
-        self.create_bm25(CreateBM25(
-            ngram_min=self.ngram_min, ngram_max=self.ngram_max, bm25_k1=self.bm25_k1, bm25_b=self.bm25_b))
+        # Updates from /syncServices and from a new generation don't run at the same time
+        with self._update_lock:
+            # Generation is read before the services so that changes written meanwhile are noticed later
+            database_generation = self.db._get_database_generation()
+            updated_services_msg = self.db.update_services()
+            # Update also BM25 index with new services
+            # Use existing BM25 parameters so that if user has called /createBM25 endpoint to update their values
+            # they won't get overrided with the defaults
+            search_index = self.search_index
+            self.search_index = self._build_search_index(self.db.get_services(), CreateBM25(
+                ngram_min=search_index["ngram_min"], ngram_max=search_index["ngram_max"],
+                bm25_k1=search_index["bm25_k1"], bm25_b=search_index["bm25_b"]))
+            self.db.database_generation = database_generation
         return updated_services_msg
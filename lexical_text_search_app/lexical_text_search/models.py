@@ -14,6 +14,16 @@ class ServiceSearchQuery(BaseModel):
     top_k: Optional[int] = 10
 
 
+class ServiceIdSearchQuery(BaseModel):
+    text: str
+    language: Optional[str] = Query("fi", regex="^(fi|en|sv)$")
+    top_k: Optional[int] = 10
+    service_ids: Optional[list] = None
+    service_classes: Optional[list] = None
+    municipalities: Optional[list] = None
+    life_events: Optional[list] = None
+
+
 class CreateBM25(BaseModel):
     ngram_min: Optional[dict] = {'fi': 4, 'en': 2, 'sv': 1}
     ngram_max: Optional[dict] = {'fi': 4, 'en': 2, 'sv': 2}
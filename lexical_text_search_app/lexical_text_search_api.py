@@ -21,6 +21,9 @@ class LexicalTextSearchAPI():
     searchServices(ServiceSearchQuery: ServiceSearchQuery)
         Returns list of found services
 
+    searchServiceIds(ServiceIdSearchQuery: ServiceIdSearchQuery)
+        Returns ids and scores of found services among the candidate services
+
     """
 
     def __init__(self, lexical_text_search: Optional[LexicalTextSearch] = None) -> None:
@@ -76,3 +79,19 @@ class LexicalTextSearchAPI():
             - **top_k**: Number of recommendations. Set to 0 to get all services.
             """
             return self.lexical_text_search.search_services(serviceSearchQuery)
+
+        @self.app.post("/searchServiceIds", tags=["Service search"],
+                       summary="Get ids and scores of candidate services by text query")
+        def search_service_ids(serviceIdSearchQuery: ServiceIdSearchQuery) -> list:
+            """
+            ServiceIdSearchQuery has the following fields:
+
+            - **text**: Free text query
+            - **language**: Language of the text
+            - **top_k**: Number of recommendations. Set to 0 to get all candidate services.
+            - **service_ids**: Ids of the candidate services. Leave empty to use all services as candidates.
+            - **service_classes**: Service class codes, candidates must have at least one of them
+            - **municipalities**: Municipality codes, candidates must be available in at least one of them
+            - **life_events**: Life event codes, candidates must have at least one of them
+            """
+            return self.lexical_text_search.search_service_ids(serviceIdSearchQuery)
@@ -1,9 +1,20 @@
 from pydantic import BaseModel
+from typing import Optional, List
 
 
 class VectorResponse(BaseModel):
     vector: list
+    model: Optional[str] = None
 
 
 class VectorizeQuery(BaseModel):
     text: str
+
+
+class VectorBatchResponse(BaseModel):
+    vectors: list
+    model: Optional[str] = None
+
+
+class VectorizeBatchQuery(BaseModel):
+    texts: List[str]
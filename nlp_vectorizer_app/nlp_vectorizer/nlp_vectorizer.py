@@ -19,6 +19,9 @@ class NlpVectorizer():
     -------
     vectorize(VectorizeQuery: VectorizeQuery)
         Returns vectorized text as a list
+
+    vectorize_batch(VectorizeBatchQuery: VectorizeBatchQuery)
+        Returns vectorized texts as a list of lists
     """
 
     def __init__(self, vectorizer: Optional[SentenceTransformer] = None) -> None:
@@ -34,5 +37,15 @@ class NlpVectorizer():
         vector = self.vectorizer.encode(
             cleaned_text, convert_to_tensor=True, normalize_embeddings=True)
         return VectorResponse(
-            vector=vector.tolist()
+            vector=vector.tolist(),
+            model=os.environ.get('NLP_MODEL_NAME')
+        )
+
+    def vectorize_batch(self, VectorizeBatchQuery: VectorizeBatchQuery) -> VectorBatchResponse:
+        cleaned_texts = [self.data_cleaner.clean_text(text) for text in VectorizeBatchQuery.texts]
+        vectors = self.vectorizer.encode(
+            cleaned_texts, convert_to_tensor=True, normalize_embeddings=True)
+        return VectorBatchResponse(
+            vectors=vectors.tolist(),
+            model=os.environ.get('NLP_MODEL_NAME')
         )
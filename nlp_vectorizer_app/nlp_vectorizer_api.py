@@ -21,6 +21,9 @@ class NlpVectorizerAPI():
     vectorize(VectorizeQuery: VectorizeQuery)
         Returns vectorized text as a list
 
+    vectorizeBatch(VectorizeBatchQuery: VectorizeBatchQuery)
+        Returns vectorized texts as a list of lists
+
     """
 
     def __init__(self, nlp_vectorizer: Optional[NlpVectorizer] = None) -> None:
@@ -47,3 +50,7 @@ class NlpVectorizerAPI():
         def vectorize(vectorizeQuery: VectorizeQuery) -> VectorResponse:
             return self.nlp_vectorizer.vectorize(vectorizeQuery)
 
+        @self.app.post("/vectorizeBatch")
+        def vectorize_batch(vectorizeBatchQuery: VectorizeBatchQuery) -> VectorBatchResponse:
+            return self.nlp_vectorizer.vectorize_batch(vectorizeBatchQuery)
+
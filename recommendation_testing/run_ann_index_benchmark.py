@@ -0,0 +1,92 @@
+import os
+import sys
+import time
+import argparse
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'service_matcher_app'))
+from service_matcher.ann_index import IVFFlatIndex
+
+
+def create_synthetic_vectors(n_vectors: int, dim: int, n_topics: int, rng: np.random.Generator) -> np.ndarray:
+    # Service descriptions cluster around topics so vectors are drawn around random topic centers
+    topics = rng.standard_normal((n_topics, dim))
+    vectors = topics[rng.integers(n_topics, size=n_vectors)] + 0.5 * rng.standard_normal((n_vectors, dim))
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors.astype(np.float32)
+
+
+def create_queries(vectors: np.ndarray, n_queries: int, rng: np.random.Generator) -> np.ndarray:
+    queries = vectors[rng.integers(len(vectors), size=n_queries)] + 0.05 * rng.standard_normal((n_queries, vectors.shape[1]))
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    return queries.astype(np.float32)
+
+
+def get_top_k(rows: np.ndarray, scores: np.ndarray, top_k: int) -> np.ndarray:
+    if len(scores) > top_k:
+        top = np.argpartition(-scores, top_k - 1)[:top_k]
+        return rows[top]
+    return rows
+
+
+def run_benchmark(vectors: np.ndarray, queries: np.ndarray, top_k: int, n_probes: list, filter_ratio: float, rng: np.random.Generator) -> dict:
+    mask = rng.random(len(vectors)) < filter_ratio
+    all_rows = np.arange(len(vectors))
+
+    start = time.perf_counter()
+    exact_results = []
+    for query in queries:
+        scores = vectors.dot(query)
+        exact_results.append(set(get_top_k(all_rows[mask], scores[mask], top_k).tolist()))
+    exact_latency = (time.perf_counter() - start) / len(queries)
+    print(f"exact: latency {exact_latency*1000:.2f} ms")
+
+    start = time.perf_counter()
+    index = IVFFlatIndex(vectors)
+    print(f"index with {len(index.centroids)} lists built in {time.perf_counter() - start:.1f} s")
+
+    results = {"exact": {"latency_ms": exact_latency*1000, "recall": 1.0}}
+    for n_probe in n_probes:
+        index.n_probe = n_probe
+        start = time.perf_counter()
+        recalls = []
+        for query, exact_result in zip(queries, exact_results):
+            rows, scores = index.search(query, mask)
+            ann_result = set(get_top_k(rows, scores, top_k).tolist())
+            recalls.append(len(ann_result & exact_result) / max(len(exact_result), 1))
+        latency = (time.perf_counter() - start) / len(queries)
+        results[f"n_probe={n_probe}"] = {"latency_ms": latency*1000, "recall": float(np.mean(recalls))}
+        print(f"n_probe={n_probe}: latency {latency*1000:.2f} ms, recall@{top_k} {np.mean(recalls):.3f}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vectors_file", type=str, default=None,
+                        help="Numpy .npy file of service description vectors, synthetic vectors are used if not given")
+    parser.add_argument("--n_vectors", type=int, default=100000,
+                        help="Number of synthetic vectors")
+    parser.add_argument("--dim", type=int, default=768,
+                        help="Dimension of synthetic vectors")
+    parser.add_argument("--n_queries", type=int, default=200,
+                        help="Number of queries")
+    parser.add_argument("--top_k", type=int, default=20,
+                        help="Top K results compared to exact search")
+    parser.add_argument("--n_probes", nargs="+", type=int, default=[4, 8, 16, 32, 64],
+                        help="Numbers of probed lists to benchmark")
+    parser.add_argument("--filter_ratio", type=float, default=1.0,
+                        help="Share of services allowed by a random filter mask")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    if args.vectors_file:
+        vectors = np.load(args.vectors_file).astype(np.float32)
+    else:
+        vectors = create_synthetic_vectors(args.n_vectors, args.dim, n_topics=1000, rng=rng)
+    queries = create_queries(vectors, args.n_queries, rng)
+
+    print(f"Benchmarking {len(vectors)} vectors of dimension {vectors.shape[1]} with {len(queries)} queries")
+    run_benchmark(vectors, queries, args.top_k, args.n_probes, args.filter_ratio, rng)
+
+
+if __name__ == "__main__":
+    main()
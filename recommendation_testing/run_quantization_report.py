@@ -0,0 +1,149 @@
+import os
+import sys
+import time
+import argparse
+import json
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'service_matcher_app'))
+from run_ann_index_benchmark import create_synthetic_vectors, create_queries
+from service_matcher.catalog import ServiceCatalog, FILTER_DIMENSIONS
+from service_rec_test_cases import test_cases
+
+
+def get_top_k_rows(scores: np.ndarray, top_k: int) -> np.ndarray:
+    return np.argsort(-np.nan_to_num(scores, nan=-np.inf), kind="stable")[:top_k]
+
+
+def create_catalog(vectors: np.ndarray, quantization: str, rescore_candidates: int) -> ServiceCatalog:
+    ids = np.array([f"service-{row}" for row in range(len(vectors))], dtype=object)
+    classifications = [{"id": service_id} for service_id in ids]
+    return ServiceCatalog.from_arrays(vectors.copy(), ids, classifications, filter_index={dimension: {} for dimension in FILTER_DIMENSIONS},
+                                      quantization=quantization, rescore_candidates=rescore_candidates)
+
+
+def run_offline_quantization_report(vectors: np.ndarray, queries: np.ndarray, quantizations: list, top_k: int, rescore_candidates: int) -> dict:
+    # Catalogs are scored directly like in recommendations, without running Service Match Engine
+    mask = np.ones(len(vectors), dtype=bool)
+    reference_catalog = create_catalog(vectors, "none", rescore_candidates)
+    start = time.perf_counter()
+    reference_results = [get_top_k_rows(reference_catalog.get_masked_scores(query, mask, top_k), top_k) for query in queries]
+    reference_latency = (time.perf_counter() - start) / len(queries)
+    report = {"none": {"latency_ms": reference_latency*1000, "vector_bytes": int(reference_catalog.vectors.nbytes)}}
+    print(f"none: latency {reference_latency*1000:.2f} ms, vectors {reference_catalog.vectors.nbytes / 2**20:.1f} MiB")
+
+    for quantization in quantizations:
+        catalog = create_catalog(vectors, quantization, rescore_candidates)
+        start = time.perf_counter()
+        results = [get_top_k_rows(catalog.get_masked_scores(query, mask, top_k), top_k) for query in queries]
+        latency = (time.perf_counter() - start) / len(queries)
+        overlaps = [len(set(result.tolist()) & set(reference_result.tolist())) / max(len(reference_result), 1)
+                    for result, reference_result in zip(results, reference_results)]
+        exact_order = np.mean([np.array_equal(result, reference_result) for result, reference_result in zip(results, reference_results)])
+        # Error of the quantized scores before rescoring
+        score_errors = [np.abs(catalog.get_scores(query) - reference_catalog.get_scores(query)).max() for query in queries]
+        report[quantization] = {
+            "latency_ms": latency*1000,
+            "vector_bytes": int(catalog.quantized_vectors.nbytes),
+            "mean_top_k_overlap": float(np.mean(overlaps)),
+            "min_top_k_overlap": float(np.min(overlaps)),
+            "same_top_k_order": float(exact_order),
+            "max_score_error": float(np.max(score_errors))
+        }
+        print(f"{quantization}: latency {latency*1000:.2f} ms, vectors {catalog.quantized_vectors.nbytes / 2**20:.1f} MiB, "
+              f"top_k overlap mean {np.mean(overlaps):.4f} min {np.min(overlaps):.4f}, same order {exact_order:.4f}, "
+              f"max score error before rescoring {np.max(score_errors):.4f}")
+    return report
+
+
+def get_overlap(reference_url: str, quantized_url: str, language: str, text_recommender: str, top_k: int) -> dict:
+    # Test scripts of running instances need their plotting requirements, the offline report doesn't
+    from run_recommender_testing import recommend_services
+    overlaps = {}
+    for test_case in test_cases:
+        text = test_cases.get(test_case).get('need_text').get(language)
+        reference_ids = [resp["service"]["id"] for resp in recommend_services(
+            text, text_recommender=text_recommender, language=language, top_k=top_k, url=reference_url)]
+        quantized_ids = [resp["service"]["id"] for resp in recommend_services(
+            text, text_recommender=text_recommender, language=language, top_k=top_k, url=quantized_url)]
+        overlaps[text] = len(set(reference_ids) & set(quantized_ids)) / max(len(reference_ids), 1)
+    return overlaps
+
+
+def run_quantization_report(reference_url: str, quantized_url: str, language: str, recommenders_to_test: list, top_k: int) -> dict:
+    from run_recommender_testing import run_recommendation_testing
+    reference_scores = run_recommendation_testing(
+        test_cases, language=language, recommenders_to_test=recommenders_to_test, top_k=top_k, print_scores=False, url=reference_url)
+    quantized_scores = run_recommendation_testing(
+        test_cases, language=language, recommenders_to_test=recommenders_to_test, top_k=top_k, print_scores=False, url=quantized_url)
+
+    report = {}
+    for text_recommender in recommenders_to_test:
+        overlaps = get_overlap(reference_url, quantized_url,
+                               language, text_recommender, top_k)
+        reference_total = sum(scores[text_recommender] for scores in reference_scores.values())
+        quantized_total = sum(scores[text_recommender] for scores in quantized_scores.values())
+        report[text_recommender] = {
+            "reference_test_score": reference_total / len(reference_scores),
+            "quantized_test_score": quantized_total / len(quantized_scores),
+            "mean_top_k_overlap": sum(overlaps.values()) / len(overlaps),
+            "min_top_k_overlap": min(overlaps.values()),
+            "top_k_overlaps": overlaps
+        }
+        print(f"{text_recommender}: test score {report[text_recommender]['reference_test_score']:.4f} -> {report[text_recommender]['quantized_test_score']:.4f}, "
+              f"top_k overlap mean {report[text_recommender]['mean_top_k_overlap']:.4f} min {report[text_recommender]['min_top_k_overlap']:.4f}")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--reference_url", type=str, default='http://localhost/services/recommend',
+                        help="Recommend endpoint of Service Match Engine using unquantized vectors")
+    parser.add_argument("--quantized_url", type=str, default='http://localhost:81/services/recommend',
+                        help="Recommend endpoint of Service Match Engine using quantized vectors")
+    parser.add_argument("--language", type=str, default='fi',
+                        choices=["fi", "en", "sv"],
+                        help="The language to test (fi, en, sv)")
+    parser.add_argument("--recommenders_to_test", nargs="+", default=[
+                        'all', 'nlp'], help="List of text recommenders to test (all, nlp)")
+    parser.add_argument("--top_k", type=int, default=15,
+                        help="Top K recommendations used for testing")
+    parser.add_argument("--save_report", action="store_true",
+                        help="Save report to json file")
+    parser.add_argument("--offline", action="store_true",
+                        help="Compare quantized and unquantized service catalogs directly instead of two running instances")
+    parser.add_argument("--vectors_file", type=str, default=None,
+                        help="Numpy .npy file of service description vectors for the offline report, synthetic vectors are used if not given")
+    parser.add_argument("--n_vectors", type=int, default=20000,
+                        help="Number of synthetic vectors for the offline report")
+    parser.add_argument("--dim", type=int, default=768,
+                        help="Dimension of synthetic vectors for the offline report")
+    parser.add_argument("--n_queries", type=int, default=200,
+                        help="Number of queries for the offline report")
+    parser.add_argument("--quantizations", nargs="+", default=["float16", "int8"],
+                        help="Quantizations compared to unquantized vectors in the offline report")
+    parser.add_argument("--rescore_candidates", type=int, default=200,
+                        help="Number of best quantized scores rescored with exact vectors in the offline report")
+    args = parser.parse_args()
+
+    if args.offline:
+        rng = np.random.default_rng(0)
+        if args.vectors_file:
+            vectors = np.load(args.vectors_file).astype(np.float32)
+        else:
+            vectors = create_synthetic_vectors(args.n_vectors, args.dim, n_topics=1000, rng=rng)
+        queries = create_queries(vectors, args.n_queries, rng)
+        print(f"Comparing {len(vectors)} vectors of dimension {vectors.shape[1]} with {len(queries)} queries")
+        report = run_offline_quantization_report(vectors, queries, args.quantizations, args.top_k, args.rescore_candidates)
+        report_file = 'offline_quantization_report.json'
+    else:
+        report = run_quantization_report(
+            args.reference_url, args.quantized_url, args.language, args.recommenders_to_test, args.top_k)
+        report_file = f'{args.language}_quantization_report.json'
+
+    if args.save_report:
+        with open(report_file, 'w', encoding='utf-8') as outfile:
+            json.dump(report, outfile, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
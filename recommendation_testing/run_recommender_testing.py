@@ -6,11 +6,11 @@ from sklearn.metrics import auc
 from service_rec_test_cases import test_cases
 
 
-def recommend_services(text: str, text_recommender: str, language: str, top_k: int):
+def recommend_services(text: str, text_recommender: str, language: str, top_k: int, url: str = 'http://localhost/services/recommend'):
     body = {'need_text': text, 'top_k': top_k,   "municipalities": [], "life_events": [], "service_classes": [], "score_threshold": 0.0,
             "text_recommender": text_recommender, 'language': language}
     r = requests.post(
-        'http://localhost/services/recommend', json=body)
+        url, json=body)
 
     services = r.json()
     return(services)
@@ -29,13 +29,13 @@ def get_matched_services(response: list, test_cases: dict) -> list:
     return matched_services
 
 
-def run_recommendation_testing(test_cases: dict, language: str, recommenders_to_test: list = ['all', 'nlp', 'lexical'], top_k: int = 15, print_scores: bool = True, plot_images: bool = False) -> dict:
+def run_recommendation_testing(test_cases: dict, language: str, recommenders_to_test: list = ['all', 'nlp', 'lexical'], top_k: int = 15, print_scores: bool = True, plot_images: bool = False, url: str = 'http://localhost/services/recommend') -> dict:
     test_scores = {}
     for test_case in test_cases:
         matches = {}
         for text_recommender in recommenders_to_test:
             response = recommend_services(
-                test_cases.get(test_case).get('need_text').get(language), text_recommender=text_recommender, language=language, top_k=top_k)
+                test_cases.get(test_case).get('need_text').get(language), text_recommender=text_recommender, language=language, top_k=top_k, url=url)
             response = [{"name": resp["service"]["name"]["fi"], "score": resp["score"],
                         "id": resp["service"]["id"]} for resp in response]
 
@@ -0,0 +1,102 @@
+import os
+import sys
+import copy
+import json
+import time
+import random
+import argparse
+from unittest.mock import MagicMock
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'service_matcher_app'))
+from service_matcher.db import ServiceMatcherDB
+
+TEST_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test')
+
+
+def create_synthetic_data(n_services: int, channels_per_service: int, rng: random.Random) -> tuple:
+    # Services and channels are copies of the test examples with new ids, channels are linked to 1-3 random services
+    with open(os.path.join(TEST_DATA_DIR, 'example_service_data.json')) as json_file:
+        service_template = json.load(json_file)[0]
+    with open(os.path.join(TEST_DATA_DIR, 'example_service_channel_data.json')) as json_file:
+        channel_template = json.load(json_file)[0]
+    services = []
+    for idx in range(n_services):
+        service = copy.deepcopy(service_template)
+        service["id"] = f"service-{idx}"
+        services.append(service)
+    channels = []
+    for idx in range(n_services * channels_per_service):
+        channel = copy.deepcopy(channel_template)
+        channel["id"] = f"channel-{idx}"
+        channel["serviceIds"] = [f"service-{rng.randrange(n_services)}" for _ in range(rng.randint(1, 3))]
+        channels.append(channel)
+    return services, channels
+
+
+def create_db(services: list, channels: list) -> ServiceMatcherDB:
+    # The collections return every document, which is what the full catalog queries return
+    mongo_client = MagicMock()
+    mongo_client.service_db.services.find.return_value = services
+    mongo_client.service_db.channels.find.return_value = channels
+    mongo_client.service_db.service_vectors.find.return_value = []
+    mongo_client.service_db.service_class_vectors.find.return_value = []
+    mongo_client.service_db.translations.find.return_value = []
+    return ServiceMatcherDB(mongo_client)
+
+
+def assemble_with_nested_scan(services: list, channels: list) -> list:
+    # Assembly before the channel index, every service scans every channel and the result list is copied for each service
+    res = []
+    for service in services:
+        ser_channels = [cha for cha in channels if cha.serviceIds is not None and (service.id in cha.serviceIds)]
+        res = res + [{'service': service, 'channels': ser_channels}]
+    return res
+
+
+def assemble_with_channel_index(db: ServiceMatcherDB, services: list, channels: list) -> list:
+    # Channels are grouped by service in one pass, which the service cache does once per sync
+    service_channels = db._group_channels_by_service(channels)
+    return [{'service': service, 'channels': list(service_channels.get(service.id, []))} for service in services]
+
+
+def run_benchmark(sizes: list, channels_per_service: int, repeats: int, nested_scan_max_services: int) -> dict:
+    rng = random.Random(0)
+    results = {}
+    for n_services in sizes:
+        services, channels = create_synthetic_data(n_services, channels_per_service, rng)
+        db = create_db(services, channels)
+        service_models = list(db.services_by_id.values())
+        channel_models = list(db.channels_by_id.values())
+        assemblies = [("channel_index", lambda: assemble_with_channel_index(db, service_models, channel_models)),
+                      ("all_services", lambda: db._get_all_services(include_channels=True))]
+        if n_services <= nested_scan_max_services:
+            # Both assemblies list the same channels in the same order for every service
+            assert assemble_with_nested_scan(service_models, channel_models) == assemble_with_channel_index(db, service_models, channel_models)
+            assemblies.insert(0, ("nested_scan", lambda: assemble_with_nested_scan(service_models, channel_models)))
+        timings = {}
+        for name, assemble in assemblies:
+            start = time.perf_counter()
+            for _ in range(repeats):
+                assemble()
+            timings[name] = (time.perf_counter() - start) / repeats
+        results[n_services] = timings
+        print(f"{n_services} services: " + ", ".join(
+            f"{name} {timing*1000:.1f} ms ({timing/n_services*1e6:.1f} us/service)" for name, timing in timings.items()))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", nargs="+", type=int, default=[1000, 2000, 4000, 8000],
+                        help="Numbers of services to benchmark, time per service of the channel index should stay flat as the size grows")
+    parser.add_argument("--channels_per_service", type=int, default=2,
+                        help="Number of synthetic channels per service")
+    parser.add_argument("--repeats", type=int, default=3,
+                        help="Number of timed repeats per size")
+    parser.add_argument("--nested_scan_max_services", type=int, default=4000,
+                        help="Largest number of services the quadratic nested scan is benchmarked with")
+    args = parser.parse_args()
+    run_benchmark(args.sizes, args.channels_per_service, args.repeats, args.nested_scan_max_services)
+
+
+if __name__ == "__main__":
+    main()
@@ -127,6 +127,9 @@ class ServiceDataProcessor():
         if len(current_ids) > 0:
             self._remove_old_classifications(removed_ids)
             self._remove_old_service_desc_vectors(removed_ids)
+
+        # Every service matcher and lexical text search replica polls the generation, the calls below reach only one of them
+        self._write_catalog_generation()
         
         # Sync vectors to service matcher microservice
         r = requests.get(os.environ["SERVICE_MATCHER_HOST"]+"/syncVectors")
@@ -178,6 +181,7 @@ class ServiceDataProcessor():
                     service_class_vectors[index].pop("description", None)
 
             self._write_service_class_vectors(service_class_vectors)
+            self._write_catalog_generation()
 
         msg = f"{len(service_class_vectors)} new service classes processed"
         print(msg)
@@ -291,6 +295,10 @@ class ServiceDataProcessor():
         self.mongo_client.service_db.service_class_vectors.insert_many(
             service_class_vectors)
         
+    def _write_catalog_generation(self) -> None:
+        self.mongo_client.service_db.catalog_generation.update_one(
+            {"_id": "catalog"}, {"$inc": {"generation": 1}, "$set": {"lastUpdated": datetime.utcnow()}}, upsert=True)
+
     def _get_current_classification_ids(self) -> None:
         classifications = list(self.mongo_client.service_db.classifications.find({}))
         ids = [classification["id"] for classification in classifications]
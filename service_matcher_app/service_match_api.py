@@ -49,6 +49,9 @@ class ServiceMatchAPI():
     
     get_service_recommendations( serviceRecommendQuery: ServiceRecommendQuery )
         Get service recommendations based on free text
+
+    get_service_recommendations_batch( serviceRecommendQueries: List[ServiceRecommendQuery] )
+        Get service recommendations for many free texts at once
     
     get_service_class_recommendations_by_conversation( conversation_id: str, serviceClassRecommendConversationQuery: ServiceClassRecommendConversationQuery )
         Get service class recommendations based on conversation
@@ -56,6 +59,9 @@ class ServiceMatchAPI():
     get_service_class_recommendations( serviceClassRecommendQuery: ServiceClassRecommendQuery )
         Get service class recommendations based on free text
 
+    get_cache_stats()
+        Get statistics of the in-memory caches
+
     """
 
     def __init__(self, service_matcher: Optional[ServiceMatcher] = None) -> None:
@@ -71,6 +77,10 @@ class ServiceMatchAPI():
         else:
             self.service_matcher = service_matcher
 
+        def json_response(content) -> Response:
+            # Services and channels are spliced into the response as pre-encoded JSON
+            return Response(content=self.service_matcher.encode_response(content), media_type="application/json")
+
         @self.app.get("/",
                       tags=["Health"],
                       summary="Health check",
@@ -82,18 +92,35 @@ class ServiceMatchAPI():
         @self.app.get("/syncVectors",
                       tags=["Synchronize"],
                       summary="Synchronize service matcher vectors",
-                      description="An endpoint for processor to synchronize vectors in memory",
+                      description="An endpoint for processor to synchronize vectors in memory, changes are read and taken into use in the background",
                       status_code=200)
         def sync_desc_vectors() -> None:
-            self.service_matcher.update_desc_vectors()
+            self.service_matcher.update_desc_vectors_in_background()
+            return Response(status_code=200)
+
+        @self.app.get("/syncIntents",
+                      tags=["Synchronize"],
+                      summary="Synchronize intent to services mappings",
+                      description="An endpoint to notify service matcher that intent to services mappings have changed in the database",
+                      status_code=200)
+        def sync_intents() -> None:
+            self.service_matcher.update_intents()
             return Response(status_code=200)
 
+        @self.app.get("/cacheStats",
+                      tags=["Health"],
+                      summary="Get cache statistics",
+                      description="Hit ratio, evictions and estimated memory of the in-memory response and query vector caches",
+                      status_code=200)
+        def get_cache_stats() -> dict:
+            return self.service_matcher.get_cache_stats()
+
         @self.app.get("/services",
                       tags=["Data"],
                       summary="Get all services",
                       description="Get all services and all info related to them from the database, optionally translate missing texts of service names and descriptions")
         def get_all_services(translate_missing_texts: bool = False) -> list:
-            return self.service_matcher.get_all_services(translate_missing_texts = translate_missing_texts)
+            return json_response(self.service_matcher.get_all_services(translate_missing_texts = translate_missing_texts))
         
         @self.app.post("/servicesFiltered",
                       tags=["Data"],
@@ -110,7 +137,7 @@ class ServiceMatchAPI():
             - **priorization**: With class search prioritize national or local, default local
             - **translate_missing_texts**: Show machine translations of services' English and Swedish texts if actual translations are missing', default False
             """
-            return self.service_matcher.get_all_services_filtered(serviceQuery)
+            return json_response(self.service_matcher.get_all_services_filtered(serviceQuery))
 
         @self.app.get("/services/{service_id}",
                       tags=["Data"],
@@ -122,7 +149,7 @@ class ServiceMatchAPI():
                 raise HTTPException(
                     status_code=404, detail="Service not found")
             else:
-                return service
+                return json_response(service)
 
         @self.app.get("/serviceChannels",
                       tags=["Data"],
@@ -169,7 +196,7 @@ class ServiceMatchAPI():
             - **language**: The language of the free text search text
             - **translate_missing_texts**: Show machine translations of services' English and Swedish texts if actual translations are missing', default False
             """
-            return self.service_matcher.get_service_recommendations_by_conversation(conversation_id, serviceRecommendConversationQuery)
+            return json_response(self.service_matcher.get_service_recommendations_by_conversation(conversation_id, serviceRecommendConversationQuery))
 
         @self.app.post("/services/recommendByIntent", tags=["Service recommendations"],
                       summary="Get service recommendations by intent name")
@@ -183,7 +210,7 @@ class ServiceMatchAPI():
             - **service_classes**: Limit to service class codes given in a list
             - **translate_missing_texts**: Show machine translations of services' English and Swedish texts if actual translations are missing', default False
             """
-            return self.service_matcher.get_service_recommendations_by_intent(serviceRecommendIntentQuery)
+            return json_response(self.service_matcher.get_service_recommendations_by_intent(serviceRecommendIntentQuery))
 
         @self.app.post("/services/recommendByIntentAndOptions", tags=["Service recommendations"],
                       summary="Get service recommendations by intent name and options defined to the intent in the database")
@@ -203,7 +230,7 @@ class ServiceMatchAPI():
             - **priorization**: With class search prioritize national or local, default local
             - **translate_missing_texts**: Show machine translations of services' English and Swedish texts if actual translations are missing', default False
             """
-            return self.service_matcher.get_service_recommendations_by_intent_and_options(serviceRecommendIntentAndOptionsQuery)
+            return json_response(self.service_matcher.get_service_recommendations_by_intent_and_options(serviceRecommendIntentAndOptionsQuery))
 
         @self.app.post("/services/recommend", tags=["Service recommendations"],
                       summary="Get service recommendations by conversation by text query")
@@ -221,7 +248,18 @@ class ServiceMatchAPI():
             - **language**: The language of the need text
             - **translate_missing_texts**: Show machine translations of services' English and Swedish texts if actual translations are missing', default False
             """
-            return self.service_matcher.get_service_recommendations(serviceRecommendQuery)
+            return json_response(self.service_matcher.get_service_recommendations(serviceRecommendQuery))
+
+        @self.app.post("/services/recommendBatch", tags=["Service recommendations"],
+                      summary="Get service recommendations for many text queries at once")
+        def get_service_recommendations_batch(serviceRecommendQueries: List[ServiceRecommendQuery]) -> list:
+            """
+            A list of ServiceRecommendQuery objects, see /services/recommend for their fields.
+
+            Returns a list of service recommendations for each query in the same order as the queries.
+            The queries are vectorized and scored together, so this is much faster than many single queries for offline workloads.
+            """
+            return json_response(self.service_matcher.get_service_recommendations_batch(serviceRecommendQueries))
 
         @self.app.post("/serviceClasses/recommendByConversation/{conversation_id}", tags=["Service class recommendations"],
                       summary="Get service class recommendations by conversation")
@@ -0,0 +1,126 @@
+import os
+import logging
+import tempfile
+import zipfile
+import numpy as np
+from typing import Optional, Tuple
+
+
+class IVFFlatIndex():
+    """
+    An inverted file index for approximate nearest neighbour search of normalized vectors
+
+    Vectors are clustered with spherical k-means and every vector is listed under its closest centroid.
+    A query is scored exactly only against the vectors listed under its n_probe closest centroids.
+    The index keeps row numbers only, vectors are read from the matrix given to it.
+
+    Args
+    ----------
+    vectors : np.ndarray
+        Matrix of L2-normalized vectors, one vector per row
+    n_lists : int (default None)
+        Number of clusters, square root of the number of vectors if None
+    n_probe : int (default 16)
+        Number of closest clusters searched for a query
+    n_iter : int (default 10)
+        Number of k-means iterations
+    seed : int (default 0)
+        Seed for sampling the initial centroids
+
+
+    Methods
+    -------
+    search(vector: np.ndarray, mask: np.ndarray = None)
+        Returns rows and scores of the vectors in the closest clusters that are allowed by the mask
+
+    save(path: str, fingerprint: str)
+        Saves the index to a file
+
+    load(path: str, vectors: np.ndarray, fingerprint: str, n_probe: int)
+        Returns the index saved to a file if it was built from the same vectors, otherwise None
+
+    """
+
+    def __init__(self, vectors: np.ndarray, n_lists: Optional[int] = None, n_probe: int = 16, n_iter: int = 10, seed: int = 0, build: bool = True) -> None:
+        self.vectors = vectors
+        self.n_probe = n_probe
+        if not build:
+            return
+        if n_lists is None:
+            n_lists = int(np.sqrt(len(vectors)))
+        n_lists = max(1, min(n_lists, len(vectors)))
+        self.centroids = self._train_centroids(n_lists, n_iter, seed)
+        self._create_lists(self._assign(vectors))
+
+    def __len__(self) -> int:
+        return len(self.list_rows)
+
+    def _assign(self, vectors: np.ndarray, batch_size: int = 8192) -> np.ndarray:
+        assignments = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), batch_size):
+            assignments[start:start+batch_size] = np.argmax(
+                vectors[start:start+batch_size].dot(self.centroids.T), axis=1)
+        return assignments
+
+    def _train_centroids(self, n_lists: int, n_iter: int, seed: int) -> np.ndarray:
+        rng = np.random.default_rng(seed)
+        # Centroids are trained on a sample, clusters don't get more accurate with more than a few hundred vectors each
+        sample_size = min(len(self.vectors), 256 * n_lists)
+        sample = self.vectors[np.sort(rng.choice(len(self.vectors), sample_size, replace=False))]
+        self.centroids = sample[rng.choice(sample_size, n_lists, replace=False)].copy()
+        for _ in range(n_iter):
+            assignments = self._assign(sample)
+            sums = np.zeros_like(self.centroids)
+            np.add.at(sums, assignments, sample)
+            counts = np.bincount(assignments, minlength=n_lists)
+            # Empty clusters are reseeded with random sample vectors
+            empty = counts == 0
+            sums[empty] = sample[rng.choice(sample_size, int(empty.sum()))]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            self.centroids = (sums / np.where(norms > 0, norms, 1)).astype(self.vectors.dtype)
+        return self.centroids
+
+    def _create_lists(self, assignments: np.ndarray) -> None:
+        self.list_rows = np.argsort(assignments, kind="stable")
+        self.list_offsets = np.concatenate(
+            ([0], np.cumsum(np.bincount(assignments, minlength=len(self.centroids)))))
+
+    def search(self, vector: np.ndarray, mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        centroid_scores = self.centroids.dot(vector)
+        n_probe = min(self.n_probe, len(self.centroids))
+        probed_lists = np.argpartition(-centroid_scores, n_probe - 1)[:n_probe]
+        rows = np.concatenate([self.list_rows[self.list_offsets[list_id]:self.list_offsets[list_id+1]]
+                               for list_id in probed_lists])
+        if mask is not None:
+            rows = rows[mask[rows]]
+        return rows, self.vectors[rows].dot(vector)
+
+    def save(self, path: str, fingerprint: str) -> None:
+        # Write to a temporary file of its own first so that other processes never load a partially written index
+        tmp_fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=".tmp-", suffix=".npz")
+        try:
+            with os.fdopen(tmp_fd, "wb") as tmp_file:
+                np.savez(tmp_file, centroids=self.centroids, list_rows=self.list_rows,
+                         list_offsets=self.list_offsets, fingerprint=np.array(fingerprint))
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path: str, vectors: np.ndarray, fingerprint: str, n_probe: int = 16) -> Optional["IVFFlatIndex"]:
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as saved_index:
+                if str(saved_index["fingerprint"]) != fingerprint:
+                    return None
+                index = cls(vectors, n_probe=n_probe, build=False)
+                index.centroids = saved_index["centroids"].astype(vectors.dtype)
+                index.list_rows = saved_index["list_rows"]
+                index.list_offsets = saved_index["list_offsets"]
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile) as e:
+            logging.error(f"Could not load ANN index from {path}: {e}")
+            return None
+        return index
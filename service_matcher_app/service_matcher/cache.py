@@ -0,0 +1,88 @@
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Optional
+
+
+class LRUCache():
+    """
+    A thread-safe least recently used cache with a size bound and time to live for the entries
+
+    Args
+    ----------
+    max_size : int
+        Maximum number of entries, least recently used entries are evicted first
+    ttl : float (default None)
+        Time to live of an entry in seconds, entries never expire if None
+
+
+    Methods
+    -------
+    get(key: Any)
+        Returns cached value of the key or None if it is missing or expired
+
+    set(key: Any, value: Any)
+        Adds value to the cache
+
+    clear()
+        Removes all entries from the cache
+
+    values()
+        Returns a snapshot list of cached values
+
+    get_stats()
+        Returns hit, miss and eviction counters of the cache
+
+    """
+
+    def __init__(self, max_size: int, ttl: Optional[float] = None) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Any) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[1] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key: Any, value: Any) -> None:
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def values(self) -> list:
+        with self._lock:
+            return [entry[0] for entry in self._entries.values()]
+
+    def get_stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {"size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / requests if requests > 0 else 0.0,
+                "evictions": self.evictions}
@@ -0,0 +1,256 @@
+import hashlib
+import tempfile
+import numpy as np
+from typing import Optional
+
+FILTER_DIMENSIONS = ["service_class_codes", "municipality_codes", "life_event_codes"]
+QUANTIZATIONS = ["none", "float16", "int8"]
+
+
+class ServiceCatalog():
+    """
+    A class for in-memory service description vectors of service matcher
+
+    Vectors are stored in one preallocated contiguous float32 matrix whose rows are aligned
+    with the service id array, so scoring a query is a single matrix-vector product.
+    Vectors come from NLP Vectorizer already L2-normalized, so they are stored as they are.
+    Classification codes are kept as an inverted index of one boolean row mask per code.
+    An approximate nearest neighbour index can be attached for large catalogs.
+    Generation of the catalog is set when it's published, caches key their entries on it.
+
+    With quantization, queries are first scored against a float16 or int8 (scaled per vector) copy of the matrix,
+    and the best candidates are then rescored with the exact float32 vectors which are kept in a file backed memory map.
+
+    Args
+    ----------
+    service_vectors : list
+        Service description vector documents from the database
+    quantization : str (default "none")
+        Quantization of the in-memory vectors, one of none, float16 and int8
+    rescore_candidates : int (default 200)
+        Number of best quantized scores rescored with exact vectors
+    vector_dir : str (default None)
+        Directory of the exact vector file when quantization is used, system temporary directory if None
+
+
+    Methods
+    -------
+    get_scores(vector: list)
+        Returns dot product scores of the query vector against every service row
+
+    get_masked_scores(vector: list, mask: np.ndarray, top_k: int = 0, exact_search_max_candidates: int = 10000)
+        Returns scores of the services allowed by the mask, NaN for others
+
+    get_masked_scores_batch(vectors: np.ndarray, masks: np.ndarray)
+        Returns scores of many queries with one matrix product, NaN for services not allowed by the mask of the query
+
+    get_code_mask(dimension: str, codes: list)
+        Returns row mask of services having any of the codes in the given classification dimension
+
+    get_fingerprint()
+        Returns a hash of the service ids and vectors
+
+    with_changes(changed_service_vectors: list, current_ids: set, vector_dir: str = None)
+        Returns a new catalog with changed service vectors replaced or added and services missing from current ids removed
+
+    """
+
+    def __init__(self, service_vectors: list, quantization: str = "none", rescore_candidates: int = 200, vector_dir: Optional[str] = None) -> None:
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"Unknown quantization {quantization}, expected one of {QUANTIZATIONS}")
+        vector_dim = next((len(ser["vector"]) for ser in service_vectors if ser.get("vector") is not None), 0)
+        self.vectors = np.zeros((len(service_vectors), vector_dim), dtype=np.float32)
+        for row, service in enumerate(service_vectors):
+            # Services whose vectorization failed in the processor are kept as zero rows
+            if service.get("vector") is not None:
+                self.vectors[row] = service["vector"]
+        self.ids = np.array([service.get("id") for service in service_vectors], dtype=object)
+        self.row_index = {service_id: row for row, service_id in enumerate(self.ids)}
+        self.classifications = [{i: ser[i] for i in ser if i != 'vector'} for ser in service_vectors]
+        self.filter_index = self._create_filter_index()
+        self.ann_index = None
+        self.generation = 0
+        self.quantization = quantization
+        self.rescore_candidates = rescore_candidates
+        self.quantized_vectors = None
+        self.quantization_scales = None
+        if quantization != "none" and len(self.vectors) > 0:
+            self._quantize_vectors(vector_dir)
+
+    @classmethod
+    def from_arrays(cls, vectors: np.ndarray, ids: np.ndarray, classifications: list, filter_index: Optional[dict] = None, quantization: str = "none",
+                    rescore_candidates: int = 200, quantized_vectors: Optional[np.ndarray] = None, quantization_scales: Optional[np.ndarray] = None,
+                    vector_dir: Optional[str] = None) -> "ServiceCatalog":
+        # Creates a catalog of prebuilt arrays, which can be read-only memory maps of a snapshot
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"Unknown quantization {quantization}, expected one of {QUANTIZATIONS}")
+        catalog = cls.__new__(cls)
+        catalog.vectors = vectors
+        catalog.ids = ids
+        catalog.row_index = {service_id: row for row, service_id in enumerate(ids)}
+        catalog.classifications = classifications
+        catalog.filter_index = filter_index if filter_index is not None else catalog._create_filter_index()
+        catalog.ann_index = None
+        catalog.generation = 0
+        catalog.quantization = quantization
+        catalog.rescore_candidates = rescore_candidates
+        catalog.quantized_vectors = quantized_vectors
+        catalog.quantization_scales = quantization_scales
+        if quantization != "none" and quantized_vectors is None and len(vectors) > 0:
+            catalog._quantize_vectors(vector_dir)
+        return catalog
+
+    def with_changes(self, changed_service_vectors: list, current_ids: set, vector_dir: Optional[str] = None) -> "ServiceCatalog":
+        # The catalog itself isn't modified, requests keep using it until the new one replaces it
+        changes = ServiceCatalog(changed_service_vectors)
+        if len(self) > 0 and len(changes) > 0 and changes.vectors.shape[1] != self.vectors.shape[1]:
+            raise ValueError(f"Changed vectors have dimension {changes.vectors.shape[1]} instead of {self.vectors.shape[1]}")
+        changed_ids = set(changes.row_index)
+        kept_rows = [row for row, service_id in enumerate(self.ids) if service_id in current_ids and service_id not in changed_ids]
+        vector_dim = self.vectors.shape[1] if len(self) > 0 else changes.vectors.shape[1]
+        vectors = np.concatenate([np.asarray(self.vectors[kept_rows], dtype=np.float32).reshape(-1, vector_dim),
+                                  changes.vectors.reshape(-1, vector_dim)])
+        ids = np.concatenate([self.ids[kept_rows], changes.ids]).astype(object)
+        classifications = [self.classifications[row] for row in kept_rows] + changes.classifications
+        return ServiceCatalog.from_arrays(vectors, ids, classifications, quantization=self.quantization,
+                                          rescore_candidates=self.rescore_candidates, vector_dir=vector_dir)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def get_fingerprint(self) -> str:
+        fingerprint = hashlib.sha1('\n'.join(map(str, self.ids)).encode())
+        fingerprint.update(self.vectors.tobytes())
+        return fingerprint.hexdigest()
+
+    def _quantize_vectors(self, vector_dir: Optional[str]) -> None:
+        if self.quantization == "float16":
+            self.quantized_vectors = self.vectors.astype(np.float16)
+        else:
+            max_values = np.abs(self.vectors).max(axis=1)
+            self.quantization_scales = np.where(max_values > 0, max_values / 127, 1).astype(np.float32)
+            self.quantized_vectors = np.round(self.vectors / self.quantization_scales[:, None]).astype(np.int8)
+        # Exact vectors are needed only for rescoring a few rows so they are paged in from a file when used
+        if isinstance(self.vectors, np.memmap):
+            return
+        vector_file = tempfile.TemporaryFile(dir=vector_dir)
+        self.vectors.tofile(vector_file)
+        vector_file.flush()
+        self.vectors = np.memmap(vector_file, dtype=np.float32, mode='r', shape=self.vectors.shape)
+
+    def _get_quantized_scores(self, vector: np.ndarray, batch_size: int = 256) -> np.ndarray:
+        # numpy has no BLAS kernels for float16 and int8 so the matrix is converted in small batches
+        # into a float32 buffer that stays in CPU cache
+        # vector can also be a matrix of query vectors as columns, which gives a matrix of scores
+        scores = np.empty((len(self.ids),) + vector.shape[1:], dtype=np.float32)
+        batch = np.empty((batch_size, self.quantized_vectors.shape[1]), dtype=np.float32)
+        for start in range(0, len(self.ids), batch_size):
+            quantized_batch = self.quantized_vectors[start:start+batch_size]
+            batch_view = batch[:len(quantized_batch)]
+            batch_view[...] = quantized_batch
+            scores[start:start+batch_size] = batch_view.dot(vector)
+        if self.quantization_scales is not None:
+            scores *= self.quantization_scales.reshape((-1,) + (1,) * (vector.ndim - 1))
+        return scores
+
+    def get_scores(self, vector: list) -> np.ndarray:
+        if len(self.ids) == 0:
+            return np.zeros(0, dtype=np.float32)
+        # get cosine similarity between query vector and service vectors
+        if self.quantized_vectors is not None:
+            return self._get_quantized_scores(np.asarray(vector, dtype=np.float32))
+        return self.vectors.dot(np.asarray(vector, dtype=np.float32))
+
+    def _rescore(self, scores: np.ndarray, vector: list) -> np.ndarray:
+        candidates = np.flatnonzero(~np.isnan(scores))
+        if len(candidates) > self.rescore_candidates:
+            candidates = candidates[np.argpartition(-scores[candidates], self.rescore_candidates - 1)[:self.rescore_candidates]]
+        candidates.sort()
+        scores[candidates] = self.vectors[candidates].dot(np.asarray(vector, dtype=np.float32))
+        return scores
+
+    def get_masked_scores(self, vector: list, mask: np.ndarray, top_k: int = 0, exact_search_max_candidates: int = 10000) -> np.ndarray:
+        scores = np.full(len(self.ids), np.nan)
+        # Only top k results are searched approximately, exact search is cheap enough for selective filters
+        if self.ann_index is not None and top_k > 0 and np.count_nonzero(mask) > exact_search_max_candidates:
+            rows, ann_scores = self.ann_index.search(np.asarray(vector, dtype=np.float32), mask)
+            if len(rows) >= top_k:
+                scores[rows] = ann_scores
+                return scores
+        scores[mask] = self.get_scores(vector)[mask]
+        if self.quantized_vectors is not None:
+            scores = self._rescore(scores, vector)
+        return scores
+
+    def get_masked_scores_batch(self, vectors: np.ndarray, masks: np.ndarray) -> np.ndarray:
+        # All queries are scored with one matrix product, row i of the result has scores of query i
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(self.ids) == 0:
+            return np.zeros((len(vectors), 0))
+        if self.quantized_vectors is not None:
+            scores = self._get_quantized_scores(vectors.T)
+        else:
+            scores = self.vectors.dot(vectors.T)
+        scores = np.where(masks, scores.T.astype(np.float64), np.nan)
+        if self.quantized_vectors is not None:
+            for query_scores, vector in zip(scores, vectors):
+                self._rescore(query_scores, vector)
+        return scores
+
+    def get_code_mask(self, dimension: str, codes: list) -> np.ndarray:
+        mask = np.zeros(len(self.ids), dtype=bool)
+        for code in set(codes):
+            code_mask = self.filter_index[dimension].get(code)
+            if code_mask is not None:
+                mask |= code_mask
+        return mask
+
+    def _create_filter_index(self) -> dict:
+        filter_rows = {dimension: {} for dimension in FILTER_DIMENSIONS}
+        for row, classification in enumerate(self.classifications):
+            for dimension in FILTER_DIMENSIONS:
+                for code in classification.get(dimension) or []:
+                    filter_rows[dimension].setdefault(code, []).append(row)
+        filter_index = {dimension: {} for dimension in FILTER_DIMENSIONS}
+        for dimension in FILTER_DIMENSIONS:
+            for code, rows in filter_rows[dimension].items():
+                code_mask = np.zeros(len(self.ids), dtype=bool)
+                code_mask[rows] = True
+                filter_index[dimension][code] = code_mask
+        return filter_index
+
+
+class ServiceClassCatalog():
+    """
+    A class for in-memory service class vectors of service matcher
+
+    Vectors are stored in one contiguous float32 matrix whose rows are aligned with the code and name lists.
+
+    Args
+    ----------
+    service_class_vectors : list
+        Service class vector documents from the database
+
+
+    Methods
+    -------
+    get_scores(vector: list)
+        Returns dot product scores of the query vector against every service class row
+
+    """
+
+    def __init__(self, service_class_vectors: list) -> None:
+        self.service_class_vectors = service_class_vectors
+        vector_dim = next((len(sc["vector"]) for sc in service_class_vectors), 0)
+        self.vectors = np.array([sc["vector"] for sc in service_class_vectors], dtype=np.float32).reshape(
+            len(service_class_vectors), vector_dim)
+        self.codes = [sc["code"] for sc in service_class_vectors]
+        self.names = [sc["name"] for sc in service_class_vectors]
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def get_scores(self, vector: list) -> np.ndarray:
+        if len(self.codes) == 0:
+            return np.zeros(0, dtype=np.float32)
+        return self.vectors.dot(np.asarray(vector, dtype=np.float32))
@@ -0,0 +1,164 @@
+import numpy as np
+from .cache import LRUCache
+from .utils import ServiceMatcherUtils, SERVICE_SEARCH_REGEX, FORM_REGEX
+from .policy import get_confidence_matrix
+
+
+class ConversationState():
+    """
+    A class for parsed events of a conversation up to a processed event
+
+    The state is never modified after it has been cached, it is copied before new events are added to it.
+    Only the open form event can still receive events, so it is the only event copied.
+
+    Args
+    ----------
+    policy_filters : dict
+        Disambiguation and fallback filters the events have been relabeled with
+
+
+    Methods
+    -------
+    copy()
+        Returns a copy of the state which new events can be added to
+
+    """
+
+    def __init__(self, policy_filters: dict) -> None:
+        self.policy_filters = policy_filters
+        self.n_events = 0
+        self.last_event_key = None
+        self.pending_event = None
+        self.form_on = False
+        self.open_intent_event = False
+        self.intent_events = []
+        self.intents = []
+
+    def copy(self) -> "ConversationState":
+        state = ConversationState(self.policy_filters)
+        state.n_events = self.n_events
+        state.last_event_key = self.last_event_key
+        state.pending_event = self.pending_event
+        state.form_on = self.form_on
+        state.open_intent_event = self.open_intent_event
+        state.intent_events = list(self.intent_events)
+        state.intents = list(self.intents)
+        if state.form_on and state.open_intent_event:
+            state.intent_events[-1] = dict(state.intent_events[-1], form_events=list(state.intent_events[-1]['form_events']))
+        return state
+
+
+class ConversationParser():
+    """
+    A class for parsing intent events of Botfront conversation trackers in a single pass
+
+    Events are relabeled with disambiguation and fallback, rejected actions are moved before the event preceding
+    them, form events are nested under the event starting the form and intent events are picked in one pass.
+    Parsed state is cached per conversation and only events added after the previous parse are processed. The
+    state keeps the number of processed events and the timestamp, type, name and intent of the last one, which
+    tells whether a tracker continues the same events. The last event is held back until the next one is seen,
+    since a rejection following it swaps their order.
+
+    Args
+    ----------
+    utils : ServiceMatcherUtils
+        Utilities for recognizing service classes and life events from intent names
+    max_size : int (default 10000)
+        Maximum number of cached conversation states
+    ttl : float (default 3600)
+        Seconds a conversation state is cached
+
+
+    Methods
+    -------
+    parse(conversation_id: str, events: list, policy_filters: dict)
+        Returns intent events with nested form events and names of their intents
+
+    """
+
+    def __init__(self, utils: ServiceMatcherUtils, max_size: int = 10000, ttl: float = 3600) -> None:
+        self.utils = utils
+        self.states = LRUCache(max_size=max_size, ttl=ttl)
+
+    def _get_event_key(self, event: dict) -> tuple:
+        return (event.get('timestamp'), event.get('event'), event.get('name'), event.get('parse_data', {}).get('intent', {}).get('name'))
+
+    def _get_state(self, conversation_id: str, events: list, policy_filters: dict) -> ConversationState:
+        state = self.states.get(conversation_id)
+        # Trackers only grow, so the same timestamped event at the processed length means the tracker continues the cached events
+        if (state is not None and state.policy_filters == policy_filters and len(events) >= state.n_events and
+                state.last_event_key[0] is not None and
+                self._get_event_key(events[state.n_events - 1]) == state.last_event_key):
+            return state.copy()
+        return ConversationState(policy_filters)
+
+    def _relabel_events(self, events: list, policy_filters: dict) -> list:
+        # Intent is replaced if the bot is inferring disambiguation or fallback, policy filters are evaluated for all rankings at once
+        ranked_rows = [row for row, event in enumerate(events) if 'parse_data' in event and 'intent_ranking' in event['parse_data']]
+        if len(ranked_rows) == 0:
+            return events
+        rankings = [[el['confidence'] for el in events[row]['parse_data']['intent_ranking']] for row in ranked_rows]
+        confidences = get_confidence_matrix(rankings)
+        ranking_lengths = np.array([len(ranking) for ranking in rankings])
+        is_disambiguation = (ranking_lengths > 1) & policy_filters.get('disambiguation').evaluate(confidences)
+        is_fallback = ~is_disambiguation & (ranking_lengths > 0) & policy_filters.get('fallback').evaluate(confidences)
+        events = list(events)
+        for row, disambiguation, fallback in zip(ranked_rows, is_disambiguation, is_fallback):
+            if disambiguation or fallback:
+                event = events[row]
+                events[row] = dict(event, parse_data=dict(event['parse_data'], intent={'name': 'disambiguation' if disambiguation else 'fallback'}))
+        return events
+
+    def _is_intent_event(self, event: dict) -> bool:
+        # Events related to user intent or search form intents, disambiguations, forms not related to intents etc. are skipped
+        if 'parse_data' not in event or 'intent' not in event['parse_data']:
+            return False
+        intent_name = event['parse_data']['intent']['name']
+        return (SERVICE_SEARCH_REGEX.search(intent_name) is not None or len(self.utils._get_service_classes_from_intent_name(intent_name)) > 0 or
+                len(self.utils._get_life_events_from_intent_name(intent_name)) > 0)
+
+    def _add_top_level_event(self, state: ConversationState, event: dict) -> None:
+        state.open_intent_event = self._is_intent_event(event)
+        if state.open_intent_event:
+            state.intent_events.append(event)
+            state.intents.append(event['parse_data']['intent']['name'])
+
+    def _nest_event(self, state: ConversationState, event: dict) -> None:
+        # Same rules as ServiceMatcherUtils._nest_form_events
+        event = event.copy()
+        is_form_starting_event = ('parse_data' in event and SERVICE_SEARCH_REGEX.search(event['parse_data']['intent']['name']) is not None) or \
+            (event.get('name') is not None and FORM_REGEX.search(event.get('name')) is not None)
+        is_form_ending_event = (event.get('event') == 'active_loop' and event.get('name') is None) or event.get('event') == 'action_execution_rejected'
+        if is_form_starting_event and not state.form_on:
+            state.form_on = True
+            event['form_events'] = []
+            self._add_top_level_event(state, event)
+        elif state.form_on:
+            if state.open_intent_event:
+                state.intent_events[-1]['form_events'].append(event)
+            if is_form_ending_event:
+                state.form_on = False
+        else:
+            self._add_top_level_event(state, event)
+
+    def _add_event(self, state: ConversationState, event: dict) -> None:
+        # Rejected action is moved before the held back event, which is held back until a non rejected event follows
+        if event.get('event') == 'action_execution_rejected' and state.pending_event is not None:
+            self._nest_event(state, event)
+        else:
+            if state.pending_event is not None:
+                self._nest_event(state, state.pending_event)
+            state.pending_event = event
+
+    def parse(self, conversation_id: str, events: list, policy_filters: dict) -> tuple:
+        state = self._get_state(conversation_id, events, policy_filters)
+        if len(events) > state.n_events:
+            for event in self._relabel_events(events[state.n_events:], policy_filters):
+                self._add_event(state, event)
+            state.n_events = len(events)
+            state.last_event_key = self._get_event_key(events[-1])
+            self.states.set(conversation_id, state)
+            state = state.copy()
+        if state.pending_event is not None:
+            self._nest_event(state, state.pending_event)
+        return state.intent_events, state.intents
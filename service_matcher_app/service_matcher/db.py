@@ -1,12 +1,29 @@
 import os
 import logging
 import re
-import copy
+import time
+import threading
+import contextvars
+import numpy as np
+from contextlib import contextmanager, nullcontext
 from pymongo import MongoClient
 from .classifications import SERVICE_CLASSES, LIFE_EVENT_CODES, MUNICIPALITIES
+from .catalog import ServiceCatalog, ServiceClassCatalog
+from .ann_index import IVFFlatIndex
+from .snapshot import CatalogSnapshotStore
+from .policy import PolicyExpression
+from .cache import LRUCache
 from .models import *
 from typing import Optional
 
+# Only the tracker fields the conversation parser reads are fetched, trackers of long conversations are large
+CONVERSATION_PROJECTION = {"tracker.slots": 1, "tracker.events.event": 1, "tracker.events.name": 1, "tracker.events.timestamp": 1,
+                           "tracker.events.parse_data.intent.name": 1, "tracker.events.parse_data.intent_ranking.confidence": 1}
+
+# Catalog used by the current request, a sync doesn't change it in the middle of a request
+PINNED_CATALOG = contextvars.ContextVar("pinned_catalog", default=None)
+
+
 class ServiceMatcherDB():
     """
     A class for database operations of service matcher
@@ -35,59 +52,378 @@ class ServiceMatcherDB():
                 )
         else:
             self.mongo_client = mongo_client
-        self._update_desc_vectors()
+        self.catalog_generation = 0
+        self._catalog = None
+        self.vector_watermark = None
+        self.translation_watermark = None
+        self._update_lock = threading.Lock()
+        # Checking, loading and publishing the catalog happen in request threads and syncs at the same time
+        self._catalog_lock = threading.Lock()
+        # Generation is read before the data so that changes written meanwhile are noticed later
+        self.generation_poll_interval = float(os.environ.get('CATALOG_GENERATION_POLL_INTERVAL', 5))
+        self._generation_checked = time.monotonic()
+        self.database_generation = self._get_database_generation()
+        self.snapshot_version = None
+        self.snapshot_store = None
+        if os.environ.get('CATALOG_SNAPSHOT_DIR'):
+            self.snapshot_store = CatalogSnapshotStore(os.environ['CATALOG_SNAPSHOT_DIR'])
+        self.snapshot_poll_interval = float(os.environ.get('CATALOG_SNAPSHOT_POLL_INTERVAL', 5))
+        self._snapshot_checked = time.monotonic()
+        # A worker started after another one has written a snapshot of the current data doesn't need to read vectors from the database,
+        # a snapshot written before the processor changed the data is updated from its watermark and published again
+        with self.snapshot_store.writer_lock() if self.snapshot_store is not None else nullcontext():
+            if not (self._refresh_catalog_snapshot(force=True) and
+                    self.snapshot_store.get_metadata(self.snapshot_version).get("database_generation") == self.database_generation):
+                self._update_desc_vectors(delta=True)
+        self._update_service_class_vectors()
         self._update_translations()
+        self.service_cache_refresh_interval = float(os.environ.get('SERVICE_CACHE_REFRESH_INTERVAL', 60))
+        self.service_cache = None
+        self._update_service_documents()
+        self.intent_generation = 0
+        self.intent_index = None
+        self._update_intents()
+        self.policy_filter_cache = LRUCache(max_size=1, ttl=float(os.environ.get('POLICY_CACHE_TTL', 300)))
         
-    def _get_service_desc_vectors(self, service_class_codes_filter: Optional[list] = None, municipality_ids_filter: Optional[list] = None, life_events_filter: Optional[list] = None) -> list:
-        #filter_dict = {}
-        #if (service_class_codes_filter is not None) and len(service_class_codes_filter) < len(SERVICE_CLASSES):
-        #    filter_dict["service_class_codes"] = {"$in": service_class_codes_filter}
-        #if (municipality_ids_filter is not None) and len(municipality_ids_filter) < len(MUNICIPALITIES):
-        #    filter_dict["municipality_codes"] = {"$in": municipality_ids_filter}            
-        #if (life_events_filter is not None) and len(life_events_filter) < len(LIFE_EVENT_CODES):
-        #    filter_dict["life_event_codes"] = {"$in": life_events_filter}
-        #vectors = list(self.mongo_client.service_db.service_vectors.find(filter_dict))
-        vectors = self.service_vectors
+    def _get_service_filter_mask(self, service_class_codes_filter: Optional[list] = None, municipality_ids_filter: Optional[list] = None, life_events_filter: Optional[list] = None) -> np.ndarray:
+        # Codes are OR'ed within a filter and filters are AND'ed together, a filter containing every code doesn't limit anything
+        catalog = self.catalog
+        mask = np.ones(len(catalog), dtype=bool)
         if (service_class_codes_filter is not None) and len(service_class_codes_filter) < len(SERVICE_CLASSES):
-            vectors = [vect for vect in vectors if len(set(vect.get("service_class_codes")).intersection(set(service_class_codes_filter))) != 0]
+            mask &= catalog.get_code_mask("service_class_codes", service_class_codes_filter)
         if (municipality_ids_filter is not None) and len(municipality_ids_filter) < len(MUNICIPALITIES):
-            vectors = [vect for vect in vectors if len(set(vect.get("municipality_codes")).intersection(set(municipality_ids_filter))) != 0]          
+            mask &= catalog.get_code_mask("municipality_codes", municipality_ids_filter)
         if (life_events_filter is not None) and len(life_events_filter) < len(LIFE_EVENT_CODES):
-            vectors = [vect for vect in vectors if len(set(vect.get("life_event_codes")).intersection(set(life_events_filter))) != 0]  
-        return vectors
+            mask &= catalog.get_code_mask("life_event_codes", life_events_filter)
+        return mask
+
+    def _get_service_desc_vectors(self, service_class_codes_filter: Optional[list] = None, municipality_ids_filter: Optional[list] = None, life_events_filter: Optional[list] = None) -> np.ndarray:
+        # Returns catalog rows of the services matching the filters
+        return np.flatnonzero(self._get_service_filter_mask(service_class_codes_filter, municipality_ids_filter, life_events_filter))
     
     def _get_service_ids_by_filters(self, service_class_codes_filter: Optional[list] = None, municipality_ids_filter: Optional[list] = None, life_events_filter: Optional[list] = None) -> list:
-        #filter_dict = {}
-        #if (service_class_codes_filter is not None) and len(service_class_codes_filter) < len(SERVICE_CLASSES):
-        #    filter_dict["service_class_codes"] = {"$in": service_class_codes_filter}
-        #if (municipality_ids_filter is not None) and len(municipality_ids_filter) < len(MUNICIPALITIES):
-        #    filter_dict["municipality_codes"] = {"$in": municipality_ids_filter}            
-        #if (life_events_filter is not None) and len(life_events_filter) < len(LIFE_EVENT_CODES):
-        #    filter_dict["life_event_codes"] = {"$in": life_events_filter}
-        #services = list(self.mongo_client.service_db.classifications.find(filter_dict))
-        classifications = self.classifications
-        if (service_class_codes_filter is not None) and len(service_class_codes_filter) < len(SERVICE_CLASSES):
-            classifications = [cl for cl in classifications if len(set(cl.get("service_class_codes")).intersection(set(service_class_codes_filter))) != 0]
-        if (municipality_ids_filter is not None) and len(municipality_ids_filter) < len(MUNICIPALITIES):
-            classifications = [cl for cl in classifications if len(set(cl.get("municipality_codes")).intersection(set(municipality_ids_filter))) != 0]          
-        if (life_events_filter is not None) and len(life_events_filter) < len(LIFE_EVENT_CODES):
-            classifications = [cl for cl in classifications if len(set(cl.get("life_event_codes")).intersection(set(life_events_filter))) != 0]  
-        service_ids = [cl.get('id') for cl in classifications]
+        # Mask and ids are read from the same catalog even if a sync swaps it in between
+        with self.pin_catalog():
+            mask = self._get_service_filter_mask(service_class_codes_filter, municipality_ids_filter, life_events_filter)
+            service_ids = self.catalog.ids[mask].tolist()
         return service_ids
     
-    def _update_desc_vectors(self) -> None:
-        self.service_vectors = list(self.mongo_client.service_db.service_vectors.find({}))
-        self.classifications = [{i:ser[i] for i in ser if i!='vector'} for ser in self.service_vectors]
+    @property
+    def catalog(self) -> ServiceCatalog:
+        pinned_catalog = PINNED_CATALOG.get()
+        return pinned_catalog if pinned_catalog is not None else self._catalog
+
+    @contextmanager
+    def pin_catalog(self):
+        # Requests read the catalog many times, all reads inside this block get the same catalog
+        token = PINNED_CATALOG.set(self.catalog)
+        try:
+            yield
+        finally:
+            PINNED_CATALOG.reset(token)
+
+    def _set_catalog(self, catalog: ServiceCatalog) -> None:
+        # Generation tells caches that the catalog has been replaced, callers hold the catalog lock
+        if self._catalog is not None:
+            self.catalog_generation += 1
+        catalog.generation = self.catalog_generation
+        self._catalog = catalog
+
+    def _update_desc_vectors(self, delta: bool = False) -> None:
+        self._publish_catalog(*self._build_catalog(delta), database_generation=self.database_generation)
+
+    def _get_watermark(self, documents: list, watermark=None):
+        # ObjectIds grow with insertion time and the processor replaces changed documents, so the largest _id marks what has been read
+        ids = [document["_id"] for document in documents if document.get("_id") is not None]
+        if watermark is not None:
+            ids.append(watermark)
+        return max(ids) if len(ids) > 0 else None
+
+    def _build_catalog(self, delta: bool = False) -> tuple:
+        # With delta only vectors inserted after the watermark and ids of the current services are read
+        quantization = os.environ.get('SERVICE_VECTOR_QUANTIZATION', 'none')
+        rescore_candidates = int(os.environ.get('QUANTIZED_RESCORE_CANDIDATES', 200))
+        vector_dir = os.environ.get('SERVICE_VECTOR_DIR')
+        if delta and self.vector_watermark is not None and self._catalog is not None:
+            changed_service_vectors = list(self.mongo_client.service_db.service_vectors.find({"_id": {"$gt": self.vector_watermark}}))
+            current_ids = {service_vector.get("id") for service_vector in self.mongo_client.service_db.service_vectors.find({}, {"id": 1})}
+            try:
+                catalog = self._catalog.with_changes(changed_service_vectors, current_ids, vector_dir)
+                return catalog, self._get_watermark(changed_service_vectors, self.vector_watermark)
+            except ValueError as e:
+                logging.error(f"Could not update service vectors incrementally, reading all of them: {e}")
+        service_vectors = list(self.mongo_client.service_db.service_vectors.find({}))
+        catalog = ServiceCatalog(service_vectors, quantization=quantization, rescore_candidates=rescore_candidates, vector_dir=vector_dir)
+        return catalog, self._get_watermark(service_vectors)
+
+    def _publish_catalog(self, catalog: ServiceCatalog, vector_watermark=None, database_generation=None) -> None:
+        with self._catalog_lock:
+            if self.snapshot_store is not None:
+                # Other workers swap to the new snapshot when they notice it, the watermark is stored with it for their incremental syncs
+                version = self.snapshot_store.write(catalog, vector_watermark, database_generation)
+                self._load_catalog_snapshot(version)
+                return
+            if len(catalog) >= int(os.environ.get('ANN_INDEX_MIN_SERVICES', 20000)):
+                catalog.ann_index = self._get_ann_index(catalog)
+            self.vector_watermark = vector_watermark
+            self._set_catalog(catalog)
 
-    def _update_translations(self) -> None:
-        translations = list(self.mongo_client.service_db.translations.find({}))
-        self.translation_dict = {'en':{}, 'sv': {}}
+    def _get_database_generation(self):
+        # Processor increments the generation whenever it has written new data
+        generation = self.mongo_client.service_db.catalog_generation.find_one({"_id": "catalog"})
+        return generation.get("generation") if generation is not None else None
+
+    def _refresh_database_generation(self) -> bool:
+        # Checks at most once in poll interval if the processor has written new data, returns True if it has.
+        # The generation is stored only after the new data has been published so that a failed update is retried
+        if time.monotonic() - self._generation_checked <= self.generation_poll_interval:
+            return False
+        self._generation_checked = time.monotonic()
+        try:
+            generation = self._get_database_generation()
+        except Exception as e:
+            logging.error(f"Could not read catalog generation: {e}")
+            return False
+        return generation != self.database_generation
+
+    def _is_snapshot_current(self, database_generation) -> bool:
+        # Another worker may already have written a snapshot of the database generation, callers hold the snapshot writer lock
+        if self.snapshot_store is None or database_generation is None:
+            return False
+        self._refresh_catalog_snapshot(force=True)
+        return (self.snapshot_version is not None and
+                self.snapshot_store.get_metadata(self.snapshot_version).get("database_generation") == database_generation)
+
+    def _load_catalog_snapshot(self, version: str) -> None:
+        # Callers hold the catalog lock
+        catalog = self.snapshot_store.load(version,
+                                           quantization=os.environ.get('SERVICE_VECTOR_QUANTIZATION', 'none'),
+                                           rescore_candidates=int(os.environ.get('QUANTIZED_RESCORE_CANDIDATES', 200)))
+        vector_watermark = self.snapshot_store.get_metadata(version).get("vector_watermark")
+        if len(catalog) >= int(os.environ.get('ANN_INDEX_MIN_SERVICES', 20000)):
+            catalog.ann_index = self._get_ann_index(catalog, os.path.join(
+                self.snapshot_store.get_version_directory(version), "ann_index.npz"))
+        self.vector_watermark = vector_watermark
+        self._set_catalog(catalog)
+        self.snapshot_version = version
+
+    def _refresh_catalog_snapshot(self, force: bool = False) -> bool:
+        # Checks at most once in poll interval if another worker has written a new snapshot, returns True if a snapshot is in use
+        if self.snapshot_store is None:
+            return False
+        if force or time.monotonic() - self._snapshot_checked > self.snapshot_poll_interval:
+            # Requests don't wait for a snapshot another thread is already checking or loading
+            if not self._catalog_lock.acquire(blocking=force):
+                return self.snapshot_version is not None
+            try:
+                self._snapshot_checked = time.monotonic()
+                version = self.snapshot_store.get_current_version()
+                if version is not None and version != self.snapshot_version:
+                    try:
+                        self._load_catalog_snapshot(version)
+                    except (OSError, ValueError, KeyError) as e:
+                        logging.error(f"Could not load catalog snapshot {version}: {e}")
+            finally:
+                self._catalog_lock.release()
+        return self.snapshot_version is not None
+
+    def _get_ann_index(self, catalog: ServiceCatalog, default_index_path: Optional[str] = None) -> IVFFlatIndex:
+        # A saved index is reused if it was built from exactly the same service vectors
+        index_path = os.environ.get('ANN_INDEX_PATH', default_index_path)
+        n_probe = int(os.environ.get('ANN_INDEX_N_PROBE', 16))
+        fingerprint = catalog.get_fingerprint()
+        if index_path:
+            ann_index = IVFFlatIndex.load(index_path, catalog.vectors, fingerprint, n_probe=n_probe)
+            if ann_index is not None:
+                return ann_index
+        ann_index = IVFFlatIndex(catalog.vectors, n_probe=n_probe)
+        if index_path:
+            try:
+                ann_index.save(index_path, fingerprint)
+            except OSError as e:
+                logging.error(f"Could not save ANN index to {index_path}: {e}")
+        return ann_index
+
+    def _update_translations(self, delta: bool = False) -> None:
+        self.translation_dict, self.translation_watermark = self._build_translations(delta)
+
+    def _build_translations(self, delta: bool = False) -> tuple:
+        # Translations are only added, with delta the ones inserted after the watermark are added to a copy of the current ones
+        if delta and self.translation_watermark is not None:
+            translations = list(self.mongo_client.service_db.translations.find({"_id": {"$gt": self.translation_watermark}}))
+            translation_dict = {language: dict(language_translations) for language, language_translations in self.translation_dict.items()}
+        else:
+            translations = list(self.mongo_client.service_db.translations.find({}))
+            translation_dict = {'en':{}, 'sv': {}}
         for translation in translations:
             if translation.get('source_language') == 'fi':
-                self.translation_dict[translation.get('target_language')][translation.get('source_text')] = translation.get('target_text')
+                translation_dict[translation.get('target_language')][translation.get('source_text')] = translation.get('target_text')
+        return translation_dict, self._get_watermark(translations, self.translation_watermark if delta else None)
+
+    def _update_service_class_vectors(self) -> None:
+        service_class_vectors = list(self.mongo_client.service_db.service_class_vectors.find({}))
+        self.service_class_catalog = ServiceClassCatalog(service_class_vectors)
+
+    @property
+    def services_by_id(self) -> dict:
+        return self.service_cache["services"]
+
+    @property
+    def translated_services_by_id(self) -> dict:
+        return self.service_cache["translated_services"]
+
+    @property
+    def channels_by_id(self) -> dict:
+        return self.service_cache["channels"]
+
+    @property
+    def service_channels(self) -> dict:
+        return self.service_cache["service_channels"]
+
+    def _update_service_documents(self) -> None:
+        self._publish_service_cache(self._build_service_cache())
+
+    def _get_updated_documents(self, collection, watermark) -> list:
+        # Documents at the watermark are fetched again since others may have been written later with the same timestamp
+        if watermark is None:
+            return list(collection.find())
+        return list(collection.find({"lastUpdated": {"$gte": watermark}}))
+
+    def _build_service_cache(self, delta: bool = False, remove_missing: bool = False, translation_dict: Optional[dict] = None, retranslate: bool = False) -> dict:
+        # Service payloads of recommendations are served from memory, with delta only services and channels updated since the watermarks are fetched
+        removed = False
+        if delta and self.service_cache is not None:
+            service_watermark = self.service_cache["service_watermark"]
+            channel_watermark = self.service_cache["channel_watermark"]
+            fetched_services = self._get_updated_documents(self.mongo_client.service_db.services, service_watermark)
+            fetched_channels = self._get_updated_documents(self.mongo_client.service_db.channels, channel_watermark)
+            services_by_id = dict(self.services_by_id)
+            translated_services_by_id = dict(self.translated_services_by_id)
+            channels_by_id = dict(self.channels_by_id)
+            if remove_missing:
+                # Removed services and channels are found by comparing ids only
+                current_service_ids = {service.get("id") for service in self.mongo_client.service_db.services.find({}, {"id": 1})}
+                current_channel_ids = {channel.get("id") for channel in self.mongo_client.service_db.channels.find({}, {"id": 1})}
+                n_cached = len(services_by_id) + len(channels_by_id)
+                services_by_id = {s_id: ser for s_id, ser in services_by_id.items() if s_id in current_service_ids}
+                translated_services_by_id = {s_id: ser for s_id, ser in translated_services_by_id.items() if s_id in current_service_ids}
+                channels_by_id = {c_id: cha for c_id, cha in channels_by_id.items() if c_id in current_channel_ids}
+                removed = len(services_by_id) + len(channels_by_id) < n_cached
+        else:
+            service_watermark = None
+            channel_watermark = None
+            fetched_services = list(self.mongo_client.service_db.services.find())
+            fetched_channels = list(self.mongo_client.service_db.channels.find())
+            services_by_id = {}
+            translated_services_by_id = {}
+            channels_by_id = {}
+        # Both variants are made once here so that translate_missing_texts is only a choice between them in requests
+        changed = False
+        if retranslate:
+            # Translations have changed, so missing texts of services that haven't been updated may now have a translation
+            for service_id, service_model in services_by_id.items():
+                translated_service = Service(**self._translate_missing_texts(service_model.dict(), translation_dict))
+                if translated_service != translated_services_by_id.get(service_id):
+                    translated_services_by_id[service_id] = translated_service
+                    changed = True
+        for service in fetched_services:
+            service = self._fill_translation_indicators(service)
+            service_model = Service(**service)
+            service_watermark = max(service_watermark, service_model.lastUpdated) if service_watermark is not None else service_model.lastUpdated
+            # Services fetched again at the watermark are kept as they are if they haven't been updated
+            if service_model.id in services_by_id and services_by_id[service_model.id].lastUpdated == service_model.lastUpdated:
+                continue
+            services_by_id[service_model.id] = service_model
+            translated_services_by_id[service_model.id] = Service(**self._translate_missing_texts(service, translation_dict))
+            changed = True
+        for channel in fetched_channels:
+            channel = ServiceChannel(**channel)
+            channel_watermark = max(channel_watermark, channel.lastUpdated) if channel_watermark is not None else channel.lastUpdated
+            if channel.id in channels_by_id and channels_by_id[channel.id].lastUpdated == channel.lastUpdated:
+                continue
+            channels_by_id[channel.id] = channel
+            changed = True
+
+        # Generation tells the response cache that service payloads have changed
+        generation = 0
+        if self.service_cache is not None:
+            generation = self.service_cache["generation"] + int(changed or removed)
+
+        # Index is rebuilt from all channels since an updated channel may have been linked to different services
+        return {"services": services_by_id,
+                "translated_services": translated_services_by_id,
+                "channels": channels_by_id,
+                "service_channels": self._group_channels_by_service(channels_by_id.values()),
+                "service_watermark": service_watermark,
+                "channel_watermark": channel_watermark,
+                "generation": generation}
+
+    def _publish_service_cache(self, service_cache: dict) -> None:
+        # The cache is replaced with one assignment, concurrent requests see either the old or the new cache
+        self.service_cache = service_cache
+
+    def _sync(self) -> None:
+        # Changes since the previous sync are read and everything is built before anything is published, requests aren't blocked meanwhile
+        # With snapshots one worker builds and writes the catalog of a database generation, the others wait for it and load its snapshot
+        with self._update_lock:
+            database_generation = self._get_database_generation()
+            with self.snapshot_store.writer_lock() if self.snapshot_store is not None else nullcontext():
+                catalog, vector_watermark = None, None
+                if not self._is_snapshot_current(database_generation):
+                    catalog, vector_watermark = self._build_catalog(delta=True)
+                service_class_catalog = ServiceClassCatalog(list(self.mongo_client.service_db.service_class_vectors.find({})))
+                translation_dict, translation_watermark = self._build_translations(delta=True)
+                service_cache = self._build_service_cache(delta=True, remove_missing=True, translation_dict=translation_dict,
+                                                          retranslate=translation_dict != self.translation_dict)
+
+                # Services are published before the catalog so that every service in the catalog can be found
+                self.translation_dict, self.translation_watermark = translation_dict, translation_watermark
+                self._publish_service_cache(service_cache)
+                self._update_intents()
+                self.service_class_catalog = service_class_catalog
+                if catalog is not None:
+                    self._publish_catalog(catalog, vector_watermark, database_generation)
+            self.database_generation = database_generation
+
+    def _refresh_service_documents(self) -> bool:
+        # Called periodically from a background thread, returns True if services or channels have changed
+        if not self._update_lock.acquire(blocking=False):
+            # A running sync updates the cache anyway
+            return False
+        try:
+            service_cache = self._build_service_cache(delta=True)
+            changed = service_cache["generation"] != self.service_cache["generation"]
+            self._publish_service_cache(service_cache)
+            # PTV IDs of intents are resolved against the cached services
+            if changed:
+                self._update_intents()
+            return changed
+        finally:
+            self._update_lock.release()
+
+    def _update_intents(self) -> None:
+        # Intent collection is small so it's always read whole, PTV IDs are resolved against the service cache
+        intent_to_services = list(self.mongo_client.service_db.intent_to_services.find({}))
+        intent_index = {}
+        for intent_to_service in intent_to_services:
+            intent_name = intent_to_service.get('intent')
+            # The first document of an intent is used if there are many
+            if intent_name is None or intent_name.lower() in intent_index:
+                continue
+            services = intent_to_service.get('services') if intent_to_service.get('services') is not None else []
+            ptv_services = intent_to_service.get('ptv_services') if intent_to_service.get('ptv_services') is not None else []
+            ptv_service_ids = self._get_service_ids_by_ptv_ids(ptv_services)
+            intent_index[intent_name.lower()] = {'services': list(dict.fromkeys(services + ptv_service_ids)),
+                                                 'intent_text': intent_to_service.get('intent_text'),
+                                                 'intent_service_classes': intent_to_service.get('intent_service_classes'),
+                                                 'intent_priorization': intent_to_service.get('intent_priorization')}
+        # Generation tells the response cache that intent recommendations may have changed
+        if self.intent_index is not None and intent_index != self.intent_index:
+            self.intent_generation += 1
+        self.intent_index = intent_index
 
     def _get_service_class_vectors(self) -> list:
-        return list(self.mongo_client.service_db.service_class_vectors.find({}))
+        return self.service_class_catalog.service_class_vectors
 
     def _get_all_service_classes(self) -> list:
         return([ServiceClass(**sc) for sc in SERVICE_CLASSES])
@@ -98,73 +434,47 @@ class ServiceMatcherDB():
     def _get_all_municipalities(self) -> list:
         return(MUNICIPALITIES)
 
-    def _get_all_services(self, include_channels: bool = False, translate_missing_texts: bool = False) -> list:
-        res = []
-        all_services = list(self.mongo_client.service_db.services.find())
-        all_services = [self._fill_translation_indicators(service) for service in all_services]
+    def _get_service_cache(self) -> dict:
+        return self.service_cache
+
+    def _get_cached_services(self, service_cache: dict, translate_missing_texts: bool = False) -> dict:
         if translate_missing_texts:
-            all_services = [self._translate_missing_texts(service) for service in all_services]
-        all_services = [Service(**service) for service in all_services]
+            return service_cache["translated_services"]
+        return service_cache["services"]
+
+    def _get_all_services(self, include_channels: bool = False, translate_missing_texts: bool = False) -> list:
+        service_cache = self._get_service_cache()
+        all_services = list(self._get_cached_services(service_cache, translate_missing_texts).values())
         if include_channels:
-            service_ids = [ser.id for ser in all_services]
-            found_channels = list(
-                self.mongo_client.service_db.channels.find({"serviceIds": {"$in": service_ids}}))
-            found_channels = [ServiceChannel(**channel) for channel in found_channels]
-            for service in all_services:
-                ser_channels = [cha for cha in found_channels if cha.serviceIds is not None and (service.id in cha.serviceIds)]
-                res = res + [{'service': service, 'channels': ser_channels}]
+            res = [{'service': service, 'channels': list(service_cache["service_channels"].get(service.id, []))} for service in all_services]
         else:
             res = [{'service': ser} for ser in all_services]
         return(res)
 
+    def _group_channels_by_service(self, channels: list) -> dict:
+        # Single pass over the channels, a channel is listed under each of its services once and in the original order
+        service_channels = {}
+        for channel in channels:
+            for service_id in dict.fromkeys(channel.serviceIds or []):
+                service_channels.setdefault(service_id, []).append(channel)
+        return service_channels
+
     def _get_services_by_ids(self, service_ids: list, include_channels: bool = False, translate_missing_texts: bool = False) -> list:
-        res = []
-        fetched_services = list(self.mongo_client.service_db.services.find({"id": {"$in": service_ids}}))
-        filtered_services = []
-        for s_id in service_ids:
-            ser = [service for service in fetched_services if service.get('id') == s_id]
-            if len(ser) > 0:
-                filtered_services = filtered_services + ser
-        filtered_services = [ser for ser in filtered_services if ser.get("id") in service_ids]
-        filtered_services = [self._fill_translation_indicators(service) for service in filtered_services]
-        if translate_missing_texts:
-            filtered_services = [self._translate_missing_texts(service) for service in filtered_services]
-        filtered_services = [Service(**service) for service in filtered_services]
+        service_cache = self._get_service_cache()
+        cached_services = self._get_cached_services(service_cache, translate_missing_texts)
+        found_services = [cached_services[s_id] for s_id in service_ids if s_id in cached_services]
         if include_channels:
-            service_ids = [ser.id for ser in filtered_services]
-            found_channels = list(
-                self.mongo_client.service_db.channels.find({"serviceIds": {"$in": service_ids}}))
-            found_channels = [ServiceChannel(**channel) for channel in found_channels]
-            for service in filtered_services:
-                ser_channels = [cha for cha in found_channels if cha.serviceIds is not None and (service.id in cha.serviceIds)]
-                res = res + [{'service': service, 'channels': ser_channels}]
+            res = [{'service': service, 'channels': list(service_cache["service_channels"].get(service.id, []))} for service in found_services]
         else:
-            res = [{'service': ser} for ser in filtered_services]
+            res = [{'service': ser} for ser in found_services]
         return(res)
 
     def _get_service(self, service_id: str, translate_missing_texts: bool = False) -> Service:
-        found_services = list(
-            self.mongo_client.service_db.services.find({"id": service_id}))
-        found_services = [self._fill_translation_indicators(service) for service in found_services]
-        if translate_missing_texts:
-            found_services = [self._translate_missing_texts(service) for service in found_services]
-        found_services = [Service(**service) for service in found_services]
-        filtered_services = [
-            service for service in found_services if service.id == service_id]
-        if len(filtered_services) > 0:
-            return(filtered_services[0])
-        else:
-            return(None)
+        return(self._get_cached_services(self._get_service_cache(), translate_missing_texts).get(service_id))
         
     def _get_service_ids_by_ptv_ids(self, service_ptv_ids: list) -> list:
         if service_ptv_ids is not None and len(service_ptv_ids) > 0:
-            found_services = []
-            found_services_list = list(
-                self.mongo_client.service_db.services.find({"id": {"$in": service_ptv_ids }}))
-            for s_id in service_ptv_ids:
-                ser = [service for service in found_services_list if service.get('id') == s_id]
-                found_services = found_services + ser
-            service_ids = [service.get('id') for service in found_services if service.get('id') is not None] # Check is here for testing purpose
+            service_ids = [s_id for s_id in service_ptv_ids if s_id is not None and s_id in self.services_by_id]
             return(service_ids)
         else:
             return([])
@@ -183,14 +493,21 @@ class ServiceMatcherDB():
         if len(found_channels) > 0:
             return(found_channels)
         else:
-            all_service_ids = [cl.get('id') for cl in self.classifications]
-            if service_id in all_service_ids:
+            if service_id in self.catalog.row_index:
                 return([])
             else:
                 return(None)
 
 
     def _get_policy_filters(self) -> dict:
+        # Policies change rarely, parsed filters are reused until the cache entry expires
+        funcs = self.policy_filter_cache.get("policy_filters")
+        if funcs is None:
+            funcs = self._parse_policy_filters()
+            self.policy_filter_cache.set("policy_filters", funcs)
+        return(funcs)
+
+    def _parse_policy_filters(self) -> dict:
         policies_query = self.mongo_client.bf.core_policies.find()
         policies = list(policies_query)
         if policies is not None and len(policies) > 0 and 'policies' in policies[0]:
@@ -206,18 +523,12 @@ class ServiceMatcherDB():
             dis_trigger_splitted = dis_trigger_text[0].split(': ')
             if len(dis_trigger_splitted) == 2:
                 dis_filter = dis_trigger_splitted[1].replace("'", "")
-                matches = re.findall(pattern=r'(\$\d+)', string=dis_filter)
-                for match in matches:
-                    match_number = match[1:]
-                    match_element = 'confidences[{}]'.format(str(match_number))
-                    dis_filter = dis_filter.replace(match, match_element)
+                dis_filter = re.sub(r'\$(\d+)', r'confidences[\1]', dis_filter)
             else:
                 dis_filter = 'False'
         else:
             dis_filter = 'False'
 
-        def dis_func(confidences): return eval(dis_filter)
-
         fallback_trigger_text = [
             el for el in splitted if 'fallback_trigger' in el]
         if len(fallback_trigger_text) > 0:
@@ -230,15 +541,20 @@ class ServiceMatcherDB():
         else:
             fallback_filter_threshold = '0'
 
-        def fallback_func(confidences): return confidences[0] < eval(
-            fallback_filter_threshold)
-
-        funcs = {"disambiguation": dis_func, "fallback": fallback_func}
+        funcs = {"disambiguation": self._compile_policy_expression(dis_filter),
+                 "fallback": self._compile_policy_expression('confidences[0] < ({})'.format(fallback_filter_threshold))}
         return(funcs)
 
+    def _compile_policy_expression(self, expression: str) -> PolicyExpression:
+        try:
+            return PolicyExpression(expression)
+        except (ValueError, SyntaxError) as e:
+            logging.error(f"Could not parse policy trigger {expression}, trigger is ignored: {e}")
+            return PolicyExpression('False')
+
     def _get_conversation_by_id(self, conversation_id: str) -> dict:
         conversation_query = self.mongo_client.bf.conversations.find(
-            {'_id': conversation_id})
+            {'_id': conversation_id}, CONVERSATION_PROJECTION)
         conversation = list(conversation_query)
         if len(conversation) == 1:
             return(conversation[0])
@@ -247,52 +563,43 @@ class ServiceMatcherDB():
 
     def _get_activities_by_conversation(self, conversation_id: str) -> dict:
         activities_query = self.mongo_client.bf.activity.find(
-            {'conversation_id': conversation_id})
+            {'conversation_id': conversation_id}, {'text': 1, '_id': 0})
         activities = list(activities_query)
         return(activities)
 
     def _get_service_ids_by_intent_name(self, intent_name: str) -> dict:
+        intent_info = None
         if intent_name is not None and type(intent_name) == str:
-            intent_to_service = list(self.mongo_client.service_db.intent_to_services.find({}))
-            intent_to_service = [intent_to_service_el for intent_to_service_el in intent_to_service if intent_to_service_el.get('intent') is not None and intent_to_service_el.get('intent').lower() == intent_name.lower()]
-        else:
-            intent_to_service = []
-
-        services = []
-        ptv_services = []
-        text = None
-        classes = None
-        priorization = None
-        if intent_to_service is not None and len(intent_to_service) > 0:
-            text = intent_to_service[0].get('intent_text')
-            priorization = intent_to_service[0].get('intent_priorization')
-            classes = intent_to_service[0].get('intent_service_classes')
-            services = intent_to_service[0].get('services') if intent_to_service[0].get('services') is not None else []
-            ptv_services = intent_to_service[0].get('ptv_services') if intent_to_service[0].get('ptv_services') is not None else []
-
-        # Map PTV IDs to generic IDs
-        ptv_service_ids = self._get_service_ids_by_ptv_ids(ptv_services)
-        services = list(dict.fromkeys(services + ptv_service_ids))
-
-        return({'services': services, 'intent_text': text, 'intent_service_classes': classes, 'intent_priorization': priorization})
+            intent_info = self.intent_index.get(intent_name.lower())
+        if intent_info is None:
+            return({'services': [], 'intent_text': None, 'intent_service_classes': None, 'intent_priorization': None})
+        # Callers get their own copy of the service list
+        return(dict(intent_info, services=list(intent_info['services'])))
     
     def _fill_translation_indicators(self, service_orig: dict) -> dict:
+        # Only the changed fields are copied, the rest are shared with the original document
         languages = ['fi', 'en', 'sv']
-        service = copy.deepcopy(service_orig)
+        service = dict(service_orig)
         service["nameAutoTranslated"] = {"fi": False, "en": False, "sv": False}
+        service["descriptions"] = dict(service_orig["descriptions"])
         for language in languages:
-            for desc in service["descriptions"][language]:
-                desc["autoTranslated"] = False
+            service["descriptions"][language] = [dict(desc, autoTranslated=False) for desc in service_orig["descriptions"][language]]
         return(service)
           
-    def _translate_missing_texts(self, service_orig: dict) -> dict:
+    def _translate_missing_texts(self, service_orig: dict, translation_dict: Optional[dict] = None) -> dict:
         translated = False
-        service = copy.deepcopy(service_orig)
+        if translation_dict is None:
+            translation_dict = self.translation_dict
+        # Translated texts are added to new name and description containers, descriptions themselves aren't modified
+        service = dict(service_orig)
+        service["name"] = dict(service_orig["name"])
+        service["nameAutoTranslated"] = dict(service_orig["nameAutoTranslated"])
+        service["descriptions"] = dict(service_orig["descriptions"])
         languages = ['en', 'sv']
         for language in languages:
             
             if not service.get('name').get(language):
-                name_translated = self.translation_dict[language].get(service.get('name').get('fi'))
+                name_translated = translation_dict[language].get(service.get('name').get('fi'))
                 service['name'][language] = name_translated
                 service["nameAutoTranslated"][language] = True
                 
@@ -300,7 +607,7 @@ class ServiceMatcherDB():
             if len(lang_desc) == 0:
                 fi_desc = [desc["value"] for desc in service.get('descriptions').get('fi')
                            if desc["value"] is not None and desc["type"] == "Description"]
-                descs_translated = [self.translation_dict[language].get(fi_desc_el) for fi_desc_el in fi_desc]
+                descs_translated = [translation_dict[language].get(fi_desc_el) for fi_desc_el in fi_desc]
                 descs_translated = [{"value":desc, "type": "Description", "autoTranslated": True} for desc in descs_translated if desc is not None]
                 service['descriptions'][language] = service['descriptions'][language] + descs_translated
                 
@@ -308,7 +615,7 @@ class ServiceMatcherDB():
             if len(lang_gdesc) == 0:
                 fi_gdesc = [gdesc["value"] for gdesc in service.get('descriptions').get('fi')
                            if gdesc["value"] is not None and gdesc["type"] == "GD_Description"]
-                gdescs_translated = [self.translation_dict[language].get(fi_gdesc_el) for fi_gdesc_el in fi_gdesc]
+                gdescs_translated = [translation_dict[language].get(fi_gdesc_el) for fi_gdesc_el in fi_gdesc]
                 gdescs_translated = [{"value":gdesc, "type": "GD_Description", "autoTranslated": True} for gdesc in gdescs_translated if gdesc is not None]
                 service['descriptions'][language] = service['descriptions'][language] + gdescs_translated
                 
@@ -316,7 +623,7 @@ class ServiceMatcherDB():
             if len(lang_summ) == 0:
                 fi_summ = [summ["value"] for summ in service.get('descriptions').get('fi')
                            if summ["value"] is not None and summ["type"] == "Summary"]
-                summs_translated = [self.translation_dict[language].get(fi_summ_el) for fi_summ_el in fi_summ]
+                summs_translated = [translation_dict[language].get(fi_summ_el) for fi_summ_el in fi_summ]
                 summs_translated = [{"value":summ, "type": "Summary", "autoTranslated": True} for summ in summs_translated if summ is not None]
                 service['descriptions'][language] = service['descriptions'][language] + summs_translated
                 
@@ -324,7 +631,7 @@ class ServiceMatcherDB():
             if len(lang_gsumm) == 0:
                 fi_gsumm = [gsumm["value"] for gsumm in service.get('descriptions').get('fi')
                            if gsumm["value"] is not None and gsumm["type"] == "GD_Summary"]
-                gsumms_translated = [self.translation_dict[language].get(fi_gsumm_el) for fi_gsumm_el in fi_gsumm]
+                gsumms_translated = [translation_dict[language].get(fi_gsumm_el) for fi_gsumm_el in fi_gsumm]
                 gsumms_translated = [{"value":gsumm, "type": "GD_Summary", "autoTranslated": True} for gsumm in gsumms_translated if gsumm is not None]
                 service['descriptions'][language] = service['descriptions'][language] + gsumms_translated
                 
@@ -0,0 +1,90 @@
+import json
+from pydantic import BaseModel
+from fastapi.encoders import jsonable_encoder
+from .cache import LRUCache
+from typing import Any, Callable
+
+
+def encode_json(content: Any) -> bytes:
+    # Same encoding as the JSON responses of FastAPI
+    return json.dumps(jsonable_encoder(content), ensure_ascii=False, allow_nan=False,
+                      indent=None, separators=(",", ":")).encode("utf-8")
+
+
+class JSONFragmentCache():
+    """
+    A class for pre-encoded JSON of the service and channel models in responses
+
+    The service cache hands out the same Service and ServiceChannel objects until they are updated, so models
+    are cached by identity. An entry keeps a reference to its model, an identity can't be reused by another
+    object while the entry is cached. Responses are encoded by splicing the cached fragments together.
+
+    Args
+    ----------
+    max_size : int
+        Maximum number of cached fragments and municipality shaped models each
+
+
+    Methods
+    -------
+    warm(models: list)
+        Encodes the models in advance
+
+    get_fragment(model: BaseModel)
+        Returns encoded JSON of the model
+
+    get_shaped(model: BaseModel, municipality_ids: list, shape: Callable)
+        Returns the model shaped for the municipalities, shaped models are cached so their fragments can be reused
+
+    encode(content: Any)
+        Returns encoded JSON of a response
+
+    clear()
+        Removes all cached fragments and shaped models
+
+    get_stats()
+        Returns statistics of the fragment and shaped model caches
+
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self.fragments = LRUCache(max_size=max_size)
+        self.shaped_models = LRUCache(max_size=max_size)
+
+    def warm(self, models: list) -> None:
+        for model in models[:self.fragments.max_size]:
+            self.fragments.set(id(model), (model, encode_json(model)))
+
+    def get_fragment(self, model: BaseModel) -> bytes:
+        entry = self.fragments.get(id(model))
+        if entry is not None and entry[0] is model:
+            return entry[1]
+        fragment = encode_json(model)
+        self.fragments.set(id(model), (model, fragment))
+        return fragment
+
+    def get_shaped(self, model: BaseModel, municipality_ids: list, shape: Callable) -> BaseModel:
+        key = (id(model), frozenset(municipality_ids))
+        entry = self.shaped_models.get(key)
+        if entry is not None and entry[0] is model:
+            return entry[1]
+        shaped_model = shape(model, municipality_ids)
+        self.shaped_models.set(key, (model, shaped_model))
+        return shaped_model
+
+    def encode(self, content: Any) -> bytes:
+        if isinstance(content, BaseModel):
+            return self.get_fragment(content)
+        if isinstance(content, (list, tuple)):
+            return b"[" + b",".join(self.encode(item) for item in content) + b"]"
+        if isinstance(content, dict) and all(isinstance(key, str) for key in content):
+            return b"{" + b",".join(encode_json(key) + b":" + self.encode(value) for key, value in content.items()) + b"}"
+        return encode_json(content)
+
+    def clear(self) -> None:
+        self.fragments.clear()
+        self.shaped_models.clear()
+
+    def get_stats(self) -> dict:
+        return {"fragments": self.fragments.get_stats(),
+                "shaped_models": self.shaped_models.get_stats()}
@@ -1,13 +1,20 @@
 import os
 import logging
 import math
-import heapq
+import contextvars
 from collections import OrderedDict
-from typing import Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple, Optional
 from .db import ServiceMatcherDB
+from .cache import LRUCache
 import numpy as np
 import requests
 from fastapi import HTTPException
+try:
+    from nlp_vectorizer.models import VectorizeQuery, VectorizeBatchQuery
+except ImportError:
+    VectorizeQuery = None
+    VectorizeBatchQuery = None
 
 
 class FreeTextRecommender():
@@ -18,31 +25,146 @@ class FreeTextRecommender():
     ----------
     service_matcher_db : ServiceMatcherDB
         ServiceMatcher's MongoDB client where service data is stored
+    api_session : requests.Session (default None)
+        A requests session with pooled keep-alive connections to NLP Vectorizer and Lexical Text Search
+    embedded_vectorizer : NlpVectorizer (default None)
+        In-process NLP Vectorizer, loaded from nlp_vectorizer package if NLP_VECTORIZER_MODE is embedded and not given
 
     Methods
     -------
     recommend_services(text: str, municipalities: list, life_events: list, service_classes: list, match_service_classes: bool, top_k: int, score_threshold: float, text_recommender="all")
         Recommend services by free text and different filters
 
+    recommend_services_batch(queries: list)
+        Recommend services for many free text queries scoring them together
+
     recommend_service_classes(text: str, top_k: int)
         Recommend service classes by free text
 
     """
 
-    def __init__(self, service_matcher_db: ServiceMatcherDB) -> None:
+    def __init__(self, service_matcher_db: ServiceMatcherDB, api_session: Optional[requests.Session] = None, embedded_vectorizer=None) -> None:
         self.db = service_matcher_db
+        pool_size = int(os.environ.get('BACKEND_CONNECTION_POOL_SIZE', 16))
+        if api_session is None:
+            self.api_session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+            self.api_session.mount('http://', adapter)
+            self.api_session.mount('https://', adapter)
+        else:
+            self.api_session = api_session
+        self.executor = ThreadPoolExecutor(max_workers=pool_size)
+        self.nlp_vectorizer_timeout = float(os.environ.get('NLP_VECTORIZER_TIMEOUT', 10))
+        self.lexical_text_search_timeout = float(os.environ.get('LEXICAL_TEXT_SEARCH_TIMEOUT', 10))
+        self.query_vector_cache = LRUCache(
+            max_size=int(os.environ.get('QUERY_VECTOR_CACHE_SIZE', 2048)),
+            ttl=float(os.environ.get('QUERY_VECTOR_CACHE_TTL', 86400)))
+        self.nlp_model_name = None
+        self.query_vector_catalog_generation = self.db.catalog.generation
+        self.exact_search_max_candidates = int(os.environ.get('ANN_EXACT_SEARCH_MAX_CANDIDATES', 10000))
+        self.nlp_vectorizer_batch_size = int(os.environ.get('NLP_VECTORIZER_BATCH_SIZE', 256))
+        if embedded_vectorizer is None and os.environ.get('NLP_VECTORIZER_MODE', 'remote') == 'embedded':
+            embedded_vectorizer = self._load_embedded_vectorizer()
+        self.embedded_vectorizer = embedded_vectorizer
+
+    def _load_embedded_vectorizer(self):
+        # NLP Vectorizer and its model dependencies are optional, without them the remote NLP Vectorizer is used
+        try:
+            from nlp_vectorizer.nlp_vectorizer import NlpVectorizer
+            return NlpVectorizer()
+        except Exception as e:
+            logging.error(f"Could not load embedded NLP Vectorizer, using remote NLP Vectorizer: {e}")
+            return None
+
+    def _vectorize_text(self, text: str) -> dict:
+        if self.embedded_vectorizer is not None:
+            try:
+                return self.embedded_vectorizer.vectorize(VectorizeQuery(text=text)).dict()
+            except Exception as e:
+                logging.error(e)
+                if 'NLP_VECTORIZER_HOST' not in os.environ:
+                    raise HTTPException(status_code=500, detail=str(e))
+        body = {'text': text}
+        return self._post(
+            os.environ['NLP_VECTORIZER_HOST']+'/vectorize', body, self.nlp_vectorizer_timeout)
+
+    def _vectorize_texts(self, texts: list) -> dict:
+        if self.embedded_vectorizer is not None:
+            try:
+                return self.embedded_vectorizer.vectorize_batch(VectorizeBatchQuery(texts=texts)).dict()
+            except Exception as e:
+                logging.error(e)
+                if 'NLP_VECTORIZER_HOST' not in os.environ:
+                    raise HTTPException(status_code=500, detail=str(e))
+        body = {'texts': texts}
+        return self._post(
+            os.environ['NLP_VECTORIZER_HOST']+'/vectorizeBatch', body, self.nlp_vectorizer_timeout)
+
+    def _get_cache_key(self, text: str) -> str:
+        # NLP Vectorizer collapses whitespace before encoding so texts differing only by whitespace share a vector
+        return ' '.join(text.split())
+
+    def _refresh_query_vector_cache(self) -> None:
+        # A new vectorizer model is taken into use with newly vectorized services, so vectors cached before the catalog
+        # changed may come from the previous model which is only noticed from the model of a missed query
+        catalog_generation = self.db.catalog.generation
+        if catalog_generation != self.query_vector_catalog_generation:
+            self.query_vector_cache.clear()
+            self.query_vector_catalog_generation = catalog_generation
+
+    def _set_cached_vector(self, cache_key: str, text_vector: list, model: Optional[str]) -> None:
+        # Vectors of a different model aren't comparable so flush the cache if the model changes
+        if model != self.nlp_model_name:
+            self.query_vector_cache.clear()
+            self.nlp_model_name = model
+        self.query_vector_cache.set(cache_key, text_vector)
 
     def _nlp_vectorize_text(self, text: str) -> list:
-        body = {'text': text}
-        r = requests.post(
-            os.environ['NLP_VECTORIZER_HOST']+'/vectorize', json=body)
+        self._refresh_query_vector_cache()
+        cache_key = self._get_cache_key(text)
+        text_vector = self.query_vector_cache.get(cache_key)
+        if text_vector is not None:
+            return(text_vector)
+
+        response = self._vectorize_text(text)
+        text_vector = response['vector']
+        self._set_cached_vector(cache_key, text_vector, response.get('model'))
+        return(text_vector)
+
+    def _nlp_vectorize_texts(self, texts: list) -> list:
+        self._refresh_query_vector_cache()
+        cache_keys = [self._get_cache_key(text) for text in texts]
+        text_vectors = {}
+        for cache_key in set(cache_keys):
+            text_vector = self.query_vector_cache.get(cache_key)
+            if text_vector is not None:
+                text_vectors[cache_key] = text_vector
+
+        # Texts missing from the cache are vectorized in batches
+        missing_keys = [cache_key for cache_key in dict.fromkeys(cache_keys) if cache_key not in text_vectors]
+        for start in range(0, len(missing_keys), self.nlp_vectorizer_batch_size):
+            batch_keys = missing_keys[start:start+self.nlp_vectorizer_batch_size]
+            response = self._vectorize_texts(batch_keys)
+            for cache_key, text_vector in zip(batch_keys, response['vectors']):
+                self._set_cached_vector(cache_key, text_vector, response.get('model'))
+                text_vectors[cache_key] = text_vector
+        return([text_vectors[cache_key] for cache_key in cache_keys])
+
+    def _post(self, url: str, body: dict, timeout: float) -> dict:
+        try:
+            r = self.api_session.post(url, json=body, timeout=timeout)
+        except requests.exceptions.Timeout as e:
+            logging.error(e)
+            raise HTTPException(status_code=504, detail=str(e))
+        except requests.exceptions.RequestException as e:
+            logging.error(e)
+            raise HTTPException(status_code=500, detail=str(e))
         if r.status_code != 200:
             logging.error(r.text)
             raise HTTPException(status_code=500, detail=r.text)
-        text_vector = r.json()['vector']
-        return(text_vector)
+        return r.json()
 
-    def _get_service_vectors_and_filters(self, vector: list, municipalities: list, life_events: list, service_classes: list, match_service_classes: bool) -> Tuple[list, list]:
+    def _get_service_filter_mask(self, vector: list, municipalities: list, life_events: list, service_classes: list, match_service_classes: bool) -> np.ndarray:
         if match_service_classes:
             n_classes = len(self.db._get_all_service_classes())
             top_70_percent_classes = math.ceil(0.7*n_classes)
@@ -56,85 +178,111 @@ class FreeTextRecommender():
                 top_k_service_class_scores.keys())
             filtered_service_class_recommendations = list(
                 set(service_classes).intersection(set(service_class_recommendations)))
-            service_desc_vectors = self.db._get_service_desc_vectors(
+            service_mask = self.db._get_service_filter_mask(
                 filtered_service_class_recommendations, municipalities, life_events)
         else:
-            service_desc_vectors = self.db._get_service_desc_vectors(
+            service_mask = self.db._get_service_filter_mask(
                 service_class_codes_filter=service_classes, municipality_ids_filter=municipalities, life_events_filter=life_events)
 
-        filter_service_ids = [service["id"]
-                              for service in service_desc_vectors]
-
-        return service_desc_vectors, filter_service_ids
+        return service_mask
 
     def _get_service_class_scores_by_nlp_search(self, vector: list) -> Tuple[dict, dict]:
-        service_class_vectors = self.db._get_service_class_vectors()
-        vectors_array = np.array([service_class["vector"]
-                                 for service_class in service_class_vectors])
-        if len(vectors_array.shape) == 1:
-            vectors_array.shape = (0, len(vector))
-        dot_products = np.dot(
-            np.array(vector), vectors_array.T).tolist()
-
-        scores = {service_class_vectors[idx]["code"]: dot_products[idx] for idx in range(
-            len(dot_products))}
-        names = {service_class["code"]: service_class["name"]
-                 for service_class in service_class_vectors}
+        service_class_catalog = self.db.service_class_catalog
+        dot_products = service_class_catalog.get_scores(vector).tolist()
+        scores = dict(zip(service_class_catalog.codes, dot_products))
+        names = dict(zip(service_class_catalog.codes, service_class_catalog.names))
         return(scores, names)
 
-    def _get_service_scores_by_lexical_text_search(self, text: str, language: str, filter_service_ids: list) -> dict:
-        # set top_k to 0 to get scores for all services
-        body = {'text': text, 'language': language,'top_k': 0}
-        r = requests.post(
-            os.environ['LEXICAL_TEXT_SEARCH_HOST']+'/searchServices', json=body)
-        if r.status_code != 200:
-            logging.error(r.text)
-            raise HTTPException(status_code=500, detail=r.text)
-        services = r.json()['services']
-
-        scores = {service["id"]: service["score"]
-                  for service in services if service["id"] in filter_service_ids}
+    def _search_services_lexically(self, text: str, language: str, service_mask: np.ndarray, top_k: int = 0) -> list:
+        # set top_k to 0 to get scores for all candidate services, candidates are sent only if filters limit them
+        body = {'text': text, 'language': language, 'top_k': top_k}
+        if not service_mask.all():
+            body['service_ids'] = self.db.catalog.ids[service_mask].tolist()
+        response = self._post(
+            os.environ['LEXICAL_TEXT_SEARCH_HOST']+'/searchServiceIds', body, self.lexical_text_search_timeout)
+        return(response['services'])
+
+    def _get_service_scores_by_lexical_text_search(self, services: list, service_mask: np.ndarray) -> np.ndarray:
+        # Scatter scores to catalog rows, services filtered out or not found have NaN score
+        row_index = self.db.catalog.row_index
+        scores = np.full(len(service_mask), np.nan)
+        for service in services:
+            row = row_index.get(service["id"])
+            if row is not None and service_mask[row]:
+                scores[row] = service["score"]
         return(scores)
 
-    def _get_service_scores_by_nlp_search(self, vector: list, service_desc_vectors: list) -> dict:
-        vectors_array = np.array([service["vector"]
-                                 for service in service_desc_vectors])
-        if len(vectors_array.shape) == 1:
-            vectors_array.shape = (0, len(vector))
-
-        # get cosine similarity between query vector and service vectors
-        dot_products = np.dot(
-            np.array(vector), vectors_array.T).tolist()
-
-        scores = {service_desc_vectors[idx]["id"]: dot_products[idx]
-                  for idx in range(len(dot_products))}
+    def _get_service_scores_by_nlp_search(self, vector: list, service_mask: np.ndarray, top_k: int = 0) -> np.ndarray:
+        # Scores are aligned to catalog rows, services filtered out have NaN score
+        # If top_k is given, services outside the nearest neighbours found by the ANN index may also have NaN score
+        scores = self.db.catalog.get_masked_scores(
+            vector, service_mask, top_k, self.exact_search_max_candidates)
         return (scores)
 
-    def _combine_nlp_and_lexical_scores(self, nlp_scores: dict, lexical_scores: dict) -> dict:
-        combined_scores = {}
-
-        top_10_nlp = self._get_top_k_scores(nlp_scores, 10)
-        top_10_lexical = self._get_top_k_scores(lexical_scores, 10)
+    def _combine_nlp_and_lexical_scores(self, nlp_scores: np.ndarray, lexical_scores: np.ndarray) -> np.ndarray:
+        has_nlp_score = ~np.isnan(nlp_scores)
+        has_lexical_score = ~np.isnan(lexical_scores)
 
-        for service_id in set(nlp_scores) | set(lexical_scores):
-            nlp_score = nlp_scores.get(service_id, 0.01) * 100
-            lexical_score = lexical_scores.get(service_id, 1) if lexical_scores.get(service_id, 1) > 0 else 1
+        top_10_nlp = np.zeros(len(nlp_scores), dtype=bool)
+        top_10_nlp[self._get_top_k_indices(nlp_scores, 10)] = True
+        top_10_lexical = np.zeros(len(lexical_scores), dtype=bool)
+        top_10_lexical[self._get_top_k_indices(lexical_scores, 10)] = True
 
-            if service_id in top_10_nlp:
-                nlp_score = nlp_score * nlp_score
-            if service_id in top_10_lexical and lexical_score >= 55:
-                lexical_score = lexical_score * lexical_score
+        nlp_score = np.where(has_nlp_score, nlp_scores, 0.01) * 100
+        lexical_score = np.where(lexical_scores > 0, lexical_scores, 1)
 
-            combined_scores[service_id] = nlp_score * lexical_score
+        nlp_score = np.where(top_10_nlp, nlp_score * nlp_score, nlp_score)
+        lexical_score = np.where(top_10_lexical & (lexical_score >= 55), lexical_score * lexical_score, lexical_score)
 
+        combined_scores = np.where(has_nlp_score | has_lexical_score, nlp_score * lexical_score, np.nan)
         return combined_scores
 
-    def _get_top_k_scores(self, scores: dict, top_k: int, score_threshold: float = 0.0) -> OrderedDict:
-        if len(scores) < top_k:
-            top_k = len(scores)
+    def _get_top_k_indices(self, scores: np.ndarray, top_k: int, score_threshold: float = 0.0) -> np.ndarray:
+        # Apply threshold before selection so that top_k results are returned whenever enough scores pass it
+        candidates = np.flatnonzero(scores >= score_threshold)
+        if top_k <= 0:
+            return candidates[:0]
+        if len(candidates) > top_k:
+            # Scores tied with the k-th score are taken in index order, like the stable sort of all scores would
+            candidate_scores = scores[candidates]
+            kth_score = np.partition(candidate_scores, len(candidates) - top_k)[len(candidates) - top_k]
+            above = candidates[candidate_scores > kth_score]
+            tied = candidates[candidate_scores == kth_score][:top_k - len(above)]
+            candidates = np.concatenate([above, tied])
+        return candidates[np.lexsort((candidates, -scores[candidates]))]
 
-        top_k_keys = heapq.nlargest(top_k, scores, key=scores.get)
-        return OrderedDict((key, scores[key]) for key in top_k_keys if scores[key] >= score_threshold)
+    def _get_top_k_scores(self, scores: dict, top_k: int, score_threshold: float = 0.0) -> OrderedDict:
+        keys = list(scores.keys())
+        values = np.fromiter(scores.values(), dtype=np.float64, count=len(keys))
+        top_k_indices = self._get_top_k_indices(values, top_k, score_threshold)
+        return OrderedDict((keys[idx], scores[keys[idx]]) for idx in top_k_indices)
+
+    def _get_top_k_service_scores(self, scores: np.ndarray, top_k: int, score_threshold: float = 0.0) -> OrderedDict:
+        top_k_rows = self._get_top_k_indices(scores, top_k, score_threshold)
+        return OrderedDict(zip(self.db.catalog.ids[top_k_rows].tolist(), scores[top_k_rows].tolist()))
+
+    def _submit_lexical_search(self, text: str, language: str, text_recommender: str, candidate_mask: np.ndarray, match_service_classes: bool, top_k: int):
+        # Lexical search doesn't depend on the text vector so it runs concurrently with the vectorization
+        if text_recommender not in ["lexical", "all"]:
+            return None
+        # Combining scores needs lexical scores of all candidates and top k is exact only if the candidates are final
+        lexical_top_k = top_k if text_recommender == "lexical" and not match_service_classes else 0
+        # The search runs in the context of the request so it uses the catalog pinned for the request
+        return self.executor.submit(contextvars.copy_context().run,
+            self._search_services_lexically, text, language, candidate_mask, lexical_top_k)
+
+    def _get_top_k_service_scores_by_recommender(self, text_recommender: str, service_mask: np.ndarray, top_k: int, score_threshold: float, nlp_scores: Optional[np.ndarray] = None, lexical_services: Optional[list] = None) -> OrderedDict:
+        if text_recommender == "lexical":
+            scores = self._get_service_scores_by_lexical_text_search(
+                lexical_services, service_mask)
+        elif text_recommender == "nlp":
+            scores = nlp_scores
+        else:
+            lexical_scores = self._get_service_scores_by_lexical_text_search(
+                lexical_services, service_mask)
+            scores = self._combine_nlp_and_lexical_scores(
+                nlp_scores, lexical_scores)
+        return self._get_top_k_service_scores(scores, top_k, score_threshold)
 
     def recommend_services(self, text: str, municipalities: list, life_events: list, service_classes: list, match_service_classes: bool, top_k: int, score_threshold: float, text_recommender="all", language=None) -> dict:
         if not language:
@@ -146,31 +294,54 @@ class FreeTextRecommender():
         #    text_recommender_checked = text_recommender
         text_recommender_checked = text_recommender
             
+        # Matching service classes can only narrow down the filtered services
+        candidate_mask = self.db._get_service_filter_mask(
+            service_class_codes_filter=service_classes, municipality_ids_filter=municipalities, life_events_filter=life_events)
+        lexical_search = self._submit_lexical_search(
+            text, language, text_recommender_checked, candidate_mask, match_service_classes, top_k)
+
         # for filtering service classes, let's only use NLP matching so we need to vectorize text anyway even though only lexical service search were used
         vector = self._nlp_vectorize_text(text)
-        service_desc_vectors, filter_service_ids = self._get_service_vectors_and_filters(
-            vector, municipalities, life_events, service_classes, match_service_classes)
-
-        if text_recommender_checked == "lexical":
-            lexical_scores = self._get_service_scores_by_lexical_text_search(
-                text, language, filter_service_ids)
-            top_k_scores = self._get_top_k_scores(
-                lexical_scores, top_k, score_threshold)
-        elif text_recommender_checked == "nlp":
-            nlp_scores = self._get_service_scores_by_nlp_search(
-                vector, service_desc_vectors)
-            top_k_scores = self._get_top_k_scores(
-                nlp_scores, top_k, score_threshold)
+        if match_service_classes:
+            service_mask = self._get_service_filter_mask(
+                vector, municipalities, life_events, service_classes, match_service_classes)
         else:
-            lexical_scores = self._get_service_scores_by_lexical_text_search(
-                text, language, filter_service_ids)
-            nlp_scores = self._get_service_scores_by_nlp_search(
-                vector, service_desc_vectors)
-            combined_scores = self._combine_nlp_and_lexical_scores(
-                nlp_scores, lexical_scores)
-            top_k_scores = self._get_top_k_scores(
-                combined_scores, top_k, score_threshold)
+            service_mask = candidate_mask
 
+        nlp_scores = None
+        if text_recommender_checked != "lexical":
+            # Only nlp top k can be searched approximately, combining scores needs all nlp scores
+            nlp_scores = self._get_service_scores_by_nlp_search(
+                vector, service_mask, top_k if text_recommender_checked == "nlp" else 0)
+        lexical_services = lexical_search.result() if lexical_search is not None else None
+
+        return self._get_top_k_service_scores_by_recommender(
+            text_recommender_checked, service_mask, top_k, score_threshold, nlp_scores, lexical_services)
+
+    def recommend_services_batch(self, queries: list, batch_size: int = 64) -> list:
+        # Each query is a dict of the recommend_services arguments
+        candidate_masks = [self.db._get_service_filter_mask(
+            service_class_codes_filter=query["service_classes"], municipality_ids_filter=query["municipalities"], life_events_filter=query["life_events"])
+            for query in queries]
+        lexical_searches = [self._submit_lexical_search(
+            query["text"], query.get("language") or "fi", query.get("text_recommender", "all"), candidate_mask, query["match_service_classes"], query["top_k"])
+            for query, candidate_mask in zip(queries, candidate_masks)]
+
+        vectors = self._nlp_vectorize_texts([query["text"] for query in queries])
+        service_masks = [self._get_service_filter_mask(vector, query["municipalities"], query["life_events"], query["service_classes"], True)
+                         if query["match_service_classes"] else candidate_mask
+                         for query, vector, candidate_mask in zip(queries, vectors, candidate_masks)]
+
+        # Queries are scored in batches of one matrix product to bound the size of the score matrix
+        top_k_scores = []
+        for start in range(0, len(queries), batch_size):
+            nlp_scores = self.db.catalog.get_masked_scores_batch(
+                np.array(vectors[start:start+batch_size]), np.array(service_masks[start:start+batch_size]))
+            for idx in range(start, min(start+batch_size, len(queries))):
+                lexical_services = lexical_searches[idx].result() if lexical_searches[idx] is not None else None
+                top_k_scores.append(self._get_top_k_service_scores_by_recommender(
+                    queries[idx].get("text_recommender", "all"), service_masks[idx], queries[idx]["top_k"], queries[idx]["score_threshold"],
+                    nlp_scores[idx - start], lexical_services))
         return top_k_scores
 
     def recommend_service_classes(self, text: str, top_k: int) -> list:
@@ -0,0 +1,128 @@
+import ast
+import operator
+import numpy as np
+from typing import Union
+
+
+COMPARE_OPERATORS = {ast.Lt: operator.lt, ast.LtE: operator.le, ast.Gt: operator.gt,
+                     ast.GtE: operator.ge, ast.Eq: operator.eq, ast.NotEq: operator.ne}
+BINARY_OPERATORS = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv}
+UNARY_OPERATORS = {ast.USub: operator.neg, ast.UAdd: operator.pos, ast.Not: np.logical_not}
+
+
+class PolicyExpression():
+    """
+    A class for safe evaluation of Botfront policy trigger expressions over intent confidences
+
+    The expression is parsed once and only comparisons, arithmetic, boolean operators, numbers and
+    indexing of confidences with a constant are allowed. It is evaluated for many intent rankings at once
+    over a matrix of confidences where missing confidences are NaN, which makes comparisons with them False.
+
+    Args
+    ----------
+    expression : str
+        Python expression of confidences, for example 'confidences[0] < 2 * confidences[1]'
+
+
+    Methods
+    -------
+    evaluate(confidences: np.ndarray)
+        Returns the value of the expression for each row of the confidence matrix
+
+    __call__(confidences: list)
+        Returns the value of the expression for a single list of confidences
+
+    """
+
+    def __init__(self, expression: str) -> None:
+        self.expression = expression
+        self.tree = ast.parse(expression.strip(), mode="eval").body
+        self._validate(self.tree)
+
+    def __eq__(self, other: object) -> bool:
+        # Parsed expressions are compared by their source, so reparsed policies of the same triggers are equal
+        return isinstance(other, PolicyExpression) and other.expression == self.expression
+
+    def __hash__(self) -> int:
+        return hash(self.expression)
+
+    def _get_index(self, node: ast.Subscript) -> ast.AST:
+        # Python 3.8 wraps the index in ast.Index
+        if type(node.slice).__name__ == 'Index':
+            return node.slice.value
+        return node.slice
+
+    def _validate(self, node: ast.AST) -> None:
+        if isinstance(node, ast.Compare):
+            if not all(type(op) in COMPARE_OPERATORS for op in node.ops):
+                raise ValueError(f"Unsupported comparison in policy expression {self.expression}")
+            children = [node.left] + node.comparators
+        elif isinstance(node, ast.BoolOp):
+            children = node.values
+        elif isinstance(node, ast.BinOp):
+            if type(node.op) not in BINARY_OPERATORS:
+                raise ValueError(f"Unsupported operator in policy expression {self.expression}")
+            children = [node.left, node.right]
+        elif isinstance(node, ast.UnaryOp):
+            if type(node.op) not in UNARY_OPERATORS:
+                raise ValueError(f"Unsupported operator in policy expression {self.expression}")
+            children = [node.operand]
+        elif isinstance(node, ast.Constant):
+            if not isinstance(node.value, (int, float)):
+                raise ValueError(f"Unsupported constant in policy expression {self.expression}")
+            children = []
+        elif isinstance(node, ast.Subscript):
+            index = self._get_index(node)
+            if not (isinstance(node.value, ast.Name) and node.value.id == 'confidences' and
+                    isinstance(index, ast.Constant) and type(index.value) == int and index.value >= 0):
+                raise ValueError(f"Only confidences can be indexed with a number in policy expression {self.expression}")
+            children = []
+        else:
+            raise ValueError(f"Unsupported element {type(node).__name__} in policy expression {self.expression}")
+        for child in children:
+            self._validate(child)
+
+    def _evaluate_node(self, node: ast.AST, confidences: np.ndarray) -> Union[np.ndarray, float]:
+        if isinstance(node, ast.Compare):
+            result = np.ones(len(confidences), dtype=bool)
+            left = self._evaluate_node(node.left, confidences)
+            for op, comparator in zip(node.ops, node.comparators):
+                right = self._evaluate_node(comparator, confidences)
+                result &= COMPARE_OPERATORS[type(op)](left, right)
+                left = right
+            return result
+        if isinstance(node, ast.BoolOp):
+            combine = np.logical_and if isinstance(node.op, ast.And) else np.logical_or
+            values = [np.asarray(self._evaluate_node(value, confidences), dtype=bool) for value in node.values]
+            result = values[0]
+            for value in values[1:]:
+                result = combine(result, value)
+            return result
+        if isinstance(node, ast.BinOp):
+            return BINARY_OPERATORS[type(node.op)](self._evaluate_node(node.left, confidences),
+                                                   self._evaluate_node(node.right, confidences))
+        if isinstance(node, ast.UnaryOp):
+            return UNARY_OPERATORS[type(node.op)](self._evaluate_node(node.operand, confidences))
+        if isinstance(node, ast.Constant):
+            return node.value
+        index = self._get_index(node)
+        if index.value >= confidences.shape[1]:
+            return np.full(len(confidences), np.nan)
+        return confidences[:, index.value]
+
+    def evaluate(self, confidences: np.ndarray) -> np.ndarray:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result = self._evaluate_node(self.tree, confidences)
+        return np.broadcast_to(np.asarray(result, dtype=bool), (len(confidences),))
+
+    def __call__(self, confidences: list) -> bool:
+        return bool(self.evaluate(get_confidence_matrix([confidences]))[0])
+
+
+def get_confidence_matrix(rankings: list) -> np.ndarray:
+    # Rankings have different lengths, missing confidences are NaN
+    width = max([len(ranking) for ranking in rankings] + [1])
+    confidences = np.full((len(rankings), width), np.nan)
+    for row, ranking in enumerate(rankings):
+        confidences[row, :len(ranking)] = ranking
+    return confidences
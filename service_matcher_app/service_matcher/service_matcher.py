@@ -1,10 +1,18 @@
 import re
+import os
+import json
+import threading
+import logging
 from pymongo import MongoClient
 from .models import *
 from .utils import *
 from .db import *
 from .free_text_recommender import *
-from typing import Optional
+from .cache import LRUCache
+from .fragments import JSONFragmentCache
+from .watcher import CatalogWatcher
+from .conversation import ConversationParser
+from typing import Any, Optional
 
 class ServiceMatcher():
     """
@@ -33,22 +41,153 @@ class ServiceMatcher():
     get_service_recommendations( serviceRecommendQuery: ServiceRecommendQuery )
         Get service recommendations by free text parameters given to the function
 
+    get_service_recommendations_batch( serviceRecommendQueries: list )
+        Get service recommendations for a list of free text queries
+
     get_service_class_recommendations_by_conversation( conversation_id: str, serviceClassRecommendConversationQuery: ServiceClassRecommendConversationQuery )
         Get service class recommendations by conversation ID
 
     get_service_class_recommendations( serviceClassRecommendQuery: ServiceClassRecommendQuery )
         Get service class recommendations by free text
 
+    get_cache_stats()
+        Get hit, miss, eviction and memory statistics of the in-memory caches
+
+    update_desc_vectors()
+        Synchronize vectors, translations, services and intents changed in the database
+
+    update_desc_vectors_in_background()
+        Start synchronization in a background thread, requests are served from the previous data until it's done
+
+    update_intents()
+        Reload intent to services mappings from the database
+
+    refresh_catalog()
+        Swap to the newest catalog snapshot if another worker has written one and start a sync if the processor has written new data
+
+    encode_response(content: Any)
+        Encode a response to JSON bytes using pre-encoded fragments of services and channels
+
     """
 
     def __init__(self, mongo_client: Optional[MongoClient] = None) -> None:
         self.db = ServiceMatcherDB(mongo_client)
         self.utils = ServiceMatcherUtils()
         self.free_text_recommender = FreeTextRecommender(self.db)
+        self.conversation_parser = ConversationParser(
+            self.utils,
+            max_size=int(os.environ.get('CONVERSATION_STATE_CACHE_SIZE', 10000)),
+            ttl=float(os.environ.get('CONVERSATION_STATE_CACHE_TTL', 3600)))
+        self.response_cache = LRUCache(
+            max_size=int(os.environ.get('RESPONSE_CACHE_SIZE', 1024)),
+            ttl=float(os.environ.get('RESPONSE_CACHE_TTL', 3600)))
+        self.fragment_cache = JSONFragmentCache(
+            max_size=int(os.environ.get('RESPONSE_FRAGMENT_CACHE_SIZE', 100000)))
+        self._warm_fragment_cache()
+        self._sync_lock = threading.Lock()
+        self._sync_thread = None
+        self._sync_pending = False
+        # Services updated in the database are fetched in the background instead of in the requests
+        self._service_refresh_stopped = threading.Event()
+        if self.db.service_cache_refresh_interval > 0:
+            threading.Thread(target=self._run_service_refresh, daemon=True).start()
+        self.catalog_watcher = None
+        if os.environ.get('CATALOG_WATCH_MODE', 'none') != 'none':
+            # Every replica follows the database itself instead of relying on /syncVectors reaching it
+            self.catalog_watcher = CatalogWatcher(self.db.mongo_client, self.update_desc_vectors_in_background, self.update_intents,
+                                                  mode=os.environ['CATALOG_WATCH_MODE'],
+                                                  interval=float(os.environ.get('CATALOG_WATCH_INTERVAL', 5)))
+            self.catalog_watcher.start()
             
     def update_desc_vectors(self) -> None:
-        self.db._update_desc_vectors()
-        self.db._update_translations()
+        self.db._sync()
+        # Responses cached before the update are never served again
+        self.response_cache.clear()
+        self._warm_fragment_cache()
+
+    def update_desc_vectors_in_background(self) -> None:
+        # Syncs requested while one is running are combined into one more sync after it
+        with self._sync_lock:
+            if self._sync_thread is not None and self._sync_thread.is_alive():
+                self._sync_pending = True
+                return
+            self._sync_thread = threading.Thread(target=self._run_background_sync, daemon=True)
+            self._sync_thread.start()
+
+    def _run_background_sync(self) -> None:
+        while True:
+            try:
+                self.update_desc_vectors()
+            except Exception as e:
+                logging.error(f"Could not synchronize service matcher: {e}")
+            with self._sync_lock:
+                if not self._sync_pending:
+                    return
+                self._sync_pending = False
+
+    def _run_service_refresh(self) -> None:
+        while not self._service_refresh_stopped.wait(self.db.service_cache_refresh_interval):
+            try:
+                self.db._refresh_service_documents()
+            except Exception as e:
+                logging.error(f"Could not refresh cached services: {e}")
+
+    def _warm_fragment_cache(self) -> None:
+        # Every variant of the cached services and channels is encoded once per sync
+        self.fragment_cache.clear()
+        self.fragment_cache.warm(list(self.db.services_by_id.values()) + list(self.db.translated_services_by_id.values()) +
+                                 list(self.db.channels_by_id.values()))
+
+    def _filter_service_data_by_municipality(self, service: Service, municipality_ids: list) -> Service:
+        return self.fragment_cache.get_shaped(service, municipality_ids, self.utils._filter_service_data_by_municipality)
+
+    def _filter_service_channel_data_by_municipality(self, channel: ServiceChannel, municipality_ids: list) -> ServiceChannel:
+        return self.fragment_cache.get_shaped(channel, municipality_ids, self.utils._filter_service_channel_data_by_municipality)
+
+    def encode_response(self, content: Any) -> bytes:
+        return self.fragment_cache.encode(content)
+
+    def update_intents(self) -> None:
+        self.db._update_intents()
+        self.db.policy_filter_cache.clear()
+
+    def refresh_catalog(self) -> None:
+        self.db._refresh_catalog_snapshot()
+        # /syncVectors of the processor reaches only one replica, the others notice the new generation here
+        if self.db._refresh_database_generation():
+            self.update_desc_vectors_in_background()
+
+    def _get_response_cache_key(self, name: str, query: BaseModel) -> tuple:
+        query_dict = query.dict()
+        if query_dict.get("need_text") is not None:
+            # Both vectorizer and lexical search ignore repeated whitespace
+            query_dict["need_text"] = ' '.join(query_dict["need_text"].split())
+        # Generation of the pinned catalog is used, the current one may already be newer than the catalog the response is made from
+        return (name, self.db.catalog.generation, self.db.service_cache["generation"], self.db.intent_generation,
+                json.dumps(query_dict, sort_keys=True))
+
+    def _get_cached_response(self, name: str, query: BaseModel, get_response) -> list:
+        # Workers share catalog snapshots, a snapshot written by a sync in another worker is taken into use here
+        self.refresh_catalog()
+        # The response is made from one catalog even if a sync publishes a new one meanwhile
+        with self.db.pin_catalog():
+            cache_key = self._get_response_cache_key(name, query)
+            response = self.response_cache.get(cache_key)
+            if response is None:
+                response = get_response()
+                self.response_cache.set(cache_key, response)
+        return(list(response))
+
+    def get_cache_stats(self) -> dict:
+        response_cache_stats = self.response_cache.get_stats()
+        # Memory is estimated from the size of the cached responses as JSON
+        response_cache_stats["memory_bytes"] = sum(len(self.encode_response(response))
+                                                   for response in self.response_cache.values())
+        return {"catalog_generation": self.db.catalog_generation,
+                "catalog_snapshot_version": self.db.snapshot_version,
+                "response_cache": response_cache_stats,
+                "query_vector_cache": self.free_text_recommender.query_vector_cache.get_stats(),
+                "fragment_cache": self.fragment_cache.get_stats()}
 
     def get_service(self, service_id: str, translate_missing_texts: bool = False) -> Service:
         return(self.db._get_service(service_id, translate_missing_texts=translate_missing_texts))
@@ -66,6 +205,11 @@ class ServiceMatcher():
         return(self.db._get_all_service_classes())
 
     def get_all_services_filtered(self, serviceQuery: ServiceQuery) -> list:
+        self.refresh_catalog()
+        with self.db.pin_catalog():
+            return(self._get_all_services_filtered(serviceQuery))
+
+    def _get_all_services_filtered(self, serviceQuery: ServiceQuery) -> list:
         
         # Set up values from query
         if len(serviceQuery.municipalities) > 0:
@@ -117,13 +261,13 @@ class ServiceMatcher():
         if len(serviceQuery.municipalities) > 0:
             if serviceQuery.include_channels:
                 final_services = [{
-                "service":self.utils._filter_service_data_by_municipality(
+                "service":self._filter_service_data_by_municipality(
                     service.get("service"), municipality_ids),
-                "channels": [self.utils._filter_service_channel_data_by_municipality(cha, municipality_ids) for cha in service.get("channels")] if (service.get("channels") is not None) else []}
+                "channels": [self._filter_service_channel_data_by_municipality(cha, municipality_ids) for cha in service.get("channels")] if (service.get("channels") is not None) else []}
                 for service in filtered_services]
             else:
                 final_services = [{
-                "service":self.utils._filter_service_data_by_municipality(
+                "service":self._filter_service_data_by_municipality(
                     service.get("service"), municipality_ids)}
                 for service in filtered_services]
         else:
@@ -134,56 +278,22 @@ class ServiceMatcher():
 
     def _get_conversation_info(self, conversation_id: str) -> dict:
 
+        # Activities are fetched while the tracker is fetched and parsed
+        activities_query = self.free_text_recommender.executor.submit(self.db._get_activities_by_conversation, conversation_id)
         conversation = self.db._get_conversation_by_id(conversation_id)
         policy_filters = self.db._get_policy_filters()
-        disambiguation_filter = policy_filters.get('disambiguation')
-        fallback_filter = policy_filters.get('fallback')
         slots = {}
-        events = []
         all_intents = []
         intent_events = []
         if conversation is not None:
             if conversation.get('tracker').get('events') is not None:
-                events = conversation.get('tracker').get('events')
-                # Remove intent reference if the bot is inferring disambiguation or fallback
-                events_mod = []
-                for event in events:
-                    if 'parse_data' in event.keys() and 'intent_ranking' in event['parse_data'].keys() and \
-                            len(event['parse_data']['intent_ranking']) > 1 and \
-                            disambiguation_filter([el['confidence'] for el in event['parse_data']['intent_ranking']]):
-                        event['parse_data']['intent'] = {
-                            'name': 'disambiguation'}
-                    elif 'parse_data' in event.keys() and 'intent_ranking' in event['parse_data'].keys() and \
-                            len(event['parse_data']['intent_ranking']) > 0 and \
-                            fallback_filter([el['confidence'] for el in event['parse_data']['intent_ranking']]):
-                        event['parse_data']['intent'] = {'name': 'fallback'}
-                    else:
-                        pass
-                    events_mod.append(event)
-                events = events_mod
-
-            # Reverse action_execution_rejected and its' previous events order
-            is_excecution_rejected = [
-                evt.get('event') == 'action_execution_rejected' for evt in events]
-            rejected_indices = [i for i, j in enumerate(
-                is_excecution_rejected) if j == True]
-            for ix in rejected_indices:
-                events = self.utils._swap(events, ix - 1, ix)
-            
-            # Nest form events
-            events = self.utils._nest_form_events(events)
-            
+                # Only events added after the previous call for the conversation are parsed
+                intent_events, all_intents = self.conversation_parser.parse(
+                    conversation_id, conversation.get('tracker').get('events'), policy_filters)
+
             # Slots
             if conversation.get('tracker').get('slots') is not None:
                 slots = conversation.get('tracker').get('slots')
-                
-            # Filter in events that are related to user intent or search form intents, skip disambiguations, forms not related to intents etc.
-            intent_events = [event for event in events if
-                          'parse_data' in event.keys() and 'intent' in event.get('parse_data').keys() and \
-                          (re.search('service_search$', event['parse_data']['intent']['name']) is not None or len(self.utils._get_service_classes_from_intent_name(event['parse_data']['intent']['name'])) > 0 or len(self.utils._get_life_events_from_intent_name(event['parse_data']['intent']['name'])) > 0)]
-
-            # Intent names
-            all_intents = [ev.get('parse_data').get('intent').get('name') for ev in intent_events]
 
         # Handle life events' recognition
         if slots is not None and 'life_event' in slots.keys():
@@ -204,7 +314,7 @@ class ServiceMatcher():
             service_classes = self.utils._get_service_classes_from_intent_name(
                 intent)
 
-        activities = self.db._get_activities_by_conversation(conversation_id)
+        activities = activities_query.result()
         messages = []
         for activity in activities:
             text = activity.get('text')
@@ -222,12 +332,15 @@ class ServiceMatcher():
         scored_services = self.free_text_recommender.recommend_services(text, municipalities, life_events, service_classes, match_service_classes, top_k, score_threshold, text_recommender, language)
 
         services = self.db._get_services_by_ids(list(scored_services.keys()), include_channels=True, translate_missing_texts=translate_missing_texts)
+        return(self._create_matches(scored_services, services, municipalities))
+
+    def _create_matches(self, scored_services: dict, services: list, municipalities: list) -> list:
         services = [ser for ser in services if ser.get("service") is not None]
 
         matches = [{
-        "service":self.utils._filter_service_data_by_municipality(
+        "service":self._filter_service_data_by_municipality(
             service.get("service"), municipalities),
-        "channels": [self.utils._filter_service_channel_data_by_municipality(cha, municipalities) for cha in service.get("channels")] if (service.get("channels") is not None) else [],
+        "channels": [self._filter_service_channel_data_by_municipality(cha, municipalities) for cha in service.get("channels")] if (service.get("channels") is not None) else [],
         "score": scored_services.get(service.get("service").id)}
         for service in services]
 
@@ -236,6 +349,11 @@ class ServiceMatcher():
 
     def get_service_recommendations_by_conversation(self, conversation_id: str, serviceRecommendConversationQuery: ServiceRecommendConversationQuery) -> list:
         """Uses conversation info in the database"""
+        self.refresh_catalog()
+        with self.db.pin_catalog():
+            return(self._get_service_recommendations_by_conversation(conversation_id, serviceRecommendConversationQuery))
+
+    def _get_service_recommendations_by_conversation(self, conversation_id: str, serviceRecommendConversationQuery: ServiceRecommendConversationQuery) -> list:
 
         # Set up values from query
         municipalities = None
@@ -275,12 +393,12 @@ class ServiceMatcher():
             
             # Find out text search prefix
             form_events = [ev for ev in conversation_info.get('events') if 'form_events' in ev.keys() and 
-                ('parse_data' in ev.keys() and re.search('service_search$', ev['parse_data']['intent']['name']) is not None)]
+                ('parse_data' in ev.keys() and SERVICE_SEARCH_REGEX.search(ev['parse_data']['intent']['name']) is not None)]
             if len(form_events) > 0:
                 latest_form_events = form_events[-1]['form_events']
             else:
                 latest_form_events = []
-            form_name_prefixes = [re.findall(r'(.*?)service_search_form', event.get('name'))[0] for event in latest_form_events if 'name' in event.keys() and event.get('name') is not None and len(re.findall(r'(.*?)service_search_form', event.get('name'))) > 0]
+            form_name_prefixes = [FORM_NAME_PREFIX_REGEX.findall(event.get('name'))[0] for event in latest_form_events if 'name' in event.keys() and event.get('name') is not None and len(FORM_NAME_PREFIX_REGEX.findall(event.get('name'))) > 0]
             if len(form_name_prefixes) > 0:
                 form_name_prefix = form_name_prefixes[0]
             else:
@@ -309,7 +427,7 @@ class ServiceMatcher():
             form_name_prefix = ''
             if search_on:
                 fts_form_events = events[-1]['form_events']
-                form_name_prefixes = [re.findall(r'(.*?)service_search_form', event.get('name'))[0] for event in fts_form_events if 'name' in event.keys() and event.get('name') is not None and len(re.findall(r'(.*?)service_search_form', event.get('name'))) > 0]
+                form_name_prefixes = [FORM_NAME_PREFIX_REGEX.findall(event.get('name'))[0] for event in fts_form_events if 'name' in event.keys() and event.get('name') is not None and len(FORM_NAME_PREFIX_REGEX.findall(event.get('name'))) > 0]
                 if len(form_name_prefixes) > 0:
                     form_name_prefix = form_name_prefixes[0]
 
@@ -400,6 +518,15 @@ class ServiceMatcher():
             raise Exception("No mode found, something went wrong")
             
     def get_service_recommendations_by_intent(self, serviceRecommendIntentQuery: ServiceRecommendIntentQuery, intentInfo: Optional[dict] = None) -> list:
+        # Intent info from a conversation isn't part of the query so those responses aren't cached
+        if intentInfo:
+            self.refresh_catalog()
+            with self.db.pin_catalog():
+                return(self._get_service_recommendations_by_intent(serviceRecommendIntentQuery, intentInfo))
+        return(self._get_cached_response("intent", serviceRecommendIntentQuery,
+                                         lambda: self._get_service_recommendations_by_intent(serviceRecommendIntentQuery)))
+
+    def _get_service_recommendations_by_intent(self, serviceRecommendIntentQuery: ServiceRecommendIntentQuery, intentInfo: Optional[dict] = None) -> list:
         
         # Get municipality filter
         municipality_ids = self.utils._get_municipality_ids_by_names(
@@ -421,15 +548,15 @@ class ServiceMatcher():
         
         if len(service_ids) > 0:
             # Straight intent matches found
-            filtered_ids = self.db._get_service_ids_by_filters(
-                service_class_codes_filter=service_classes, municipality_ids_filter=municipality_ids, life_events_filter=life_events)
+            filtered_ids = set(self.db._get_service_ids_by_filters(
+                service_class_codes_filter=service_classes, municipality_ids_filter=municipality_ids, life_events_filter=life_events))
 
             services = self.db._get_services_by_ids(service_ids, include_channels=True, translate_missing_texts=serviceRecommendIntentQuery.translate_missing_texts)
             services = [ser for ser in services if ser.get("service") is not None and ser.get("service").id in filtered_ids]
             intent_matches = [{
-            "service":self.utils._filter_service_data_by_municipality(
+            "service":self._filter_service_data_by_municipality(
                 service.get("service"), municipality_ids),
-            "channels": [self.utils._filter_service_channel_data_by_municipality(cha, municipality_ids) for cha in service.get("channels")] if (service.get("channels") is not None) else []}
+            "channels": [self._filter_service_channel_data_by_municipality(cha, municipality_ids) for cha in service.get("channels")] if (service.get("channels") is not None) else []}
             for service in services]
 
             return(intent_matches)
@@ -438,6 +565,14 @@ class ServiceMatcher():
 
 
     def get_service_recommendations_by_intent_and_options(self, serviceRecommendIntentAndOptionsQuery: ServiceRecommendIntentAndOptionsQuery, intentInfo: Optional[dict] = None) -> list:
+        if intentInfo:
+            self.refresh_catalog()
+            with self.db.pin_catalog():
+                return(self._get_service_recommendations_by_intent_and_options(serviceRecommendIntentAndOptionsQuery, intentInfo))
+        return(self._get_cached_response("intent_and_options", serviceRecommendIntentAndOptionsQuery,
+                                         lambda: self._get_service_recommendations_by_intent_and_options(serviceRecommendIntentAndOptionsQuery)))
+
+    def _get_service_recommendations_by_intent_and_options(self, serviceRecommendIntentAndOptionsQuery: ServiceRecommendIntentAndOptionsQuery, intentInfo: Optional[dict] = None) -> list:
         
         # Get municipality filter
         municipality_ids = self.utils._get_municipality_ids_by_names(
@@ -455,6 +590,7 @@ class ServiceMatcher():
         else:
             intent_recommendation_obj = intentInfo
         service_ids = intent_recommendation_obj.get("services")
+        intent_service_ids = set(service_ids)
         text = serviceRecommendIntentAndOptionsQuery.need_text
         if not text:
             text = intent_recommendation_obj.get("intent_text")
@@ -483,15 +619,15 @@ class ServiceMatcher():
         # Fetch services by intent
         if len(service_ids) > 0:
             # Straight intent matches found
-            filtered_ids = self.db._get_service_ids_by_filters(
-                service_class_codes_filter=all_service_classes, municipality_ids_filter=municipality_ids, life_events_filter=life_events)
+            filtered_ids = set(self.db._get_service_ids_by_filters(
+                service_class_codes_filter=all_service_classes, municipality_ids_filter=municipality_ids, life_events_filter=life_events))
 
             services = self.db._get_services_by_ids(service_ids, include_channels=True, translate_missing_texts=serviceRecommendIntentAndOptionsQuery.translate_missing_texts)
             services = [ser for ser in services if ser.get("service") is not None and ser.get("service").id in filtered_ids]
             intent_matches = [{
-            "service":self.utils._filter_service_data_by_municipality(
+            "service":self._filter_service_data_by_municipality(
                 service.get("service"), municipality_ids),
-            "channels": [self.utils._filter_service_channel_data_by_municipality(cha, municipality_ids) for cha in service.get("channels")] if (service.get("channels") is not None) else []}
+            "channels": [self._filter_service_channel_data_by_municipality(cha, municipality_ids) for cha in service.get("channels")] if (service.get("channels") is not None) else []}
             for service in services]
             combined_matches = intent_matches
 
@@ -506,7 +642,7 @@ class ServiceMatcher():
                     text_matches = self._get_matching_services(
                         text, municipality_ids, life_events, all_service_classes, False, serviceRecommendIntentAndOptionsQuery.limit_k + len(intent_matches), serviceRecommendIntentAndOptionsQuery.score_threshold, serviceRecommendIntentAndOptionsQuery.text_recommender, serviceRecommendIntentAndOptionsQuery.language, translate_missing_texts=serviceRecommendIntentAndOptionsQuery.translate_missing_texts)                    
             # Filter out duplicates
-            filtered_text_matches = [ser for ser in text_matches if not (ser.get('service').id in service_ids)]
+            filtered_text_matches = [ser for ser in text_matches if not (ser.get('service').id in intent_service_ids)]
             filtered_text_matches = filtered_text_matches[0:serviceRecommendIntentAndOptionsQuery.limit_k]
             combined_matches = combined_matches + filtered_text_matches
 
@@ -525,7 +661,7 @@ class ServiceMatcher():
                                                                                translate_missing_texts=serviceRecommendIntentAndOptionsQuery.translate_missing_texts))
 
             # Filter out duplicates
-            filtered_class_matches = [ser for ser in class_matches if not (ser.get('service').id in service_ids)]
+            filtered_class_matches = [ser for ser in class_matches if not (ser.get('service').id in intent_service_ids)]
             filtered_class_matches = filtered_class_matches[0:serviceRecommendIntentAndOptionsQuery.limit_k]
             combined_matches = combined_matches + filtered_class_matches
 
@@ -534,6 +670,10 @@ class ServiceMatcher():
 
               
     def get_service_recommendations(self, serviceRecommendQuery: ServiceRecommendQuery) -> list:
+        return(self._get_cached_response("recommend", serviceRecommendQuery,
+                                         lambda: self._get_service_recommendations(serviceRecommendQuery)))
+
+    def _get_service_recommendations(self, serviceRecommendQuery: ServiceRecommendQuery) -> list:
 
         # Get municipality filter
         municipality_ids = self.utils._get_municipality_ids_by_names(
@@ -554,6 +694,52 @@ class ServiceMatcher():
             matches = []
         return(matches)
 
+    def get_service_recommendations_batch(self, serviceRecommendQueries: list) -> list:
+        self.refresh_catalog()
+        with self.db.pin_catalog():
+            return(self._get_service_recommendations_batch(serviceRecommendQueries))
+
+    def _get_service_recommendations_batch(self, serviceRecommendQueries: list) -> list:
+        queries = []
+        for serviceRecommendQuery in serviceRecommendQueries:
+            if serviceRecommendQuery.need_text is None or serviceRecommendQuery.need_text == '':
+                continue
+            queries.append({
+                "text": serviceRecommendQuery.need_text,
+                "municipalities": self.utils._get_municipality_ids_by_names(
+                    serviceRecommendQuery.municipalities, self.db._get_all_municipalities()),
+                "life_events": self.utils._check_life_events(
+                    serviceRecommendQuery.life_events, self.db._get_all_life_event_codes()),
+                "service_classes": self.utils._check_service_classes(
+                    serviceRecommendQuery.service_classes, self.db._get_all_service_classes()),
+                "match_service_classes": False,
+                "top_k": serviceRecommendQuery.top_k,
+                "score_threshold": serviceRecommendQuery.score_threshold,
+                "text_recommender": serviceRecommendQuery.text_recommender,
+                "language": serviceRecommendQuery.language,
+                "translate_missing_texts": serviceRecommendQuery.translate_missing_texts})
+        scored_services_batch = self.free_text_recommender.recommend_services_batch(queries)
+
+        # Union of the recommended services is fetched once, or once per translation option used
+        services_by_id = {}
+        for translate_missing_texts in set(query["translate_missing_texts"] for query in queries):
+            service_ids = list(dict.fromkeys(service_id for query, scored_services in zip(queries, scored_services_batch)
+                                             if query["translate_missing_texts"] == translate_missing_texts for service_id in scored_services))
+            services = self.db._get_services_by_ids(service_ids, include_channels=True, translate_missing_texts=translate_missing_texts)
+            services_by_id[translate_missing_texts] = {service["service"].id: service for service in services}
+
+        matches_batch = []
+        query_iter = iter(zip(queries, scored_services_batch))
+        for serviceRecommendQuery in serviceRecommendQueries:
+            if serviceRecommendQuery.need_text is None or serviceRecommendQuery.need_text == '':
+                matches_batch.append([])
+                continue
+            query, scored_services = next(query_iter)
+            services = [services_by_id[query["translate_missing_texts"]][service_id] for service_id in scored_services
+                        if service_id in services_by_id[query["translate_missing_texts"]]]
+            matches_batch.append(self._create_matches(scored_services, services, query["municipalities"]))
+        return(matches_batch)
+
     def get_service_class_recommendations_by_conversation(self, conversation_id: str, serviceClassRecommendConversationQuery: ServiceClassRecommendConversationQuery) -> list:
 
         conversation_info = self._get_conversation_info(conversation_id)
@@ -0,0 +1,155 @@
+import os
+import json
+import fcntl
+import time
+import shutil
+import tempfile
+import logging
+import numpy as np
+from bson import json_util
+from contextlib import contextmanager
+from typing import Optional
+from .catalog import ServiceCatalog, FILTER_DIMENSIONS
+
+
+class CatalogSnapshotStore():
+    """
+    A class for versioned on-disk snapshots of the service catalog shared by service matcher workers
+
+    A snapshot is a directory of numpy arrays which workers memory-map read-only, so the vectors and filter index
+    are in memory only once regardless of the number of workers. A snapshot is written to a temporary directory
+    and renamed, and then the CURRENT file pointing to it is replaced, so readers never see a partial snapshot.
+    Workers take a file lock before writing so that one of them writes a snapshot of a database generation and
+    the others load it.
+
+    Args
+    ----------
+    directory : str
+        Directory where the snapshots are stored
+    keep_versions : int (default 3)
+        Number of newest snapshots kept, older ones are removed when a new snapshot is written
+
+
+    Methods
+    -------
+    get_current_version()
+        Returns the version of the current snapshot or None if there isn't any
+
+    get_version_directory(version: str)
+        Returns the directory of a snapshot version
+
+    writer_lock()
+        Context manager holding an exclusive lock on the snapshot directory between workers
+
+    write(catalog: ServiceCatalog, vector_watermark=None, database_generation=None)
+        Writes the catalog as a new snapshot, makes it current and returns its version
+
+    get_metadata(version: str)
+        Returns the metadata of a snapshot version, including the watermark of the vectors it was built from
+
+    load(version: str, quantization: str = "none", rescore_candidates: int = 200)
+        Returns the catalog of a snapshot version with memory mapped arrays
+
+    """
+
+    CURRENT_FILE = "CURRENT"
+    LOCK_FILE = ".writer.lock"
+
+    def __init__(self, directory: str, keep_versions: int = 3) -> None:
+        self.directory = directory
+        self.keep_versions = keep_versions
+        os.makedirs(directory, exist_ok=True)
+
+    def get_current_version(self) -> Optional[str]:
+        try:
+            with open(os.path.join(self.directory, self.CURRENT_FILE)) as current_file:
+                version = current_file.read().strip()
+        except FileNotFoundError:
+            return None
+        return version if version else None
+
+    def get_version_directory(self, version: str) -> str:
+        return os.path.join(self.directory, version)
+
+    @contextmanager
+    def writer_lock(self):
+        with open(os.path.join(self.directory, self.LOCK_FILE), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def write(self, catalog: ServiceCatalog, vector_watermark=None, database_generation=None) -> str:
+        fingerprint = catalog.get_fingerprint()
+        version = f"{time.time_ns()}-{fingerprint[:12]}"
+        tmp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=self.directory)
+        try:
+            np.save(os.path.join(tmp_dir, "vectors.npy"), np.ascontiguousarray(catalog.vectors))
+            np.save(os.path.join(tmp_dir, "ids.npy"), np.array(catalog.ids.tolist(), dtype=str))
+            if catalog.quantized_vectors is not None:
+                np.save(os.path.join(tmp_dir, "quantized_vectors.npy"), catalog.quantized_vectors)
+            if catalog.quantization_scales is not None:
+                np.save(os.path.join(tmp_dir, "quantization_scales.npy"), catalog.quantization_scales)
+            filter_codes = {}
+            for dimension in FILTER_DIMENSIONS:
+                filter_codes[dimension] = list(catalog.filter_index[dimension].keys())
+                code_masks = np.array([catalog.filter_index[dimension][code] for code in filter_codes[dimension]], dtype=bool)
+                np.save(os.path.join(tmp_dir, f"filter_{dimension}.npy"), code_masks.reshape(len(filter_codes[dimension]), len(catalog)))
+            with open(os.path.join(tmp_dir, "classifications.json"), "w") as classifications_file:
+                json.dump([{key: value for key, value in classification.items() if key != "_id"}
+                           for classification in catalog.classifications], classifications_file, default=str)
+            # Watermark is an ObjectId in MongoDB, extended JSON keeps its type
+            with open(os.path.join(tmp_dir, "meta.json"), "w") as meta_file:
+                json.dump({"version": version, "fingerprint": fingerprint, "quantization": catalog.quantization,
+                           "filter_codes": filter_codes, "vector_watermark": vector_watermark,
+                           "database_generation": database_generation}, meta_file, default=json_util.default)
+            os.rename(tmp_dir, self.get_version_directory(version))
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+        tmp_current = os.path.join(self.directory, f".{self.CURRENT_FILE}.{os.getpid()}")
+        with open(tmp_current, "w") as current_file:
+            current_file.write(version)
+        os.replace(tmp_current, os.path.join(self.directory, self.CURRENT_FILE))
+        self._remove_old_versions(version)
+        return version
+
+    def _remove_old_versions(self, current_version: str) -> None:
+        # Workers still using a removed snapshot keep reading it, memory maps keep the files alive until unmapped
+        versions = sorted(name for name in os.listdir(self.directory)
+                          if not name.startswith(".") and name != self.CURRENT_FILE and name != current_version)
+        for version in versions[:max(0, len(versions) - (self.keep_versions - 1))]:
+            shutil.rmtree(self.get_version_directory(version), ignore_errors=True)
+
+    def get_metadata(self, version: str) -> dict:
+        with open(os.path.join(self.get_version_directory(version), "meta.json")) as meta_file:
+            return json.load(meta_file, object_hook=json_util.object_hook)
+
+    def load(self, version: str, quantization: str = "none", rescore_candidates: int = 200) -> ServiceCatalog:
+        version_dir = self.get_version_directory(version)
+        meta = self.get_metadata(version)
+        with open(os.path.join(version_dir, "classifications.json")) as classifications_file:
+            classifications = json.load(classifications_file)
+        vectors = np.load(os.path.join(version_dir, "vectors.npy"), mmap_mode="r")
+        ids = np.load(os.path.join(version_dir, "ids.npy")).astype(object)
+        filter_index = {}
+        for dimension in FILTER_DIMENSIONS:
+            code_masks = np.load(os.path.join(version_dir, f"filter_{dimension}.npy"), mmap_mode="r")
+            filter_index[dimension] = {code: code_masks[idx] for idx, code in enumerate(meta["filter_codes"][dimension])}
+
+        quantized_vectors = None
+        quantization_scales = None
+        # Quantized vectors of the snapshot are shared if the worker uses the same quantization
+        if quantization != "none" and meta["quantization"] == quantization:
+            quantized_vectors = np.load(os.path.join(version_dir, "quantized_vectors.npy"), mmap_mode="r")
+            scales_path = os.path.join(version_dir, "quantization_scales.npy")
+            if os.path.exists(scales_path):
+                quantization_scales = np.load(scales_path)
+        elif quantization != meta["quantization"]:
+            logging.info(f"Snapshot {version} has {meta['quantization']} quantization, quantizing vectors to {quantization} in memory")
+
+        return ServiceCatalog.from_arrays(vectors, ids, classifications, filter_index, quantization=quantization,
+                                          rescore_candidates=rescore_candidates, quantized_vectors=quantized_vectors,
+                                          quantization_scales=quantization_scales)
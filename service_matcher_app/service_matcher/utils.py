@@ -4,6 +4,11 @@ import numpy as np
 from typing import Optional
 from .models import *
 PROVINCE_CODES = ["02"]
+SERVICE_SEARCH_REGEX = re.compile('service_search$')
+FORM_REGEX = re.compile('_form$')
+FORM_NAME_PREFIX_REGEX = re.compile(r'(.*?)service_search_form')
+SERVICE_CLASS_REGEX = re.compile(r'p\d{1,2}(?:[.]\d{1,2}){0,1}', re.IGNORECASE)
+LIFE_EVENT_REGEX = re.compile(r'ke\d{1,2}(?:[.]\d{1,2}){0,1}', re.IGNORECASE)
 
 class ServiceMatcherUtils():
     """
@@ -17,6 +22,7 @@ class ServiceMatcherUtils():
 
     def _filter_service_data_by_municipality(self, service: Service, municipality_ids: list) -> list:
         languages = ['en', 'fi', 'sv']
+        municipality_ids = set(municipality_ids)
         service_filtered = service.copy(deep=True)
         for language in languages:
             service_areas = service_filtered.areas[language]
@@ -33,6 +39,7 @@ class ServiceMatcherUtils():
 
     def _filter_service_channel_data_by_municipality(self, channel: ServiceChannel, municipality_ids: list) -> list:
         languages = ['en', 'fi', 'sv']
+        municipality_ids = set(municipality_ids)
         channel_filtered = channel.copy(deep=True)
         for language in languages:
             channel_areas = channel_filtered.areas[language]
@@ -59,7 +66,7 @@ class ServiceMatcherUtils():
         start_events = 0
         for event in events:
             event = event.copy()
-            is_form_starting_event = ('parse_data' in event.keys() and re.search('service_search$', event['parse_data']['intent']['name']) is not None) or (event.get('name') is not None and re.search('_form$', event.get('name')) is not None)
+            is_form_starting_event = ('parse_data' in event.keys() and SERVICE_SEARCH_REGEX.search(event['parse_data']['intent']['name']) is not None) or (event.get('name') is not None and FORM_REGEX.search(event.get('name')) is not None)
             is_form_ending_event = (event.get('event') == 'active_loop' and event.get('name') is None) or event.get('event') == 'action_execution_rejected'
             if is_form_starting_event and not form_on:
                 form_on = True
@@ -96,8 +103,9 @@ class ServiceMatcherUtils():
         return(matching_municipality_ids)
 
     def _check_life_events(self, life_events: list, all_life_events: list) -> list:
+        all_life_events_set = set(all_life_events)
         filtered_life_events = [
-            le for le in life_events if le in all_life_events]
+            le for le in life_events if le in all_life_events_set]
         # If no info, don't limit by life events
         if len(filtered_life_events) == 0:
             filtered_life_events = all_life_events
@@ -105,8 +113,9 @@ class ServiceMatcherUtils():
 
     def _check_service_classes(self, service_classes: list, all_service_classes: list) -> list:
         all_service_classes = [sc.code for sc in all_service_classes]
+        all_service_classes_set = set(all_service_classes)
         filtered_service_classes = [
-            sc for sc in service_classes if sc in all_service_classes]
+            sc for sc in service_classes if sc in all_service_classes_set]
         # If no info, don't limit by service classes
         if len(filtered_service_classes) == 0:
             filtered_service_classes = all_service_classes
@@ -120,9 +129,7 @@ class ServiceMatcherUtils():
 
     def _get_service_classes_from_intent_name(self, intent: Optional[str]) -> list:
         if intent is not None:
-            service_class_regex = re.compile(
-                'p\d{1,2}(?:[.]\d{1,2}){0,1}', re.IGNORECASE)
-            found_service_classes = re.findall(service_class_regex, intent)
+            found_service_classes = SERVICE_CLASS_REGEX.findall(intent)
             if len(found_service_classes) > 0:
                 found_service_classes = list(set([found_service_class.upper(
                 ) for found_service_class in found_service_classes]))
@@ -132,9 +139,7 @@ class ServiceMatcherUtils():
 
     def _get_life_events_from_intent_name(self, intent: Optional[str]) -> list:
         if intent is not None:
-            life_event_regex = re.compile(
-                'ke\d{1,2}(?:[.]\d{1,2}){0,1}', re.IGNORECASE)
-            found_life_events = re.findall(life_event_regex, intent)
+            found_life_events = LIFE_EVENT_REGEX.findall(intent)
             if len(found_life_events) > 0:
                 found_life_events = list(set([found_life_event.upper()
                                               for found_life_event in found_life_events]))
@@ -0,0 +1,126 @@
+import logging
+import threading
+from pymongo.errors import PyMongoError
+from typing import Callable
+
+
+CATALOG_COLLECTIONS = ["service_vectors", "services", "channels", "translations"]
+INTENT_COLLECTIONS = ["intent_to_services"]
+# Services and channels have a timestamp, the other collections are only inserted to so their ObjectIds grow
+WATERMARK_FIELDS = {"services": "lastUpdated", "channels": "lastUpdated"}
+
+
+class CatalogWatcher():
+    """
+    A class for following changes of the service database so that every service matcher replica stays up to date
+
+    Changes are read from a MongoDB change stream of the service database, or by polling the collections when
+    change streams aren't supported (for example Cosmos DB). A poll reads the newest watermark and the estimated number of
+    documents of each collection. Changes are applied once the collections have been quiet for an interval, so a
+    sync doesn't see a half written update of the processor.
+
+    Args
+    ----------
+    mongo_client : MongoClient
+        MongoDB client where service data is stored
+    on_catalog_change : Callable
+        Called when vectors, services, channels or translations have changed
+    on_intent_change : Callable
+        Called when intent to services mappings have changed
+    mode : str (default "change_stream")
+        "change_stream" or "polling", change stream falls back to polling if the database doesn't support it
+    interval : float (default 5)
+        Seconds of quiet before changes are applied and seconds between polls
+
+
+    Methods
+    -------
+    start()
+        Starts following the changes in a background thread
+
+    stop()
+        Stops following the changes
+
+    poll()
+        Checks the collections once and returns names of the collections changed since the previous poll
+
+    """
+
+    def __init__(self, mongo_client, on_catalog_change: Callable, on_intent_change: Callable, mode: str = "change_stream", interval: float = 5) -> None:
+        if mode not in ["change_stream", "polling"]:
+            raise ValueError(f"Unknown catalog watch mode {mode}")
+        self.mongo_client = mongo_client
+        self.on_catalog_change = on_catalog_change
+        self.on_intent_change = on_intent_change
+        self.mode = mode
+        self.interval = interval
+        self.collection_states = {}
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def _run(self) -> None:
+        if self.mode == "change_stream":
+            try:
+                self._watch_change_stream()
+            except PyMongoError as e:
+                logging.error(f"Could not watch service database changes, polling instead: {e}")
+        self._poll_changes()
+
+    def _apply_changes(self, collections: set) -> None:
+        try:
+            if len(collections & set(CATALOG_COLLECTIONS)) > 0:
+                self.on_catalog_change()
+            if len(collections & set(INTENT_COLLECTIONS)) > 0:
+                self.on_intent_change()
+        except Exception as e:
+            logging.error(f"Could not apply changes of {sorted(collections)}: {e}")
+
+    def _watch_change_stream(self) -> None:
+        pipeline = [{"$match": {"ns.coll": {"$in": CATALOG_COLLECTIONS + INTENT_COLLECTIONS}}}]
+        changed_collections = set()
+        with self.mongo_client.service_db.watch(pipeline, max_await_time_ms=int(self.interval * 1000)) as stream:
+            while not self._stopped.is_set():
+                change = stream.try_next()
+                if change is not None:
+                    changed_collections.add(change["ns"]["coll"])
+                elif len(changed_collections) > 0:
+                    self._apply_changes(changed_collections)
+                    changed_collections = set()
+
+    def _get_collection_state(self, collection_name: str) -> tuple:
+        field = WATERMARK_FIELDS.get(collection_name, "_id")
+        collection = self.mongo_client.service_db[collection_name]
+        newest = collection.find_one({}, {field: 1}, sort=[(field, -1)])
+        # Removals are noticed from the number of documents, which is read from collection metadata instead of counting them
+        return (newest.get(field) if newest is not None else None, collection.estimated_document_count())
+
+    def poll(self) -> set:
+        changed_collections = set()
+        for collection_name in CATALOG_COLLECTIONS + INTENT_COLLECTIONS:
+            state = self._get_collection_state(collection_name)
+            if collection_name in self.collection_states and self.collection_states[collection_name] != state:
+                changed_collections.add(collection_name)
+            self.collection_states[collection_name] = state
+        return changed_collections
+
+    def _poll_changes(self) -> None:
+        changed_collections = set()
+        while not self._stopped.is_set():
+            try:
+                new_changes = self.poll()
+            except PyMongoError as e:
+                logging.error(f"Could not poll service database changes: {e}")
+                new_changes = set()
+            if len(new_changes) > 0:
+                changed_collections |= new_changes
+            elif len(changed_collections) > 0:
+                self._apply_changes(changed_collections)
+                changed_collections = set()
+            self._stopped.wait(self.interval)
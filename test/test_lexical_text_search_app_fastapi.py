@@ -93,6 +93,21 @@ class FastAPITest(unittest.TestCase):
         response2 = self.test_client.post("/searchServices", json={"text": "Jotain", "language":"fi", "top_k": 1})
         self.assertEqual(response2.status_code, 200)
         self.assertEqual(len(response2.json()["services"]), 1)
+
+    def test_lexical_text_search_service_ids(self):
+        service_ids = [service["id"] for service in self.lexical_text_search.db.get_services()]
+        response = self.test_client.post("/searchServiceIds", json={"text": "Jotain", "language": "fi", "top_k": 0})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()["services"]), 2)
+        self.assertEqual(set(response.json()["services"][0].keys()), {"id", "score"})
+
+        response2 = self.test_client.post("/searchServiceIds", json={"text": "Jotain", "language": "fi", "top_k": 0, "service_ids": service_ids[:1]})
+        self.assertEqual(response2.status_code, 200)
+        self.assertEqual([service["id"] for service in response2.json()["services"]], service_ids[:1])
+
+        response3 = self.test_client.post("/searchServiceIds", json={"text": "Jotain", "language": "fi", "top_k": 0, "life_events": ["Not existing"]})
+        self.assertEqual(response3.status_code, 200)
+        self.assertEqual(len(response3.json()["services"]), 0)
         
 if __name__ == '__main__':
     unittest.main()
@@ -35,6 +35,12 @@ class FastAPITest(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json()["vector"], [123, 123, 123, 123])
 
+    def test_nlp_vectorizer_vectorize_batch(self):
+        self.vectorizer.encode.return_value = np.array([[123, 123, 123, 123], [111, 111, 111, 111]])
+        response = self.test_client.post("/vectorizeBatch", json={"texts": ["Jotain", "Jotain muuta"]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["vectors"], [[123, 123, 123, 123], [111, 111, 111, 111]])
+
     def test_nlp_vectorizer_recommend_services_error(self):
         response = self.test_client.post("/vectorize", json={})
         self.assertNotEqual(response.status_code, 200)
@@ -95,6 +95,7 @@ class ServiceDataProcessortTest(unittest.TestCase):
         os.environ['LEXICAL_TEXT_SEARCH_HOST'] = 'request_success'
         response = self.data_processor.process_service_descriptions()
         self.assertEqual(response, "2 new services processed")
+        self.mongo_client_instance.service_db.catalog_generation.update_one.assert_called_once()
 
     @patch('requests.get', side_effect=mocked_requests_get)
     @patch('requests.post', side_effect=mocked_requests_post)
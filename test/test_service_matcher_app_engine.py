@@ -1,12 +1,20 @@
 import os
 import sys
+import tempfile
 sys.path.append('service_matcher_app')
+sys.path.append('nlp_vectorizer_app')
 import json
 import unittest
 from unittest.mock import MagicMock, patch
 from service_matcher_app.service_matcher import models
 from service_matcher_app.service_matcher.service_matcher import ServiceMatcher
+from service_matcher_app.service_matcher.ann_index import IVFFlatIndex
+from service_matcher_app.service_matcher.catalog import ServiceCatalog
+from service_matcher_app.service_matcher.policy import PolicyExpression, get_confidence_matrix
+from service_matcher_app.service_matcher.watcher import CatalogWatcher
 import numpy as np
+from bson import ObjectId
+from fastapi.encoders import jsonable_encoder
 
 
 NLP_VECTORIZER_JSON_RESPONSE_SUCCESS = {"vector": [123, 123, 123, 123]}
@@ -50,9 +58,9 @@ def mocked_requests_post(*args, **kwargs):
         return MockResponse(NLP_VECTORIZER_JSON_RESPONSE_SUCCESS, 200)
     elif args[0] == 'request_error/vectorizerecommend':
         return MockResponse(JSON_RESPONSE_ERROR, 400)
-    if args[0] == 'request_success/searchServices':
+    if args[0] == 'request_success/searchServiceIds':
         return MockResponse(LEXICAL_TEXT_SEARCH_JSON_RESPONSE_SUCCESS, 200)
-    elif args[0] == 'request_error/searchServices':
+    elif args[0] == 'request_error/searchServiceIds':
         return MockResponse(JSON_RESPONSE_ERROR, 400)
 
 class ServiceMatchEngineTest(unittest.TestCase):
@@ -155,9 +163,59 @@ class ServiceMatchEngineTest(unittest.TestCase):
         service_desc_vectors = self.service_matcher.db._get_service_desc_vectors()
         self.assertEqual(len(service_desc_vectors), 1)
 
+    def test_get_service_ids_by_filters(self):
+        service_ids = self.service_matcher.db._get_service_ids_by_filters(municipality_ids_filter=["853", "1"])
+        self.assertEqual(service_ids, [self.test_service_data[0]["id"]])
+        service_ids = self.service_matcher.db._get_service_ids_by_filters(municipality_ids_filter=["1"])
+        self.assertEqual(len(service_ids), 0)
+        service_ids = self.service_matcher.db._get_service_ids_by_filters(service_class_codes_filter=["P20.1"], life_events_filter=["KE6"])
+        self.assertEqual(len(service_ids), 1)
+        service_ids = self.service_matcher.db._get_service_ids_by_filters(service_class_codes_filter=["P20.1"], life_events_filter=["KE7"])
+        self.assertEqual(len(service_ids), 0)
+
     def test_get_service_class_vectors(self):
         service_class_vectors = self.service_matcher.db._get_service_class_vectors()
         self.assertEqual(len(service_class_vectors), 4)
+        self.assertEqual(self.service_matcher.db.service_class_catalog.vectors.shape, (4, 4))
+
+    def test_get_services_by_ids_from_cache(self):
+        service_id = self.test_service_data[0]["id"]
+        services_find = self.mongo_client_instance.service_db.services.find
+        channels_find = self.mongo_client_instance.service_db.channels.find
+        find_counts = (services_find.call_count, channels_find.call_count)
+        services = self.service_matcher.db._get_services_by_ids([service_id, "missing"], include_channels=True, translate_missing_texts=True)
+        self.assertEqual((services_find.call_count, channels_find.call_count), find_counts)
+        self.assertEqual([service["service"].id for service in services], [service_id])
+        self.assertEqual([channel.id for channel in services[0]["channels"]],
+                         [channel["id"] for channel in self.test_service_channel_data if service_id in channel["serviceIds"]])
+        self.assertEqual(services[0]["service"].name["en"], "Shooting range")
+        # Variants are precomputed without modifying the documents read from the database
+        self.assertIs(self.service_matcher.db._get_service(service_id, translate_missing_texts=True), services[0]["service"])
+        self.assertNotIn("nameAutoTranslated", self.test_service_data[0])
+        self.assertEqual(len(self.test_service_data[0]["descriptions"]["en"]), 0)
+        # Services updated since the newest cached one are fetched in the background, unchanged ones are kept as they are
+        db = self.service_matcher.db
+        service = db._get_service(service_id)
+        service_generation = db.service_cache["generation"]
+        self.assertFalse(db._refresh_service_documents())
+        self.assertEqual(services_find.call_args[0][0], {"lastUpdated": {"$gte": max(ser.lastUpdated for ser in db.services_by_id.values())}})
+        self.assertIs(db._get_service(service_id), service)
+        self.assertEqual(db.service_cache["generation"], service_generation)
+        services_find.return_value = [dict(self.test_service_data[0], lastUpdated="2022-01-01T00:00:00+00:00")]
+        self.assertTrue(db._refresh_service_documents())
+        self.assertEqual(db._get_service(service_id).lastUpdated.year, 2022)
+        self.assertEqual(db.service_cache["generation"], service_generation + 1)
+        self.assertEqual(db.service_cache["service_watermark"].year, 2022)
+        self.assertEqual(len(db.services_by_id), len(self.test_service_data))
+
+    def test_encode_response(self):
+        query = models.ServiceQuery(municipalities=["Turku"], include_channels=True)
+        services = self.service_matcher.get_all_services_filtered(query)
+        self.assertEqual(json.loads(self.service_matcher.encode_response(services)), jsonable_encoder(services))
+        # Municipality shaped services are reused so their encoded JSON is reused too
+        self.assertIs(self.service_matcher.get_all_services_filtered(query)[0]["service"], services[0]["service"])
+        self.service_matcher.encode_response(services)
+        self.assertGreater(self.service_matcher.get_cache_stats()["fragment_cache"]["fragments"]["hits"], 0)
 
     def test_get_all_service_channels(self):
         self.assertEqual(len(self.service_matcher.get_all_service_channels()), 2)
@@ -204,6 +262,18 @@ class ServiceMatchEngineTest(unittest.TestCase):
         self.assertEqual(fallback_filter([0.6,0.1]), False)
         self.assertEqual(fallback_filter([0.4,0.2]), False)
         self.assertEqual(fallback_filter([0.3,0.2]), True)
+        # Filters are parsed once and evaluated for many rankings at once
+        find_count = self.mongo_client_instance.bf.core_policies.find.call_count
+        self.assertIs(self.service_matcher.db._get_policy_filters().get('disambiguation'), dis_filter)
+        self.assertEqual(self.mongo_client_instance.bf.core_policies.find.call_count, find_count)
+        confidences = get_confidence_matrix([[0.6, 0.1], [0.6, 0.4], [0.3]])
+        self.assertEqual(dis_filter.evaluate(confidences).tolist(), [False, True, False])
+        self.assertEqual(fallback_filter.evaluate(confidences).tolist(), [False, False, True])
+        with self.assertRaises(ValueError):
+            PolicyExpression("__import__('os').getcwd()")
+        self.assertEqual(PolicyExpression("confidences[0] < 0.5"), PolicyExpression("confidences[0] < 0.5"))
+        self.assertEqual(len({PolicyExpression("confidences[0] < 0.5"), PolicyExpression("confidences[0] < 0.5")}), 1)
+        self.assertNotEqual(PolicyExpression("confidences[0] < 0.5"), PolicyExpression("confidences[0] < 0.4"))
         
     def test_nest_form_events(self):
         events = [{"parse_data":{"intent": {"name":"random intent"}}},
@@ -215,10 +285,57 @@ class ServiceMatchEngineTest(unittest.TestCase):
         self.assertEqual(len(nested_events[1]['form_events']), 3)
         self.assertEqual(len(nested_events[4]['form_events']), 2) 
         
+    def test_conversation_parser(self):
+        events = [{"parse_data":{"intent": {"name":"p1_greet"}}},
+                  {"parse_data":{"intent": {"name":"sports_service_search"}}}, {"event": "action", "name": "sports_service_search_form"}, {"event": "active_loop", "name":"sports_service_search_form"},
+                  {"parse_data":{"intent": {"name":"any_intent_to_reject_excecution"}}}, {"event": "action_execution_rejected", "name": "sports_service_search_form"},
+                  {"parse_data":{"intent": {"name":"ke6_something"}, "intent_ranking": [{"confidence": 0.5}, {"confidence": 0.4}]}},
+                  {"parse_data":{"intent": {"name":"ke6_something"}}}]
+        for timestamp, event in enumerate(events):
+            event["timestamp"] = 1650000000.0 + timestamp
+        policy_filters = self.service_matcher.db._get_policy_filters()
+        parser = self.service_matcher.conversation_parser
+        # Conversation is parsed a turn at a time from the state of the previous turn
+        for n_events in range(1, len(events) + 1):
+            intent_events, intents = parser.parse("C3", events[:n_events], policy_filters)
+            self.assertEqual(parser.states.get("C3").n_events, n_events)
+        self.assertEqual(intents, ["p1_greet", "sports_service_search", "ke6_something"])
+        # Tracker which doesn't continue the parsed events is parsed from the start
+        rewritten_events = events[:7] + [{"parse_data": {"intent": {"name": "p19_something"}}, "timestamp": 1660000000.0}]
+        self.assertEqual(parser.parse("C3", rewritten_events, policy_filters)[1], ["p1_greet", "sports_service_search", "p19_something"])
+        self.assertEqual(parser.parse("C3", events[:1] + [{"parse_data": {"intent": {"name": "p19_something"}}, "timestamp": 1670000000.0}],
+                                      policy_filters)[1], ["p1_greet", "p19_something"])
+        # Rejection is moved before the intent that caused it and ends the form, ranked ke6 intent is a disambiguation
+        self.assertEqual(len(intent_events[1]["form_events"]), 3)
+        self.assertEqual(intent_events[1]["form_events"][-1]["event"], "action_execution_rejected")
+        self.assertEqual(parser.parse("C4", events, policy_filters), (intent_events, intents))
+        # Tracker events are left untouched
+        self.assertEqual(events[6]["parse_data"]["intent"]["name"], "ke6_something")
+        self.assertNotIn("form_events", events[1])
+
+    def test_intent_index(self):
+        intent_find = self.mongo_client_instance.service_db.intent_to_services.find
+        find_count = intent_find.call_count
+        intent_info = self.service_matcher.db._get_service_ids_by_intent_name("KE7_Something")
+        self.assertEqual(intent_find.call_count, find_count)
+        self.assertEqual(intent_info, {'services': [self.test_service_data[0]["id"]], 'intent_text': "Intentiä kuvaava teksti",
+                                       'intent_service_classes': ["P20.1"], 'intent_priorization': None})
+        self.assertEqual(self.service_matcher.db._get_service_ids_by_intent_name("missing")["services"], [])
+        # Changed mappings are taken into use when service matcher is notified
+        intent_find.return_value = [{"intent": "ke7_something", "services": [], "ptv_services": [self.test_service_data[1]["id"], "missing"]}]
+        self.service_matcher.update_intents()
+        self.assertEqual(self.service_matcher.db._get_service_ids_by_intent_name("ke7_something")["services"], [self.test_service_data[1]["id"]])
+        self.assertEqual(self.service_matcher.db.intent_generation, 1)
+
     def test_get_conversation_info(self):        
         conv_info = self.service_matcher._get_conversation_info(self.conversation_id)
         self.assertEqual(conv_info["messages"][0], "Tekstiä")
         self.assertEqual(conv_info["slots"]["municipality"], "Turku") 
+        # Only fields used by the parser are fetched
+        conversation_projection = self.mongo_client_instance.bf.conversations.find.call_args[0][1]
+        self.assertEqual(conversation_projection["tracker.slots"], 1)
+        self.assertNotIn("tracker", conversation_projection)
+        self.assertEqual(self.mongo_client_instance.bf.activity.find.call_args[0][1], {"text": 1, "_id": 0})
         
     def test_get_municipality_ids_by_names(self):        
         mun_codes = self.service_matcher.utils._get_municipality_ids_by_names(["Turku"], self.service_matcher.db._get_all_municipalities())        
@@ -270,7 +387,239 @@ class ServiceMatchEngineTest(unittest.TestCase):
         found_life_events = self.service_matcher.utils._get_life_events_from_intent_name("p1_asd")
         self.assertEqual(found_life_events, [])
 
-    @patch('requests.post', side_effect=mocked_requests_post)
+    def test_get_top_k_scores(self):
+        scores = {"A": 0.9, "B": 0.5, "C": 0.7, "D": 0.1}
+        top_k_scores = self.service_matcher.free_text_recommender._get_top_k_scores(scores, 2)
+        self.assertEqual(list(top_k_scores.keys()), ["A", "C"])
+        top_k_scores = self.service_matcher.free_text_recommender._get_top_k_scores(scores, 3, score_threshold=0.6)
+        self.assertEqual(list(top_k_scores.keys()), ["A", "C"])
+        top_k_scores = self.service_matcher.free_text_recommender._get_top_k_scores(scores, 10)
+        self.assertEqual(list(top_k_scores.keys()), ["A", "C", "B", "D"])
+        top_k_scores = self.service_matcher.free_text_recommender._get_top_k_scores(scores, 0)
+        self.assertEqual(len(top_k_scores), 0)
+        top_k_indices = self.service_matcher.free_text_recommender._get_top_k_indices(np.array([0.2, np.nan, 0.4, -0.1]), 5)
+        self.assertEqual(top_k_indices.tolist(), [2, 0])
+        # Ties at the k-th score are broken by index like the stable sort of all scores
+        tied_scores = np.array([0.1, 0.5, 0.3, 0.5, 0.3, 0.3, 0.9, 0.3])
+        for top_k in range(len(tied_scores) + 1):
+            expected = np.argsort(-tied_scores, kind="stable")[:top_k]
+            top_k_indices = self.service_matcher.free_text_recommender._get_top_k_indices(tied_scores, top_k)
+            self.assertEqual(top_k_indices.tolist(), expected.tolist())
+
+    def test_combine_nlp_and_lexical_scores(self):
+        nlp_scores = np.array([0.5, 0.2, np.nan, 0.1, np.nan])
+        lexical_scores = np.array([60, np.nan, 10, -1, np.nan])
+        combined_scores = self.service_matcher.free_text_recommender._combine_nlp_and_lexical_scores(nlp_scores, lexical_scores)
+        self.assertEqual(combined_scores[0], (0.5 * 100) * (0.5 * 100) * 60 * 60)
+        self.assertEqual(combined_scores[1], (0.2 * 100) * (0.2 * 100) * 1)
+        self.assertEqual(combined_scores[2], 0.01 * 100 * 10)
+        self.assertEqual(combined_scores[3], (0.1 * 100) * (0.1 * 100) * 1)
+        self.assertTrue(np.isnan(combined_scores[4]))
+
+    def test_ann_index(self):
+        rng = np.random.default_rng(0)
+        vectors = rng.standard_normal((500, 8)).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        query = vectors[0]
+        mask = np.arange(500) % 2 == 0
+
+        # Searching every list is exact
+        ann_index = IVFFlatIndex(vectors, n_lists=10, n_probe=10)
+        rows, scores = ann_index.search(query, mask)
+        self.assertEqual(sorted(rows.tolist()), list(range(0, 500, 2)))
+        np.testing.assert_allclose(scores, vectors[rows].dot(query), rtol=1e-6)
+        ann_index.n_probe = 1
+        rows, _ = ann_index.search(query)
+        self.assertIn(0, rows)
+        self.assertLess(len(rows), 500)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            index_path = os.path.join(tmp_dir, "ann_index.npz")
+            ann_index.save(index_path, "fingerprint")
+            loaded_index = IVFFlatIndex.load(index_path, vectors, "fingerprint", n_probe=1)
+            np.testing.assert_array_equal(loaded_index.list_rows, ann_index.list_rows)
+            self.assertIsNone(IVFFlatIndex.load(index_path, vectors, "other fingerprint"))
+            self.assertEqual(os.listdir(tmp_dir), ["ann_index.npz"])
+            # A truncated index is rebuilt instead of failing the request
+            with open(index_path, "r+b") as index_file:
+                index_file.truncate(100)
+            self.assertIsNone(IVFFlatIndex.load(index_path, vectors, "fingerprint"))
+
+    def test_quantized_catalog(self):
+        rng = np.random.default_rng(0)
+        vectors = rng.standard_normal((300, 8))
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        service_vectors = [{"id": str(row), "vector": vector.tolist()} for row, vector in enumerate(vectors)]
+        mask = np.ones(300, dtype=bool)
+        exact_scores = ServiceCatalog(service_vectors).get_masked_scores(vectors[0], mask)
+        for quantization in ["float16", "int8"]:
+            catalog = ServiceCatalog(service_vectors, quantization=quantization, rescore_candidates=10)
+            scores = catalog.get_masked_scores(vectors[0], mask)
+            top_10 = np.argsort(-exact_scores)[:10]
+            # Best candidates are rescored exactly, the rest have quantized scores
+            np.testing.assert_allclose(scores[top_10], exact_scores[top_10], rtol=1e-5)
+            np.testing.assert_allclose(scores, exact_scores, atol=0.05)
+        with self.assertRaises(ValueError):
+            ServiceCatalog(service_vectors, quantization="int4")
+
+    def test_catalog_snapshot(self):
+        generation_find_one = self.mongo_client_instance.service_db.catalog_generation.find_one
+        generation_find_one.return_value = {"_id": "catalog", "generation": 1}
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.environ['CATALOG_SNAPSHOT_DIR'] = tmp_dir
+            try:
+                worker = ServiceMatcher(self.mongo_client_instance)
+                other_worker = ServiceMatcher(self.mongo_client_instance)
+            finally:
+                del os.environ['CATALOG_SNAPSHOT_DIR']
+            # The second worker uses the snapshot written by the first one
+            self.assertEqual(other_worker.db.snapshot_version, worker.db.snapshot_version)
+            self.assertIsInstance(other_worker.db.catalog.vectors, np.memmap)
+            self.assertEqual(other_worker.db._get_service_ids_by_filters(municipality_ids_filter=["853"]),
+                             self.service_matcher.db._get_service_ids_by_filters(municipality_ids_filter=["853"]))
+            # Processor has written new data, the worker syncing first writes a snapshot and the others load it
+            generation_find_one.return_value = {"_id": "catalog", "generation": 2}
+            worker.update_desc_vectors()
+            self.assertNotEqual(other_worker.db.snapshot_version, worker.db.snapshot_version)
+            other_worker.db.snapshot_poll_interval = 0
+            other_worker.refresh_catalog()
+            self.assertEqual(other_worker.db.snapshot_version, worker.db.snapshot_version)
+            self.assertEqual(other_worker.db.catalog_generation, 1)
+            snapshot_version = worker.db.snapshot_version
+            other_worker.update_desc_vectors()
+            worker.update_desc_vectors()
+            self.assertEqual(other_worker.db.snapshot_version, snapshot_version)
+            self.assertEqual(worker.db.snapshot_version, snapshot_version)
+            # Workers continue incremental syncs from the watermark of the snapshot they loaded
+            vector_watermark = ObjectId()
+            worker.db._publish_catalog(worker.db.catalog, vector_watermark)
+            other_worker.refresh_catalog()
+            self.assertEqual(other_worker.db.snapshot_version, worker.db.snapshot_version)
+            self.assertEqual(other_worker.db.vector_watermark, vector_watermark)
+
+    def test_sync_translations(self):
+        translations_find = self.mongo_client_instance.service_db.translations.find
+        translations = translations_find.return_value
+        service_id = self.test_service_data[0]["id"]
+        # Only the translations change, the service itself isn't updated
+        translations_find.return_value = [translation for translation in translations if translation["target_text"] != "Shooting range"]
+        service_matcher = ServiceMatcher(self.mongo_client_instance)
+        self.assertIsNone(service_matcher.db.translated_services_by_id[service_id].name["en"])
+        service_cache_generation = service_matcher.db.service_cache["generation"]
+        translations_find.return_value = translations
+        service_matcher.update_desc_vectors()
+        self.assertEqual(service_matcher.db.translated_services_by_id[service_id].name["en"], "Shooting range")
+        self.assertTrue(service_matcher.db.translated_services_by_id[service_id].nameAutoTranslated["en"])
+        self.assertIsNone(service_matcher.db.services_by_id[service_id].name["en"])
+        self.assertEqual(service_matcher.db.service_cache["generation"], service_cache_generation + 1)
+
+    def test_stale_catalog_snapshot(self):
+        generation_find_one = self.mongo_client_instance.service_db.catalog_generation.find_one
+        generation_find_one.return_value = {"_id": "catalog", "generation": 1}
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.environ['CATALOG_SNAPSHOT_DIR'] = tmp_dir
+            try:
+                worker = ServiceMatcher(self.mongo_client_instance)
+                # Processor has written new data before a worker is restarted
+                generation_find_one.return_value = {"_id": "catalog", "generation": 2}
+                restarted_worker = ServiceMatcher(self.mongo_client_instance)
+                other_worker = ServiceMatcher(self.mongo_client_instance)
+            finally:
+                del os.environ['CATALOG_SNAPSHOT_DIR']
+            self.assertNotEqual(restarted_worker.db.snapshot_version, worker.db.snapshot_version)
+            self.assertEqual(restarted_worker.db.snapshot_store.get_metadata(
+                restarted_worker.db.snapshot_version)["database_generation"], 2)
+            self.assertEqual(other_worker.db.snapshot_version, restarted_worker.db.snapshot_version)
+
+    def test_filter_ids_during_catalog_swap(self):
+        db = self.service_matcher.db
+        expected_ids = db._get_service_ids_by_filters(municipality_ids_filter=["853"])
+        get_service_filter_mask = db._get_service_filter_mask
+
+        def get_mask_and_swap_catalog(*args):
+            # A sync publishes a smaller catalog after the mask has been made
+            mask = get_service_filter_mask(*args)
+            db._catalog = ServiceCatalog([])
+            return mask
+
+        db._get_service_filter_mask = get_mask_and_swap_catalog
+        self.assertEqual(db._get_service_ids_by_filters(municipality_ids_filter=["853"]), expected_ids)
+
+    def test_incremental_sync(self):
+        service_ids = [service["id"] for service in self.test_service_data]
+        service_vectors = [{"_id": 1, "id": service_ids[0], "vector": [1, 0, 0, 0], "service_class_codes": ["P20.1"], "municipality_codes": ["853"], "life_event_codes": ["KE6"]},
+                           {"_id": 2, "id": service_ids[1], "vector": [0, 1, 0, 0], "service_class_codes": ["P19"], "municipality_codes": ["853"], "life_event_codes": []}]
+        vector_queries = []
+
+        def find_service_vectors(query={}, projection=None):
+            vector_queries.append(query)
+            if "_id" in query:
+                return [vector for vector in service_vectors if vector["_id"] > query["_id"]["$gt"]]
+            return list(service_vectors)
+
+        self.mongo_client_instance.service_db.service_vectors.find = MagicMock(side_effect=find_service_vectors)
+        service_matcher = ServiceMatcher(self.mongo_client_instance)
+        self.assertEqual(service_matcher.db.vector_watermark, 2)
+        catalog = service_matcher.db.catalog
+        # First service is updated and second one removed
+        service_vectors[:] = [{"_id": 3, "id": service_ids[0], "vector": [0, 0, 1, 0], "service_class_codes": ["P19"], "municipality_codes": ["853"], "life_event_codes": []}]
+        with service_matcher.db.pin_catalog():
+            service_matcher.update_desc_vectors()
+            # Catalog doesn't change in the middle of a request
+            self.assertIs(service_matcher.db.catalog, catalog)
+        self.assertEqual(vector_queries[-2:], [{"_id": {"$gt": 2}}, {}])
+        self.assertEqual(service_matcher.db.vector_watermark, 3)
+        self.assertEqual(service_matcher.db.catalog.ids.tolist(), [service_ids[0]])
+        self.assertEqual(service_matcher.db.catalog.vectors.tolist(), [[0, 0, 1, 0]])
+        self.assertEqual(service_matcher.db._get_service_ids_by_filters(service_class_codes_filter=["P19"]), [service_ids[0]])
+        self.assertEqual(service_matcher.db.catalog_generation, 1)
+        # Sync in the background publishes the same catalog
+        service_vectors.append({"_id": 4, "id": service_ids[1], "vector": [0, 0, 0, 1], "service_class_codes": [], "municipality_codes": [], "life_event_codes": []})
+        service_matcher.update_desc_vectors_in_background()
+        service_matcher._sync_thread.join()
+        self.assertEqual(service_matcher.db.catalog.ids.tolist(), [service_ids[0], service_ids[1]])
+
+    def test_database_generation(self):
+        self.service_matcher.update_desc_vectors_in_background = MagicMock()
+        self.service_matcher.db.generation_poll_interval = 0
+        self.service_matcher.refresh_catalog()
+        self.service_matcher.update_desc_vectors_in_background.assert_not_called()
+        # Processor has written new data
+        self.mongo_client_instance.service_db.catalog_generation.find_one.return_value = {"_id": "catalog", "generation": 2}
+        self.service_matcher.refresh_catalog()
+        self.assertNotEqual(self.service_matcher.db.database_generation, 2)
+        # Generation is stored only by a finished sync, until then it is retried
+        self.service_matcher.refresh_catalog()
+        self.assertEqual(self.service_matcher.update_desc_vectors_in_background.call_count, 2)
+        self.service_matcher.db._sync()
+        self.assertEqual(self.service_matcher.db.database_generation, 2)
+        self.service_matcher.refresh_catalog()
+        self.assertEqual(self.service_matcher.update_desc_vectors_in_background.call_count, 2)
+
+    def test_catalog_watcher(self):
+        collections = {}
+        for name in ["service_vectors", "services", "channels", "translations", "intent_to_services"]:
+            collections[name] = MagicMock()
+            collections[name].find_one.return_value = {"_id": 1}
+            collections[name].estimated_document_count.return_value = 10
+        mongo_client = MagicMock()
+        mongo_client.service_db.__getitem__.side_effect = lambda name: collections[name]
+        on_catalog_change = MagicMock()
+        on_intent_change = MagicMock()
+        watcher = CatalogWatcher(mongo_client, on_catalog_change, on_intent_change, mode="polling")
+        self.assertEqual(watcher.poll(), set())
+        # New vectors and a removed intent mapping
+        collections["service_vectors"].find_one.return_value = {"_id": 2}
+        collections["intent_to_services"].estimated_document_count.return_value = 9
+        self.assertEqual(watcher.poll(), {"service_vectors", "intent_to_services"})
+        self.assertEqual(watcher.poll(), set())
+        watcher._apply_changes({"service_vectors"})
+        on_catalog_change.assert_called_once()
+        on_intent_change.assert_not_called()
+        with self.assertRaises(ValueError):
+            CatalogWatcher(mongo_client, on_catalog_change, on_intent_change, mode="unknown")
+
+    @patch('requests.Session.post', side_effect=mocked_requests_post)
     def test_get_matching_services(self, mock_post):
 
         # Barely tests the threshold check, score and vector scales are not necessarily realistic
@@ -282,7 +631,7 @@ class ServiceMatchEngineTest(unittest.TestCase):
         self.assertEqual(len(matches3), 0)
 
         
-    @patch('requests.post', side_effect=mocked_requests_post)
+    @patch('requests.Session.post', side_effect=mocked_requests_post)
     def test_get_service_recommendations_by_conversation(self, mock_post):
         
         recommendations = self.service_matcher.get_service_recommendations_by_conversation(self.conversation_id, models.ServiceRecommendConversationQuery(mode="infer"))
@@ -339,7 +688,7 @@ class ServiceMatchEngineTest(unittest.TestCase):
         recommendations = self.service_matcher.get_service_recommendations_by_conversation(self.conversation_id2, models.ServiceRecommendConversationQuery(mode="infer"))
         self.assertEqual(len(recommendations), 0)
         
-    @patch('requests.post', side_effect=mocked_requests_post)
+    @patch('requests.Session.post', side_effect=mocked_requests_post)
     def test_get_service_recommendations_by_intent(self, mock_post):
         
         recommendations = self.service_matcher.get_service_recommendations_by_intent(models.ServiceRecommendIntentQuery(intent="p1_greet"))
@@ -359,7 +708,7 @@ class ServiceMatchEngineTest(unittest.TestCase):
                                                                                                                         municipalities=["Naantali"]))
         self.assertEqual(len(recommendations), 0)
 
-    @patch('requests.post', side_effect=mocked_requests_post)
+    @patch('requests.Session.post', side_effect=mocked_requests_post)
     def test_get_service_recommendations_by_intent_and_options(self, mock_post):
 
         recommendations = self.service_matcher.get_service_recommendations_by_intent_and_options(models.ServiceRecommendIntentAndOptionsQuery(intent="ke7_something"))
@@ -369,17 +718,72 @@ class ServiceMatchEngineTest(unittest.TestCase):
         recommendations = self.service_matcher.get_service_recommendations_by_intent_and_options(models.ServiceRecommendIntentAndOptionsQuery(intent="p2_greet"))
         self.assertEqual(len(recommendations), 0) 
         
-    @patch('requests.post', side_effect=mocked_requests_post)
+    @patch('requests.Session.post', side_effect=mocked_requests_post)
     def test_get_service_recommendations(self, mock_post):
         os.environ['NLP_VECTORIZER_HOST'] = 'request_success'
         service_r = self.service_matcher.get_service_recommendations(models.ServiceRecommendQuery(need_text="Jotain", municipalities=["Turku"]))
         self.assertEqual(service_r[0]["service"].id, self.test_service_data[0]["id"])
 
-    @patch('requests.post', side_effect=mocked_requests_post)
+    @patch('requests.Session.post', side_effect=mocked_requests_post)
+    def test_nlp_vectorize_text_cache(self, mock_post):
+        os.environ['NLP_VECTORIZER_HOST'] = 'request_success'
+        vector1 = self.service_matcher.free_text_recommender._nlp_vectorize_text("Jotain  tekstiä")
+        vector2 = self.service_matcher.free_text_recommender._nlp_vectorize_text(" Jotain tekstiä ")
+        self.assertEqual(vector1, vector2)
+        self.assertEqual(mock_post.call_count, 1)
+        cache_stats = self.service_matcher.free_text_recommender.query_vector_cache.get_stats()
+        self.assertEqual(cache_stats["hits"], 1)
+        self.assertEqual(cache_stats["misses"], 1)
+        # Vectors may come from a previous model after the catalog has changed
+        self.service_matcher.update_desc_vectors()
+        self.service_matcher.free_text_recommender._nlp_vectorize_text("Jotain tekstiä")
+        self.assertEqual(mock_post.call_count, 2)
+
+    @patch('requests.Session.post', side_effect=mocked_requests_post)
+    def test_response_cache(self, mock_post):
+        os.environ['NLP_VECTORIZER_HOST'] = 'request_success'
+        query = models.ServiceRecommendQuery(need_text="Jotain", municipalities=["Turku"])
+        service_r = self.service_matcher.get_service_recommendations(query)
+        service_r2 = self.service_matcher.get_service_recommendations(models.ServiceRecommendQuery(need_text=" Jotain ", municipalities=["Turku"]))
+        self.assertEqual(service_r, service_r2)
+        # Synchronizing vectors invalidates cached responses
+        self.service_matcher.update_desc_vectors()
+        self.service_matcher.get_service_recommendations(query)
+        cache_stats = self.service_matcher.get_cache_stats()
+        self.assertEqual(cache_stats["catalog_generation"], 1)
+        self.assertEqual(cache_stats["response_cache"]["hits"], 1)
+        self.assertEqual(cache_stats["response_cache"]["misses"], 2)
+        self.assertEqual(cache_stats["response_cache"]["size"], 1)
+        self.assertGreater(cache_stats["response_cache"]["memory_bytes"], 0)
+        # Responses made from a pinned catalog are keyed on its generation even if a sync publishes a new catalog meanwhile
+        with self.service_matcher.db.pin_catalog():
+            self.service_matcher.update_desc_vectors()
+            cache_key = self.service_matcher._get_response_cache_key("recommend", query)
+        self.assertEqual(cache_key[1], 1)
+        self.assertEqual(self.service_matcher._get_response_cache_key("recommend", query)[1], 2)
+
+    @patch('requests.Session.post', side_effect=mocked_requests_post)
+    def test_nlp_vectorize_text_embedded(self, mock_post):
+        os.environ['NLP_VECTORIZER_HOST'] = 'request_success'
+        free_text_recommender = self.service_matcher.free_text_recommender
+        free_text_recommender.embedded_vectorizer = MagicMock()
+        free_text_recommender.embedded_vectorizer.vectorize.return_value.dict.return_value = {"vector": [1, 1, 1, 1], "model": "test"}
+        self.assertEqual(free_text_recommender._nlp_vectorize_text("Jotain"), [1, 1, 1, 1])
+        mock_post.assert_not_called()
+        # Remote NLP Vectorizer is used if the embedded one fails
+        free_text_recommender.embedded_vectorizer.vectorize.side_effect = RuntimeError("Vectorization failed")
+        self.assertEqual(free_text_recommender._nlp_vectorize_text("Jotain muuta"), NLP_VECTORIZER_JSON_RESPONSE_SUCCESS["vector"])
+        self.assertEqual(mock_post.call_count, 1)
+
+    @patch('requests.Session.post', side_effect=mocked_requests_post)
     def test_get_service_class_recommendations(self, mock_post):
         os.environ['NLP_VECTORIZER_HOST'] = 'request_success'
         service_r = self.service_matcher.get_service_class_recommendations(models.ServiceClassRecommendQuery(need_text="Jotain"))
         self.assertEqual(service_r[0]["service_class_code"], "P1")
+        # Class vectors are read from the database only when vectors are synchronized
+        self.mongo_client_instance.service_db.service_class_vectors.find.reset_mock()
+        self.service_matcher.get_service_class_recommendations(models.ServiceClassRecommendQuery(need_text="Jotain"))
+        self.mongo_client_instance.service_db.service_class_vectors.find.assert_not_called()
 
 if __name__ == '__main__':
     unittest.main()
@@ -53,9 +53,11 @@ def mocked_requests_post(*args, **kwargs):
         return MockResponse(NLP_VECTORIZER_JSON_RESPONSE_SUCCESS, 200)
     elif args[0] == 'request_error/vectorizerecommend':
         return MockResponse(JSON_RESPONSE_ERROR, 400)
-    if args[0] == 'request_success/searchServices':
+    if args[0] == 'request_success/vectorizeBatch':
+        return MockResponse({"vectors": [NLP_VECTORIZER_JSON_RESPONSE_SUCCESS["vector"] for text in kwargs["json"]["texts"]]}, 200)
+    if args[0] == 'request_success/searchServiceIds':
         return MockResponse(LEXICAL_TEXT_SEARCH_JSON_RESPONSE_SUCCESS, 200)
-    elif args[0] == 'request_error/searchServices':
+    elif args[0] == 'request_error/searchServiceIds':
         return MockResponse(JSON_RESPONSE_ERROR, 400)
 
 class FastAPITest(unittest.TestCase):
@@ -123,6 +125,9 @@ class FastAPITest(unittest.TestCase):
         self.mongo_client_instance.service_db.translations.find.return_value = [{"source_language":"fi", "target_language":"en", "source_text": "Ampumarata", "target_text": "Shooting range"}, {"source_language":"fi", "target_language":"en", "source_text": "Ampumaradalla tarkoitetaan sisällä olevaa tilaa tai ulkona olevaa aluetta, joka on ampuma-aseella maaliin ampumista varten.\n\nVähäisellä ampumaradalla tarkoitetaan ampumarataa, jolla on tarkoitettu ammuttavaksi enintään 10 000 laukausta vuodessa.\n\nLuvan ampumaradan perustamiseen ja ylläpitämiseen antaa ja peruuttaa Poliisihallitus. Myös ampumaratailmoitus tehdään Poliisihallitukselle.", "target_text": "Desc Translation"}, {"source_language":"fi", "target_language":"en", "source_text": "Ampumaradan perustaminen ja ylläpitäminen on luvanvaraista. Vähäisestä ampumaradasta on tehtävä ampumaratailmoitus.", "target_text": "Summ Translation"}]
         
         self.service_matcher = ServiceMatcher(self.mongo_client_instance)
+        # TestClient is itself a requests session so backend calls are mocked on the recommender's session only
+        self.service_matcher.free_text_recommender.api_session = MagicMock()
+        self.service_matcher.free_text_recommender.api_session.post.side_effect = mocked_requests_post
         self.service_match_api = ServiceMatchAPI(self.service_matcher)
 
         self.test_client = TestClient(self.service_match_api.app)
@@ -284,6 +289,24 @@ class FastAPITest(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json()[0]['service']['id'], self.test_service_data[0]['id'])
        
+    def test_cache_stats(self):
+        response = self.test_client.get("/cacheStats")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["response_cache"]["size"], 0)
+
+    def test_recommend_services_batch(self):
+        os.environ['NLP_VECTORIZER_HOST'] = 'request_success'
+        os.environ['LEXICAL_TEXT_SEARCH_HOST'] = 'request_success'
+        queries = [{"need_text": "Jotain", "municipalities": ['Turku']}, {"need_text": ""}, {"need_text": "Jotain muuta", "text_recommender": "nlp"}]
+        response = self.test_client.post("/services/recommendBatch", json=queries)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 3)
+        self.assertEqual(response.json()[1], [])
+        single_response = self.test_client.post("/services/recommend", json=queries[0])
+        self.assertEqual(response.json()[0], single_response.json())
+        single_response = self.test_client.post("/services/recommend", json=queries[2])
+        self.assertEqual(response.json()[2], single_response.json())
+
     @patch('requests.post', side_effect=mocked_requests_post)
     def test_recommend_service_classes(self, mock_post):
         os.environ['NLP_VECTORIZER_HOST'] = 'request_success'